@@ -3,34 +3,99 @@
 Система управления LoadLock с отслеживанием статуса
 """
 
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import (Flask, Request, Response, current_app, render_template, request, jsonify,
+                   send_file, stream_with_context)
+from flask.json.provider import DefaultJSONProvider
+import hmac
 import base64
 import json
+import click
 import os
 from pathlib import Path
-import requests
 from dotenv import load_dotenv
 from datetime import datetime
 import sqlite3
-import io
-from werkzeug.utils import secure_filename
+import time
+
+from db_connection import ConnectionManager
+from job_queue import JobQueue, JobWorkerPool, JobError
+from recognition_cache import HORA_PROMPT, RecognitionCache
+from image_preprocess import ImagePreprocessor, MEDIA_TYPES
+from label_reader import LocalLabelReader
+from event_stream import EventBroadcaster
+from migrations import migrate
+from bulk_import import BulkImporter, BulkImportError, batch_report
+from vision_client import VisionAPIError, get_vision_client
+from vision_batcher import VisionBatcher
+from upload_ingest import HashingSpool
+from thumbnails import ThumbnailMaker
+from blob_store import BlobStore, ImageReferences, file_extension, file_sha256
+from metrics import (HTTP_IN_PROGRESS, HTTP_LATENCY, UPLOAD_BYTES, MetricsExporter,
+                     instrument_methods)
+from profiling import ProfilingSettings, RequestProfiler, phase
+from table_export import EXPORT_FORMATS, EXPORT_SPECS, export_table, parse_date_range
 
 load_dotenv()
 
+class LoadLockRequest(Request):
+    """Запрос с отдельным лимитом размера тела для массового импорта"""
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'bulk_upload':
+            return current_app.config['BULK_MAX_CONTENT_LENGTH']
+        return current_app.config['MAX_CONTENT_LENGTH']
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        """Файлы /api/upload пишутся сразу в папку загрузок с подсчетом хэша"""
+        if self.endpoint != 'upload_file':
+            return super()._get_file_stream(total_content_length, content_type,
+                                            filename, content_length)
+        spool = HashingSpool(current_app.config['UPLOAD_FOLDER'],
+                             max_bytes=current_app.config['MAX_CONTENT_LENGTH'])
+        self.__dict__.setdefault('ingest_spools', []).append(spool)
+        return spool
+    
+    def close(self):
+        """Удаляет принятые, но не сохраненные файлы (ошибка, лишние поля формы)"""
+        super().close()
+        for spool in self.__dict__.get('ingest_spools', []):
+            spool.discard()
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON-ответы с учетом времени в фазе serialize (Server-Timing)"""
+    
+    def dumps(self, obj, **kwargs):
+        with phase('serialize'):
+            return super().dumps(obj, **kwargs)
+
 app = Flask(__name__)
+app.request_class = LoadLockRequest
+app.json = TimedJSONProvider(app)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['BULK_MAX_CONTENT_LENGTH'] = int(os.environ.get('BULK_MAX_CONTENT_LENGTH', 512 * 1024 * 1024))
 
 # Используем динамические пути для совместимости с облаком
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
-OUTPUT_DIR = os.path.join(BASE_DIR, 'output')
+# LOADLOCK_DATA_DIR - отдельная папка для данных (нагрузочные тесты, несколько экземпляров)
+DATA_DIR = os.environ.get('LOADLOCK_DATA_DIR', BASE_DIR)
+UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads')
+OUTPUT_DIR = os.path.join(DATA_DIR, 'output')
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
 
 # Создаем директории если их нет
-Path(UPLOAD_FOLDER).mkdir(exist_ok=True)
-Path(OUTPUT_DIR).mkdir(exist_ok=True)
+Path(UPLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
+Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+
+# Фото хранятся по хэшу содержимого: uploads/objects/ab/cd/<sha256>.<ext>
+upload_store = BlobStore.from_env(os.path.join(UPLOAD_FOLDER, 'objects'))
+# Срок хранения фото LoadLock в статусе ready (дни, 0 - без ограничения) и период
+# ожидания перед удалением файлов без ссылок (часы)
+UPLOAD_RETENTION_READY_DAYS = int(os.environ.get('UPLOAD_RETENTION_READY_DAYS', 30))
+UPLOAD_GC_GRACE_HOURS = float(os.environ.get('UPLOAD_GC_GRACE_HOURS', 24))
 
 # Статусы для LoadLock
 LOADLOCK_STATUSES = {
@@ -42,136 +107,323 @@ LOADLOCK_STATUSES = {
     'ready': {'label': 'מוכן', 'color': '#198754', 'emoji': '✅'},
 }
 
+# Границы корзин гистограммы времени в статусе, секунды (последняя корзина - "больше").
+# Используются в триггерах миграции 6: менять только вместе с новой миграцией
+STATS_BUCKETS = [3600, 4 * 3600, 12 * 3600, 24 * 3600, 3 * 24 * 3600, 7 * 24 * 3600]
+STATS_BUCKET_SQL = 'CASE {} ELSE {} END'.format(
+    ' '.join(f'WHEN d < {limit} THEN {i}' for i, limit in enumerate(STATS_BUCKETS)),
+    len(STATS_BUCKETS)
+)
+
+# Полный пересчет сводки из loadlocks и status_history (миграция 6 и rebuild_stats).
+# Интервал пребывания в old_status - от предыдущей смены статуса (или date_added) до этой
+STATS_REBUILD_SQL = [
+    'DELETE FROM loadlock_stats',
+    'DELETE FROM loadlock_stats_histogram',
+    """
+    UPDATE loadlocks SET status_since = COALESCE(
+        (SELECT MAX(timestamp) FROM status_history
+         WHERE loadlock_id = loadlocks.id AND old_status IS NOT new_status),
+        date_added)
+    WHERE status_since IS NOT COALESCE(
+        (SELECT MAX(timestamp) FROM status_history
+         WHERE loadlock_id = loadlocks.id AND old_status IS NOT new_status),
+        date_added)
+    """,
+    """
+    INSERT INTO loadlock_stats (status, count)
+    SELECT status, COUNT(*) FROM loadlocks WHERE status IS NOT NULL GROUP BY status
+    """,
+    """
+    CREATE TEMP TABLE IF NOT EXISTS stats_intervals (status TEXT, d REAL)
+    """,
+    'DELETE FROM temp.stats_intervals',
+    """
+    INSERT INTO temp.stats_intervals (status, d)
+    SELECT sh.old_status,
+           (julianday(sh.timestamp) - julianday(COALESCE(
+               LAG(sh.timestamp) OVER (PARTITION BY sh.loadlock_id ORDER BY sh.timestamp, sh.id),
+               l.date_added))) * 86400
+    FROM status_history sh
+    JOIN loadlocks l ON l.id = sh.loadlock_id
+    WHERE sh.old_status IS NOT NULL AND sh.old_status IS NOT sh.new_status
+    """,
+    """
+    INSERT INTO loadlock_stats (status, total_seconds, transitions)
+    SELECT status, SUM(MAX(d, 0)), COUNT(*) FROM temp.stats_intervals WHERE true GROUP BY status
+    ON CONFLICT(status) DO UPDATE SET total_seconds = excluded.total_seconds,
+                                      transitions = excluded.transitions
+    """,
+    f"""
+    INSERT INTO loadlock_stats_histogram (status, bucket, count)
+    SELECT status, {STATS_BUCKET_SQL}, COUNT(*) FROM temp.stats_intervals
+    WHERE true GROUP BY 1, 2
+    """,
+    'DROP TABLE temp.stats_intervals',
+]
+
+# Миграции loadlock.db: индекс в списке + 1 = версия схемы (PRAGMA user_version).
+# Существующие миграции не меняются - только добавляются новые в конец
+LOADLOCK_MIGRATIONS = [
+    # 1: основные таблицы
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS loadlocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hora_number TEXT NOT NULL UNIQUE,
+            name TEXT,
+            status TEXT DEFAULT 'inserted',
+            current_sample TEXT,
+            date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_updated TIMESTAMP,
+            image_path TEXT,
+            notes TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS status_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            loadlock_id INTEGER NOT NULL,
+            old_status TEXT,
+            new_status TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            notes TEXT,
+            FOREIGN KEY (loadlock_id) REFERENCES loadlocks(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS samples (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            loadlock_id INTEGER NOT NULL,
+            sample_name TEXT NOT NULL,
+            material TEXT,
+            date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            notes TEXT,
+            FOREIGN KEY (loadlock_id) REFERENCES loadlocks(id)
+        )
+        ''',
+    ],
+    # 2: журнал изменений для дельта-синхронизации: одна строка на LoadLock,
+    # seq растет монотонно (AUTOINCREMENT не переиспользует номера).
+    # Триггеры ловят любую запись в loadlocks в той же транзакции
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            loadlock_id INTEGER NOT NULL UNIQUE,
+            op TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS loadlocks_change_insert AFTER INSERT ON loadlocks
+        BEGIN
+            INSERT OR REPLACE INTO change_log (loadlock_id, op) VALUES (NEW.id, 'upsert');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS loadlocks_change_update AFTER UPDATE ON loadlocks
+        BEGIN
+            INSERT OR REPLACE INTO change_log (loadlock_id, op) VALUES (NEW.id, 'upsert');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS loadlocks_change_delete AFTER DELETE ON loadlocks
+        BEGIN
+            INSERT OR REPLACE INTO change_log (loadlock_id, op) VALUES (OLD.id, 'delete');
+        END
+        ''',
+    ],
+    # 3: события для SSE (/api/events); читаются всеми процессами gunicorn
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS event_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            loadlock_id INTEGER,
+            data TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ],
+    # 4: индексы под запросы истории, образцов и фильтра по статусу;
+    # сироты из старых версий мешали бы проверке внешних ключей
+    [
+        'DELETE FROM status_history WHERE loadlock_id NOT IN (SELECT id FROM loadlocks)',
+        'DELETE FROM samples WHERE loadlock_id NOT IN (SELECT id FROM loadlocks)',
+        'CREATE INDEX IF NOT EXISTS idx_status_history_loadlock_ts ON status_history(loadlock_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_samples_loadlock_date ON samples(loadlock_id, date_added)',
+        'CREATE INDEX IF NOT EXISTS idx_loadlocks_status ON loadlocks(status)',
+    ],
+    # 5: индексы под сортировки постраничного /api/loadlocks (выражения из LOADLOCK_SORTS)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_loadlocks_name ON loadlocks(COALESCE(name, ''), id)",
+        "CREATE INDEX IF NOT EXISTS idx_loadlocks_status_name ON loadlocks(status, COALESCE(name, ''), id)",
+        "CREATE INDEX IF NOT EXISTS idx_loadlocks_date_added ON loadlocks(COALESCE(date_added, ''), id)",
+        "CREATE INDEX IF NOT EXISTS idx_loadlocks_last_updated "
+        "ON loadlocks(COALESCE(last_updated, date_added, ''), id)",
+        "CREATE INDEX IF NOT EXISTS idx_loadlocks_status_last_updated "
+        "ON loadlocks(status, COALESCE(last_updated, date_added, ''), id)",
+    ],
+    # 6: сводка для /api/stats, которую триггеры ведут в той же транзакции, что и запись
+    # в loadlocks: число LoadLock в каждом статусе, суммарное время в статусе и гистограмма.
+    # status_since - момент входа в текущий статус (UTC, как CURRENT_TIMESTAMP)
+    [
+        'ALTER TABLE loadlocks ADD COLUMN status_since TIMESTAMP',
+        '''
+        CREATE TABLE IF NOT EXISTS loadlock_stats (
+            status TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0,
+            total_seconds REAL NOT NULL DEFAULT 0,
+            transitions INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS loadlock_stats_histogram (
+            status TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (status, bucket)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS loadlocks_stats_insert AFTER INSERT ON loadlocks
+        BEGIN
+            INSERT INTO loadlock_stats (status, count) VALUES (NEW.status, 1)
+            ON CONFLICT(status) DO UPDATE SET count = count + 1;
+            UPDATE loadlocks SET status_since = CURRENT_TIMESTAMP
+            WHERE id = NEW.id AND NEW.status_since IS NULL;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS loadlocks_stats_delete AFTER DELETE ON loadlocks
+        BEGIN
+            UPDATE loadlock_stats SET count = count - 1 WHERE status = OLD.status;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS loadlocks_stats_status AFTER UPDATE OF status ON loadlocks
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE loadlock_stats SET count = count - 1 WHERE status = OLD.status;
+            INSERT INTO loadlock_stats (status, count) VALUES (NEW.status, 1)
+            ON CONFLICT(status) DO UPDATE SET count = count + 1;
+            INSERT INTO loadlock_stats (status, total_seconds, transitions)
+            SELECT OLD.status, d, 1 FROM (
+                SELECT MAX(0, (julianday('now') - julianday(
+                    COALESCE(OLD.status_since, OLD.date_added, 'now'))) * 86400) AS d
+            ) WHERE true
+            ON CONFLICT(status) DO UPDATE SET total_seconds = total_seconds + excluded.total_seconds,
+                                              transitions = transitions + 1;
+            INSERT INTO loadlock_stats_histogram (status, bucket, count)
+            SELECT OLD.status, {STATS_BUCKET_SQL}, 1 FROM (
+                SELECT MAX(0, (julianday('now') - julianday(
+                    COALESCE(OLD.status_since, OLD.date_added, 'now'))) * 86400) AS d
+            ) WHERE true
+            ON CONFLICT(status, bucket) DO UPDATE SET count = count + 1;
+            UPDATE loadlocks SET status_since = CURRENT_TIMESTAMP WHERE id = NEW.id;
+        END
+        ''',
+        *STATS_REBUILD_SQL,
+    ],
+    # 7: миниатюра фото для карточек (строится фоновой задачей thumbnail)
+    [
+        'ALTER TABLE loadlocks ADD COLUMN thumb_path TEXT',
+    ],
+]
+
+# Сортировки постраничного /api/loadlocks: ключ -> выражение SQL.
+# Под каждое выражение есть индекс (выражение, id), поэтому страница читается
+# по индексу без сортировки всей таблицы. hora_number - по UNIQUE-индексу
+LOADLOCK_SORTS = {
+    'name': "COALESCE(name, '')",
+    'hora_number': 'hora_number',
+    'date_added': "COALESCE(date_added, '')",
+    'last_updated': "COALESCE(last_updated, date_added, '')",
+}
+LOADLOCK_PAGE_SIZE = 100
+LOADLOCK_PAGE_MAX = 500
+
+
 class LoadLockManager:
     def __init__(self):
         self.api_key = os.getenv('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("OPENAI_API_KEY not set")
         
-        self.base_url = "https://api.openai.com/v1"
+        self.base_url = os.getenv('VISION_API_BASE_URL', "https://api.openai.com/v1")
+        # Один пул соединений и общий лимит запросов на процесс
+        self.vision = get_vision_client(self.api_key, self.base_url)
+        self.model = "gpt-4o"
+        self.batcher = VisionBatcher.from_env(self.vision, self.model)
         self.output_dir = Path(OUTPUT_DIR)
         self.output_dir.mkdir(exist_ok=True)
+        # Кэш общий с hora_scanner.py (тот же файл в output/)
+        self.cache = RecognitionCache.from_env(self.output_dir / "recognition_cache.db")
+        self.preprocessor = ImagePreprocessor.from_env()
+        self.label_reader = LocalLabelReader.from_env()
+        self.thumbnails = ThumbnailMaker.from_env(self.output_dir / "thumbnails")
         self.db_path = self.output_dir / "loadlock.db"
+        # Постоянные соединения на поток вместо connect/close в каждом методе
+        self.db = ConnectionManager(self.db_path)
         self.init_database()
+        self.events = EventBroadcaster(self.db)
     
     def init_database(self):
-        """Инициализирует базу данных LoadLock"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Таблица для LoadLock камер
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS loadlocks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                hora_number TEXT NOT NULL UNIQUE,
-                name TEXT,
-                status TEXT DEFAULT 'inserted',
-                current_sample TEXT,
-                date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_updated TIMESTAMP,
-                image_path TEXT,
-                notes TEXT
-            )
-        ''')
-        
-        # Таблица для истории изменений статуса
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS status_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                loadlock_id INTEGER NOT NULL,
-                old_status TEXT,
-                new_status TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                notes TEXT,
-                FOREIGN KEY (loadlock_id) REFERENCES loadlocks(id)
-            )
-        ''')
-        
-        # Таблица для образцов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS samples (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                loadlock_id INTEGER NOT NULL,
-                sample_name TEXT NOT NULL,
-                material TEXT,
-                date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                notes TEXT,
-                FOREIGN KEY (loadlock_id) REFERENCES loadlocks(id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        """Инициализирует базу данных LoadLock (применяет недостающие миграции)"""
+        migrate(self.db.connection, LOADLOCK_MIGRATIONS)
+    
+    def log_event(self, cursor, event, loadlock_id, **data):
+        """Записывает событие в event_log в текущей транзакции"""
+        cursor.execute(
+            'INSERT INTO event_log (event, loadlock_id, data) VALUES (?, ?, ?)',
+            (event, loadlock_id, json.dumps(data, ensure_ascii=False))
+        )
     
     def image_to_base64(self, image_path):
         """Преобразует изображение в base64"""
         with open(image_path, 'rb') as image_file:
             return base64.standard_b64encode(image_file.read()).decode('utf-8')
     
-    def extract_hora_number(self, image_path):
-        """Извлекает номер הוראה из изображения"""
+    def extract_hora_number(self, image_path, content_hash=None):
+        """Извлекает номер הוראה из изображения (content_hash - SHA-256 файла, если уже известен)"""
         if not os.path.exists(image_path):
             return None
         
-        prompt = """You are a specialist in recognizing machine instruction numbers (מספר הוראה) in vacuum chamber systems.
-
-Analyze this image carefully and extract the "מספר הוראה" (instruction number).
-Return ONLY a JSON object with this exact structure:
-{
-    "hora_number": "THE NUMBER YOU FOUND",
-    "confidence": "high/medium/low",
-    "location": "where on the image",
-    "additional_info": "any other visible text"
-}"""
+        # Повторная загрузка того же фото отвечается из кэша без запроса к API
+        cache_key, cached = self.cached_recognition(image_path, content_hash=content_hash)
+        if cached is not None:
+            return cached
         
-        image_base64 = self.image_to_base64(image_path)
-        ext = Path(image_path).suffix.lower()
-        media_type_map = {
-            '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
-            '.gif': 'image/gif', '.webp': 'image/webp'
-        }
-        media_type = media_type_map.get(ext, 'image/jpeg')
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        payload = {
-            "model": "gpt-4o",
-            "messages": [{
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{media_type};base64,{image_base64}"
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ]
-            }],
-            "max_tokens": 500
-        }
+        # Уменьшаем и перекодируем фото перед отправкой; base64 строится потоково при отправке
+        with phase('encode'):
+            image_source, stats = self.preprocessor.prepare_source(image_path)
+        print(f"Image prepared: {stats['original_bytes']} -> {stats['sent_bytes']} bytes "
+              f"(saved {stats['saved_bytes']})")
         
         try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=60
-            )
-            response.raise_for_status()
-            result = response.json()
-            if 'choices' in result and len(result['choices']) > 0:
-                return result['choices'][0]['message']['content']
-            return None
-        except requests.exceptions.RequestException as e:
+            # Фото, одновременно ждущие распознавания, уходят одним пакетным запросом
+            answer = self.batcher.complete(image_source, HORA_PROMPT)
+        except VisionAPIError as e:
             print(f"API Error: {e}")
             return None
+        if answer is None:
+            return None
+        self.remember_recognition(cache_key, answer)
+        return answer
+    
+    def cached_recognition(self, image_path, content_hash=None):
+        """Ключ кэша и сохраненный ответ (строка JSON с source=cache) или None"""
+        cache_key = self.cache.make_key(image_path, HORA_PROMPT, self.model, content_hash=content_hash)
+        cached = self.cache.get(cache_key)
+        if cached is None:
+            return cache_key, None
+        return cache_key, json.dumps({**cached, 'source': 'cache'}, ensure_ascii=False)
+    
+    def remember_recognition(self, cache_key, answer):
+        """Кэширует ответ API, если номер найден"""
+        data = self.parse_hora_response(answer)
+        if data and data.get('hora_number') != 'NOT_FOUND':
+            self.cache.put(cache_key, data)
     
     def parse_hora_response(self, response_text):
         """Парсит ответ ИИ"""
@@ -184,52 +436,232 @@ Return ONLY a JSON object with this exact structure:
         except json.JSONDecodeError:
             return None
     
+    def recognize_image(self, image_path, progress=None, content_hash=None):
+        """Распознает номер на изображении: (data, error); data['source'] - кто ответил"""
+        report = progress or (lambda stage: None)
+        
+        # Сначала пробуем прочитать этикетку локально, API - только при низкой уверенности
+        report('local_ocr')
+        data = self.label_reader.read_confident(image_path) if self.label_reader else None
+        
+        if data is None:
+            report('recognizing')
+            response = self.extract_hora_number(image_path, content_hash=content_hash)
+            
+            if not response:
+                return None, 'Error processing image'
+            
+            # Парсим ответ
+            report('parsing')
+            data = self.parse_hora_response(response)
+            
+            if not data:
+                return None, 'Error parsing response'
+        
+        data.setdefault('source', 'remote')
+        return data, None
+    
+    def recognize_upload(self, image_path, progress=None, content_hash=None):
+        """Распознает номер на загруженном изображении и добавляет LoadLock"""
+        report = progress or (lambda stage: None)
+        
+        data, error = self.recognize_image(image_path, report, content_hash=content_hash)
+        if error:
+            return {'error': error}
+        return self.save_recognition(image_path, data, report)
+    
+    def save_recognition(self, image_path, data, progress=None):
+        """Добавляет LoadLock по распознанному номеру; результат задачи распознавания"""
+        report = progress or (lambda stage: None)
+        source = data['source']
+        
+        if data.get('hora_number') == 'NOT_FOUND':
+            return {
+                'success': False,
+                'message': 'Could not recognize instruction number',
+                'additional_info': data.get('additional_info', ''),
+                'source': source
+            }
+        
+        hora_number = data.get('hora_number', 'UNKNOWN')
+        confidence = data.get('confidence', 'unknown')
+        
+        # Добавляем в БД
+        report('saving')
+        added, loadlock_id = self.add_loadlock(
+            hora_number, 
+            name=f"LoadLock {hora_number}",
+            image_path=image_path,
+            notes=f"Confidence: {confidence}, Source: {source}"
+        )
+        
+        return {
+            'success': True,
+            'hora_number': hora_number,
+            'confidence': confidence,
+            'loadlock_id': loadlock_id,
+            'already_exists': not added,
+            'source': source
+        }
+    
     def add_loadlock(self, hora_number, name="", image_path="", notes=""):
         """Добавляет новый LoadLock"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        name = name or hora_number
         
-        try:
-            cursor.execute('''
-                INSERT INTO loadlocks (hora_number, name, image_path, notes, last_updated)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (hora_number, name or hora_number, image_path, notes, datetime.now()))
+        with self.db.transaction() as cursor:
+            try:
+                cursor.execute('''
+                    INSERT INTO loadlocks (hora_number, name, image_path, notes, last_updated)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (hora_number, name, image_path, notes, datetime.now()))
+            except sqlite3.IntegrityError:
+                return False, None
             
-            conn.commit()
             loadlock_id = cursor.lastrowid
-            return True, loadlock_id
+            self.log_event(cursor, 'loadlock_added', loadlock_id,
+                           hora_number=hora_number, name=name)
         
-        except sqlite3.IntegrityError:
-            return False, None
-        
-        finally:
-            conn.close()
+        self.events.notify()
+        return True, loadlock_id
     
     def get_all_loadlocks(self):
         """Получает все LoadLock"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        cursor = self.db.execute('''
             SELECT id, hora_number, name, status, current_sample, 
                    date_added, last_updated, notes 
             FROM loadlocks 
             ORDER BY name
         ''')
-        loadlocks = cursor.fetchall()
-        conn.close()
+        return cursor.fetchall()
+    
+    def query_loadlocks(self, statuses=None, q=None, sort='name', descending=False,
+                        limit=LOADLOCK_PAGE_SIZE, after=None):
+        """Страница LoadLock по ключу: (строки, ключ следующей страницы, счетчики по статусам)"""
+        expr = LOADLOCK_SORTS[sort]
+        where, params = [], []
+        if q:
+            # Префикс как диапазон [q, q+1): работает по индексам hora_number и name
+            upper = q[:-1] + chr(min(ord(q[-1]) + 1, 0x10FFFF))
+            name_expr = LOADLOCK_SORTS['name']
+            where.append(f'((hora_number >= ? AND hora_number < ?) '
+                         f'OR ({name_expr} >= ? AND {name_expr} < ?))')
+            params += [q, upper, q, upper]
+        # Счетчики учитывают поиск, но не фильтр статуса - для вкладок по статусам
+        count_where, count_params = list(where), list(params)
+        if statuses:
+            where.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params += list(statuses)
+        if after is not None:
+            # (expr, id) > (?, ?) в раскрытом виде: первое условие дает поиск по индексу
+            op = '<' if descending else '>'
+            where.append(f'{expr} {op}= ? AND ({expr} {op} ? OR id {op} ?)')
+            params += [after[0], after[0], after[1]]
         
-        return loadlocks
+        order = 'DESC' if descending else 'ASC'
+        page_sql = f'''
+            SELECT id, hora_number, name, status, current_sample,
+                   date_added, last_updated, notes, {expr}
+            FROM loadlocks
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY {expr} {order}, id {order}
+            LIMIT ?
+        '''
+        count_sql = f'''
+            SELECT status, COUNT(*) FROM loadlocks
+            {'WHERE ' + ' AND '.join(count_where) if count_where else ''}
+            GROUP BY status
+        '''
+        with self.db.snapshot() as cursor:
+            cursor.execute(page_sql, params + [limit + 1])
+            rows = cursor.fetchall()
+            if q:
+                cursor.execute(count_sql, count_params)
+            else:
+                # Без поиска счетчики берутся из сводки, которую ведут триггеры
+                cursor.execute('SELECT status, count FROM loadlock_stats WHERE count > 0')
+            counts = dict(cursor.fetchall())
+        
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (rows[-1][8], rows[-1][0])
+        return [row[:8] for row in rows], next_key, counts
+    
+    def get_stats(self):
+        """Сводка по статусам: число LoadLock, среднее время в статусе и гистограмма"""
+        with self.db.snapshot() as cursor:
+            cursor.execute('SELECT status, count, total_seconds, transitions FROM loadlock_stats')
+            rows = cursor.fetchall()
+            cursor.execute('SELECT status, bucket, count FROM loadlock_stats_histogram')
+            histogram_rows = cursor.fetchall()
+        
+        histograms = {}
+        for status, bucket, count in histogram_rows:
+            histograms.setdefault(status, [0] * (len(STATS_BUCKETS) + 1))[bucket] = count
+        
+        stats = {}
+        for status, count, total_seconds, transitions in rows:
+            stats[status] = {
+                'count': count,
+                'transitions': transitions,
+                'total_seconds': round(total_seconds, 1),
+                'avg_seconds': round(total_seconds / transitions, 1) if transitions else None,
+                'histogram': histograms.get(status, [0] * (len(STATS_BUCKETS) + 1))
+            }
+        return stats
+    
+    def rebuild_stats(self):
+        """Пересчитывает сводку из loadlocks и status_history (исправляет расхождения).
+
+        История удаленных LoadLock удаляется вместе с ними, поэтому после пересчета
+        время в статусах считается только по существующим LoadLock.
+        """
+        with self.db.transaction() as cursor:
+            for sql in STATS_REBUILD_SQL:
+                cursor.execute(sql)
+    
+    def get_change_seq(self):
+        """Получает текущий номер последнего изменения"""
+        return self.db.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+    
+    def get_loadlock_changes(self, since):
+        """Получает LoadLock, измененные после since: (seq, измененные, удаленные id, полный список?)"""
+        with self.db.snapshot() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+            seq = cursor.fetchone()[0]
+            
+            # since=0 или seq из "будущего" (БД пересоздана) - отдаем полный список
+            if since <= 0 or since > seq:
+                cursor.execute('''
+                    SELECT id, hora_number, name, status, current_sample, 
+                           date_added, last_updated, notes 
+                    FROM loadlocks 
+                    ORDER BY name
+                ''')
+                return seq, cursor.fetchall(), [], True
+            
+            cursor.execute('''
+                SELECT c.op, c.loadlock_id, l.id, l.hora_number, l.name, l.status,
+                       l.current_sample, l.date_added, l.last_updated, l.notes
+                FROM change_log c
+                LEFT JOIN loadlocks l ON l.id = c.loadlock_id
+                WHERE c.seq > ?
+                ORDER BY c.seq
+            ''', (since,))
+            changed, deleted = [], []
+            for row in cursor.fetchall():
+                if row[0] == 'delete' or row[2] is None:
+                    deleted.append(row[1])
+                else:
+                    changed.append(row[2:])
+            return seq, changed, deleted, False
     
     def update_status(self, loadlock_id, new_status, notes=""):
         """Обновляет статус LoadLock"""
         if new_status not in LOADLOCK_STATUSES:
             return False
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
+        with self.db.transaction() as cursor:
             # Получаем старый статус
             cursor.execute('SELECT status FROM loadlocks WHERE id = ?', (loadlock_id,))
             result = cursor.fetchone()
@@ -251,82 +683,196 @@ Return ONLY a JSON object with this exact structure:
                 VALUES (?, ?, ?, ?)
             ''', (loadlock_id, old_status, new_status, notes))
             
-            conn.commit()
-            return True
+            self.log_event(cursor, 'status_changed', loadlock_id,
+                           old_status=old_status, new_status=new_status)
         
-        finally:
-            conn.close()
+        self.events.notify()
+        return True
     
-    def add_sample(self, loadlock_id, sample_name, material="", notes=""):
-        """Добавляет образец в LoadLock"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def bulk_update_status(self, new_status, loadlock_ids=None, from_status=None, notes=""):
+        """Переводит несколько LoadLock в новый статус одной транзакцией"""
+        if new_status not in LOADLOCK_STATUSES:
+            return None
         
-        try:
-            cursor.execute('''
-                INSERT INTO samples (loadlock_id, sample_name, material, notes)
-                VALUES (?, ?, ?, ?)
-            ''', (loadlock_id, sample_name, material, notes))
+        with self.db.transaction() as cursor:
+            if loadlock_ids is not None:
+                ids = list(dict.fromkeys(int(i) for i in loadlock_ids))
+                current = {}
+                # Порциями, чтобы не упереться в лимит параметров SQLite
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    cursor.execute(
+                        f'SELECT id, status FROM loadlocks WHERE id IN ({placeholders})', chunk
+                    )
+                    current.update(cursor.fetchall())
+            else:
+                cursor.execute('SELECT id, status FROM loadlocks WHERE status = ?', (from_status,))
+                current = dict(cursor.fetchall())
+                ids = list(current)
             
-            # Обновляем текущий образец в LoadLock
-            cursor.execute('''
+            changed = [(ll_id, old) for ll_id, old in current.items() if old != new_status]
+            now = datetime.now()
+            
+            cursor.executemany('''
                 UPDATE loadlocks 
-                SET current_sample = ?
+                SET status = ?, last_updated = ?
                 WHERE id = ?
-            ''', (sample_name, loadlock_id))
+            ''', [(new_status, now, ll_id) for ll_id, _ in changed])
+            
+            cursor.executemany('''
+                INSERT INTO status_history (loadlock_id, old_status, new_status, notes)
+                VALUES (?, ?, ?, ?)
+            ''', [(ll_id, old, new_status, notes) for ll_id, old in changed])
             
-            conn.commit()
-            return True
+            cursor.executemany(
+                'INSERT INTO event_log (event, loadlock_id, data) VALUES (?, ?, ?)',
+                [('status_changed', ll_id,
+                  json.dumps({'old_status': old, 'new_status': new_status}))
+                 for ll_id, old in changed]
+            )
+        
+        if changed:
+            self.events.notify()
+        
+        results = []
+        for ll_id in ids:
+            if ll_id not in current:
+                results.append({'id': ll_id, 'success': False, 'error': 'LoadLock not found'})
+            else:
+                results.append({
+                    'id': ll_id,
+                    'success': True,
+                    'old_status': current[ll_id],
+                    'changed': current[ll_id] != new_status
+                })
+        return results
+    
+    def add_sample(self, loadlock_id, sample_name, material="", notes=""):
+        """Добавляет образец в LoadLock"""
+        try:
+            with self.db.transaction() as cursor:
+                cursor.execute('''
+                    INSERT INTO samples (loadlock_id, sample_name, material, notes)
+                    VALUES (?, ?, ?, ?)
+                ''', (loadlock_id, sample_name, material, notes))
+                
+                # Обновляем текущий образец в LoadLock
+                cursor.execute('''
+                    UPDATE loadlocks 
+                    SET current_sample = ?
+                    WHERE id = ?
+                ''', (sample_name, loadlock_id))
+                
+                self.log_event(cursor, 'sample_added', loadlock_id, sample_name=sample_name)
+        
+        except sqlite3.IntegrityError:
+            # Несуществующий LoadLock (внешний ключ) или пустое имя образца
+            return False
         
-        finally:
-            conn.close()
+        self.events.notify()
+        return True
     
     def get_loadlock_history(self, loadlock_id):
         """Получает историю изменений статуса"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        cursor = self.db.execute('''
             SELECT old_status, new_status, timestamp, notes
             FROM status_history
             WHERE loadlock_id = ?
             ORDER BY timestamp DESC
             LIMIT 50
         ''', (loadlock_id,))
-        
-        history = cursor.fetchall()
-        conn.close()
-        
-        return history
+        return cursor.fetchall()
     
     def get_loadlock_samples(self, loadlock_id):
         """Получает все образцы в LoadLock"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        cursor = self.db.execute('''
             SELECT id, sample_name, material, date_added, notes
             FROM samples
             WHERE loadlock_id = ?
             ORDER BY date_added DESC
         ''', (loadlock_id,))
+        return cursor.fetchall()
+    
+    def get_loadlock_image(self, loadlock_id):
+        """Пути фото и миниатюры LoadLock: (image_path, thumb_path) или None"""
+        return self.db.execute(
+            'SELECT image_path, thumb_path FROM loadlocks WHERE id = ?', (loadlock_id,)
+        ).fetchone()
+    
+    def build_thumbnail(self, loadlock_id, force=False):
+        """Строит миниатюру фото LoadLock и возвращает ее путь (None - фото нет или не читается)"""
+        row = self.get_loadlock_image(loadlock_id)
+        if not row or not row[0] or not os.path.exists(row[0]):
+            return None
+        image_path, thumb_path = row
+        if thumb_path and os.path.exists(thumb_path) and not force:
+            return thumb_path
         
-        samples = cursor.fetchall()
-        conn.close()
-        
-        return samples
+        path = self.thumbnails.make(image_path, f"ll{loadlock_id}_{Path(image_path).stem}")
+        if path is None:
+            return None
+        with self.db.transaction() as cursor:
+            cursor.execute('UPDATE loadlocks SET thumb_path = ? WHERE id = ?', (str(path), loadlock_id))
+        return str(path)
+    
+    def get_loadlocks_without_thumbnails(self, force=False):
+        """id LoadLock с фото, для которых нужно построить миниатюру"""
+        cursor = self.db.execute(f'''
+            SELECT id, thumb_path FROM loadlocks
+            WHERE image_path IS NOT NULL AND image_path != ''
+            {'' if force else 'AND thumb_path IS NULL'}
+            ORDER BY id
+        ''')
+        return [row[0] for row in cursor.fetchall()
+                if force or not row[1] or not os.path.exists(row[1])]
+    
+    def expire_ready_images(self, days, dry_run=False):
+        """Убирает ссылки на фото LoadLock, которые дольше days дней в статусе ready.
+    
+        Сами файлы удаляет сборка мусора хранилища, если на них больше никто не ссылается.
+        Возвращает число LoadLock.
+        """
+        rows = self.db.execute('''
+            SELECT id, thumb_path FROM loadlocks
+            WHERE status = 'ready' AND status_since < datetime('now', ?)
+              AND image_path IS NOT NULL AND image_path != ''
+        ''', (f'-{int(days)} days',)).fetchall()
+        if dry_run or not rows:
+            return len(rows)
+    
+        with self.db.transaction() as cursor:
+            cursor.executemany('UPDATE loadlocks SET image_path = NULL, thumb_path = NULL WHERE id = ?',
+                               [(row[0],) for row in rows])
+        for _, thumb_path in rows:
+            if thumb_path:
+                try:
+                    os.remove(thumb_path)
+                except FileNotFoundError:
+                    pass
+        self.events.notify()
+        return len(rows)
     
     def delete_loadlock(self, loadlock_id):
         """Удаляет LoadLock"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM loadlocks WHERE id = ?', (loadlock_id,))
-        cursor.execute('DELETE FROM status_history WHERE loadlock_id = ?', (loadlock_id,))
-        cursor.execute('DELETE FROM samples WHERE loadlock_id = ?', (loadlock_id,))
+        image = self.get_loadlock_image(loadlock_id)
+        with self.db.transaction() as cursor:
+            # Сначала дочерние строки - внешние ключи проверяются
+            cursor.execute('DELETE FROM status_history WHERE loadlock_id = ?', (loadlock_id,))
+            cursor.execute('DELETE FROM samples WHERE loadlock_id = ?', (loadlock_id,))
+            cursor.execute('DELETE FROM loadlocks WHERE id = ?', (loadlock_id,))
+            self.log_event(cursor, 'loadlock_deleted', loadlock_id)
         
-        conn.commit()
-        conn.close()
+        # Миниатюра принадлежит только этому LoadLock
+        if image and image[1]:
+            try:
+                os.remove(image[1])
+            except FileNotFoundError:
+                pass
+        self.events.notify()
+
+# Время каждого метода менеджера - в метриках (loadlock_manager_call_duration_seconds)
+instrument_methods(LoadLockManager, exclude=('log_event', 'parse_hora_response'))
 
 # Инициализируем менеджер
 try:
@@ -334,6 +880,114 @@ try:
 except ValueError as e:
     print(f"Error: {e}")
 
+# Ссылки на фото: LoadLock и станки hora_scanner.py. Базы разные, поэтому счетчик
+# ссылок считается по обеим при сборке мусора, а не ведется триггерами
+image_references = ImageReferences([
+    (Path(OUTPUT_DIR) / "loadlock.db", 'loadlocks', 'image_path'),
+    (Path(OUTPUT_DIR) / "machines.db", 'machines', 'image_path'),
+])
+
+def run_recognition_job(payload, progress):
+    """Обработчик фоновой задачи распознавания загруженного фото"""
+    result = manager.recognize_upload(payload['image_path'], progress,
+                                      content_hash=payload.get('sha256'))
+    return recognition_job_result(result)
+
+def recognition_job_result(result):
+    """Итог задачи распознавания: JobError при ошибке, для нового LoadLock - задача миниатюры"""
+    if 'error' in result:
+        raise JobError(result['error'])
+    if result.get('loadlock_id') and not result.get('already_exists'):
+        enqueue_thumbnails([result['loadlock_id']])
+    return result
+
+def run_thumbnail_job(payload, progress):
+    """Обработчик фоновой задачи построения миниатюры"""
+    return {'thumb_path': manager.build_thumbnail(payload['loadlock_id'])}
+
+def enqueue_thumbnails(loadlock_ids):
+    """Ставит в очередь построение миниатюр для новых LoadLock"""
+    for loadlock_id in loadlock_ids:
+        job_queue.enqueue('thumbnail', {'loadlock_id': loadlock_id})
+
+JOB_HANDLERS = {'recognize': run_recognition_job, 'thumbnail': run_thumbnail_job}
+
+# Очередь распознавания; UPLOAD_WORKERS=0 если задачи выполняет отдельный процесс worker.py
+# BULK_IMPORT_CONCURRENCY - одновременных задач одного массового импорта (во всех процессах)
+job_queue = JobQueue(Path(OUTPUT_DIR) / "jobs.db",
+                     batch_concurrency=int(os.environ.get('BULK_IMPORT_CONCURRENCY', 4)))
+job_workers = JobWorkerPool(job_queue, JOB_HANDLERS, size=int(os.environ.get('UPLOAD_WORKERS', 2)))
+if job_workers.size > 0:
+    job_workers.start()
+
+metrics_exporter = MetricsExporter(job_queue)
+# Server-Timing и выборочные профили запросов (output/profiles/), включаются на лету
+profiling_settings = ProfilingSettings.from_env(Path(OUTPUT_DIR) / "profiling.json")
+request_profiler = RequestProfiler(profiling_settings, Path(OUTPUT_DIR) / "profiles")
+
+@app.before_request
+def start_request_timer():
+    request.environ['loadlock.started'] = time.perf_counter()
+    HTTP_IN_PROGRESS.inc()
+    request.environ['loadlock.profile'] = request_profiler.begin()
+
+@app.after_request
+def observe_request(response):
+    """Задержка маршрута по endpoint (а не пути, чтобы id не раздували число рядов)"""
+    started = request.environ.get('loadlock.started')
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        HTTP_LATENCY.labels(endpoint, request.method, str(response.status_code)).observe(elapsed)
+        profile = request.environ.get('loadlock.profile')
+        if profile is not None:
+            request_profiler.finish(profile, elapsed, response, name=endpoint)
+    return response
+
+@app.teardown_request
+def finish_request(exc):
+    started = request.environ.pop('loadlock.started', None)
+    if started is not None:
+        HTTP_IN_PROGRESS.dec()
+        # Если ответ не дошел до after_request - только освобождаем профайлер
+        profile = request.environ.pop('loadlock.profile', None)
+        if profile is not None:
+            request_profiler.finish(profile, time.perf_counter() - started)
+
+def check_admin_token():
+    """None, если запрос с верным ADMIN_TOKEN, иначе ответ с ошибкой"""
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token:
+        return jsonify({'error': 'Admin API disabled (ADMIN_TOKEN not set)'}), 404
+    supplied = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8')):
+        return jsonify({'error': 'Forbidden'}), 403
+    return None
+
+@app.route('/api/admin/profiling', methods=['GET', 'POST', 'DELETE'])
+def admin_profiling():
+    """Настройки профилирования: server_timing, sample_rate (0..1), slow_ms (0 - выкл.).
+    POST меняет их для всех процессов без перезапуска, DELETE возвращает значения из окружения"""
+    error = check_admin_token()
+    if error:
+        return error
+    if request.method == 'POST':
+        try:
+            settings = profiling_settings.update(request.get_json(silent=True))
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+    elif request.method == 'DELETE':
+        settings = profiling_settings.reset()
+    else:
+        settings = profiling_settings.current()
+    return jsonify(settings), 200
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в формате Prometheus (со всех процессов gunicorn)"""
+    output, content_type = metrics_exporter.render()
+    return Response(output, content_type=content_type)
+
 def allowed_file(filename):
     """Проверяет расширение файла"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -343,26 +997,196 @@ def index():
     """Главная страница"""
     return render_template('loadlock.html', statuses=LOADLOCK_STATUSES)
 
+def serialize_loadlock(ll):
+    """Преобразует строку loadlocks в JSON-объект"""
+    return {
+        'id': ll[0],
+        'hora_number': ll[1],
+        'name': ll[2],
+        'status': ll[3],
+        'current_sample': ll[4],
+        'date_added': ll[5],
+        'last_updated': ll[6],
+        'notes': ll[7],
+        'status_info': LOADLOCK_STATUSES.get(ll[3], {})
+    }
+
+# Любой из этих параметров переключает /api/loadlocks в постраничный режим
+PAGE_PARAMS = {'status', 'q', 'sort', 'limit', 'after'}
+
+def encode_cursor(sort, key):
+    """Курсор следующей страницы: сортировка и ключ последней строки"""
+    raw = json.dumps([sort, key[0], key[1]], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort):
+    """Разбирает курсор; ValueError, если он битый или от другой сортировки"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, value, loadlock_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort or not isinstance(loadlock_id, int):
+        raise ValueError('Cursor does not match sort')
+    return value, loadlock_id
+
+def parse_int(value, default=None):
+    """Целое из параметра запроса или default (как args.get(..., type=int) во Flask)"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def loadlocks_page(args, seq):
+    """Страница LoadLock по параметрам status, q, sort, limit, after: (тело ответа, код).
+    args - параметры запроса (Flask или Starlette)"""
+    statuses = [s for s in args.get('status', '').split(',') if s]
+    unknown = [s for s in statuses if s not in LOADLOCK_STATUSES]
+    if unknown:
+        return {'error': f"Unknown status: {', '.join(unknown)}"}, 400
+    
+    sort = args.get('sort', 'name')
+    descending = sort.startswith('-')
+    sort_key = sort.lstrip('-')
+    if sort_key not in LOADLOCK_SORTS:
+        return {'error': f"Unknown sort, use one of: {', '.join(LOADLOCK_SORTS)}"}, 400
+    
+    limit = parse_int(args.get('limit'), LOADLOCK_PAGE_SIZE)
+    limit = max(1, min(limit, LOADLOCK_PAGE_MAX))
+    after = None
+    if args.get('after'):
+        try:
+            after = decode_cursor(args['after'], sort)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+    
+    rows, next_key, counts = manager.query_loadlocks(
+        statuses=statuses, q=args.get('q', '').strip() or None,
+        sort=sort_key, descending=descending, limit=limit, after=after
+    )
+    total = sum(n for status, n in counts.items() if not statuses or status in statuses)
+    with phase('serialize'):
+        items = [serialize_loadlock(ll) for ll in rows]
+    return {
+        'seq': seq,
+        'items': items,
+        'counts': counts,
+        'total': total,
+        'limit': limit,
+        'sort': sort,
+        'next_after': encode_cursor(sort, next_key) if next_key else None
+    }, 200
+
 @app.route('/api/loadlocks', methods=['GET'])
 def get_loadlocks():
-    """Получает все LoadLock"""
-    loadlocks = manager.get_all_loadlocks()
-    
-    result = []
-    for ll in loadlocks:
-        result.append({
-            'id': ll[0],
-            'hora_number': ll[1],
-            'name': ll[2],
-            'status': ll[3],
-            'current_sample': ll[4],
-            'date_added': ll[5],
-            'last_updated': ll[6],
-            'notes': ll[7],
-            'status_info': LOADLOCK_STATUSES.get(ll[3], {})
+    """Получает LoadLock: весь список, изменения после ?since=<seq> или страницу с фильтрами"""
+    # Номер изменения берем до чтения данных: ETag никогда не опережает содержимое
+    seq = manager.get_change_seq()
+    etag = f'"ll-{seq}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return '', 304, {'ETag': etag}
+    
+    since = request.args.get('since', type=int)
+    if since is None and PAGE_PARAMS & request.args.keys():
+        body, status = loadlocks_page(request.args, seq)
+        if status != 200:
+            return jsonify(body), status
+        response = jsonify(body)
+    elif since is None:
+        loadlocks = manager.get_all_loadlocks()
+        with phase('serialize'):
+            result = [serialize_loadlock(ll) for ll in loadlocks]
+        response = jsonify(result)
+    else:
+        seq, changed, deleted, reset = manager.get_loadlock_changes(since)
+        with phase('serialize'):
+            changed = [serialize_loadlock(ll) for ll in changed]
+        response = jsonify({
+            'seq': seq,
+            'reset': reset,
+            'changed': changed,
+            'deleted': deleted
         })
+        etag = f'"ll-{seq}"'
+    
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response, 200
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Сводка для руководителей: LoadLock по статусам и время пребывания в статусах"""
+    stats = manager.get_stats()
+    statuses = {}
+    for status, info in LOADLOCK_STATUSES.items():
+        entry = stats.pop(status, None) or {
+            'count': 0, 'transitions': 0, 'total_seconds': 0, 'avg_seconds': None,
+            'histogram': [0] * (len(STATS_BUCKETS) + 1)
+        }
+        statuses[status] = {**entry, 'status_info': info}
+    # Статусы, которых уже нет в LOADLOCK_STATUSES, но которые остались в базе
+    statuses.update(stats)
+    return jsonify({
+        'total': sum(entry['count'] for entry in statuses.values()),
+        'statuses': statuses,
+        'histogram_buckets': STATS_BUCKETS
+    }), 200
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Пересчитывает сводку /api/stats из status_history"""
+    manager.rebuild_stats()
+    print('Stats rebuilt')
+
+# Открытых SSE-потоков на процесс: по умолчанию половина потоков gthread, остальное - API
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS',
+                                     max(1, int(os.environ.get('GUNICORN_THREADS', 16)) // 2)))
+
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """Поток Server-Sent Events об изменениях LoadLock"""
+    # Каждый поток держит поток-обработчик gthread: сверх лимита - 503, экран опрашивает список
+    subscriber = manager.events.subscribe(max_subscribers=SSE_MAX_STREAMS)
+    if subscriber is None:
+        return jsonify({'error': 'Too many open event streams'}), 503, {'Retry-After': '30'}
+    # Браузер сам присылает Last-Event-ID при переподключении
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    response = Response(
+        stream_with_context(manager.events.stream(last_event_id, subscriber)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Если генератор так и не запустился (клиент ушел сразу), подписку снимает close
+    response.call_on_close(lambda: manager.events.unsubscribe(subscriber))
+    return response
+
+@app.route('/api/export', defaults={'table': 'machines'}, methods=['GET'])
+@app.route('/api/export/<table>', methods=['GET'])
+def export_data(table):
+    """Выгрузка таблицы: ?format=csv|jsonl, from/to - даты (YYYY-MM-DD) включительно.
+    Ответ отдается по частям по мере чтения курсора, без загрузки таблицы в память"""
+    if table not in EXPORT_SPECS:
+        return jsonify({'error': f"Unknown table, use one of: {', '.join(EXPORT_SPECS)}"}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format, use one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        since, until = parse_date_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date: {e}'}), 400
+    
+    # machines - база hora_scanner.py, остальные таблицы - loadlock.db
+    db_path = Path(OUTPUT_DIR) / "machines.db" if table == 'machines' else manager.db_path
+    if not db_path.exists():
+        return jsonify({'error': 'Database not found'}), 404
     
-    return jsonify(result), 200
+    filename = f"{table}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    return Response(
+        export_table(db_path, table, fmt, since, until),
+        content_type=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/api/loadlock/<int:ll_id>/status', methods=['POST'])
 def update_status(ll_id):
@@ -376,79 +1200,247 @@ def update_status(ll_id):
     else:
         return jsonify({'error': 'Failed to update status'}), 400
 
+@app.route('/api/loadlocks/status', methods=['POST'])
+def bulk_update_status():
+    """Массово меняет статус: по списку ids или всем LoadLock в статусе from_status"""
+    data = request.json or {}
+    new_status = data.get('status')
+    ids = data.get('ids')
+    from_status = data.get('from_status')
+    
+    error = bulk_status_error(new_status, ids, from_status)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    results = manager.bulk_update_status(
+        new_status, loadlock_ids=ids, from_status=from_status, notes=data.get('notes', '')
+    )
+    
+    return jsonify({
+        'success': True,
+        'updated': sum(1 for r in results if r.get('changed')),
+        'results': results
+    }), 200
+
+def bulk_status_error(new_status, ids, from_status):
+    """Ошибка параметров массовой смены статуса или None"""
+    if new_status not in LOADLOCK_STATUSES:
+        return 'Unknown status'
+    if ids is None and from_status not in LOADLOCK_STATUSES:
+        return 'Specify ids or a valid from_status'
+    if ids is not None and (not isinstance(ids, list)
+                            or not all(isinstance(i, int) for i in ids)):
+        return 'ids must be a list of integers'
+    return None
+
+# URL фото не зависит от содержимого: миниатюру перестраивают, фото удаляет срок хранения.
+# Поэтому срок кэша короткий, дальше браузер проверяет ETag и получает 304 без тела
+IMAGE_MAX_AGE = int(os.environ.get('IMAGE_MAX_AGE', 300))
+
+@app.route('/api/loadlock/<int:ll_id>/image', methods=['GET'])
+def get_loadlock_image(ll_id):
+    """Фото LoadLock: ?size=thumb (по умолчанию) или ?size=full"""
+    size = request.args.get('size', 'thumb')
+    if size not in ('thumb', 'full'):
+        return jsonify({'error': 'size must be thumb or full'}), 400
+    
+    row = manager.get_loadlock_image(ll_id)
+    if not row or not row[0] or not os.path.exists(row[0]):
+        return jsonify({'error': 'Image not found'}), 404
+    
+    if size == 'full':
+        path = row[0]
+    else:
+        # Если фоновая задача еще не успела - строим миниатюру сейчас
+        path = row[1] if row[1] and os.path.exists(row[1]) else manager.build_thumbnail(ll_id)
+        if path is None:
+            return jsonify({'error': 'Thumbnail not available'}), 404
+    mimetype = MEDIA_TYPES.get(Path(path).suffix.lower(), 'application/octet-stream')
+    
+    # conditional: ETag и Last-Modified, ответ 304 на If-None-Match/If-Modified-Since
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=True,
+                         max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    return response
+
+@app.cli.command('backfill-thumbnails')
+@click.option('--force', is_flag=True, help='Перестроить и уже существующие миниатюры')
+def backfill_thumbnails_command(force):
+    """Строит миниатюры для LoadLock, загруженных до их появления"""
+    loadlock_ids = manager.get_loadlocks_without_thumbnails(force=force)
+    built = 0
+    for loadlock_id in loadlock_ids:
+        if manager.build_thumbnail(loadlock_id, force=force):
+            built += 1
+    print(f'Thumbnails built: {built} of {len(loadlock_ids)}')
+
+def queued_image_paths():
+    """Фото, которые ждут незавершенные задачи очереди (путь записан в payload)"""
+    return {str(Path(path).resolve()) for path in job_queue.pending_payload_values('image_path')}
+
+def migrate_legacy_uploads(dry_run=False):
+    """Переносит в хранилище файлы старой раскладки uploads/ и фото из output/, на которые
+    ссылаются базы. Возвращает (перенесено, дубликатов, освобождено байт, пропущено)"""
+    data_roots = [Path(UPLOAD_FOLDER).resolve(), Path(OUTPUT_DIR).resolve()]
+    candidates = {path for path in Path(UPLOAD_FOLDER).iterdir()
+                  if path.is_file() and not path.name.startswith('.')}
+    # Файлы, которые ждут задачи распознавания, остаются на месте до следующего запуска
+    queued = queued_image_paths()
+    skipped = {path for path in candidates if str(path.resolve()) in queued}
+    candidates -= skipped
+    for image_path in image_references.counts():
+        path = Path(image_path)
+        # Файлы пользователя вне папок данных не трогаем
+        if (path.is_file() and not upload_store.contains(path)
+                and any(root in path.resolve().parents for root in data_roots)):
+            if str(path.resolve()) in queued:
+                skipped.add(path)
+            else:
+                candidates.add(path)
+
+    migrated, duplicates, reclaimed = 0, 0, 0
+    targets = set()
+    for path in sorted(candidates):
+        size = path.stat().st_size
+        target = upload_store.path_for(file_sha256(path), file_extension(path))
+        if target in targets or target.exists():
+            duplicates += 1
+            reclaimed += size
+        targets.add(target)
+        migrated += 1
+        if not dry_run:
+            new_path = upload_store.put_path(path, move=True)
+            image_references.rewrite(str(path), new_path)
+    return migrated, duplicates, reclaimed, len(skipped)
+
+def format_bytes(size):
+    """Размер в читаемом виде"""
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+@app.cli.command('compact-uploads')
+@click.option('--dry-run', is_flag=True, help='Только отчет, без изменений')
+@click.option('--ready-days', type=int, default=UPLOAD_RETENTION_READY_DAYS, show_default=True,
+              help='Удалить фото LoadLock, которые дольше N дней в статусе ready (0 - не удалять)')
+@click.option('--grace-hours', type=float, default=UPLOAD_GC_GRACE_HOURS, show_default=True,
+              help='Не удалять файлы без ссылок моложе N часов')
+def compact_uploads_command(dry_run, ready_days, grace_hours):
+    """Переносит фото в хранилище по содержимому, применяет срок хранения, удаляет файлы без ссылок"""
+    migrated, duplicates, dedup_bytes, skipped = migrate_legacy_uploads(dry_run=dry_run)
+    expired = manager.expire_ready_images(ready_days, dry_run=dry_run) if ready_days > 0 else 0
+    # Объекты, которые ждут задачи очереди, не удаляются и после периода ожидания
+    referenced = set(image_references.counts()) | queued_image_paths()
+    # В dry-run ссылки не меняются, поэтому оценка удаления не учитывает срок хранения
+    removed, removed_bytes = upload_store.sweep(referenced,
+                                                min_age_seconds=grace_hours * 3600,
+                                                dry_run=dry_run)
+    objects, stored_bytes = upload_store.size()
+
+    print(f"{'[dry run] ' if dry_run else ''}Uploads compaction")
+    print(f'  migrated to store:    {migrated} ({duplicates} duplicates)')
+    print(f'  skipped (queued):     {skipped}')
+    print(f'  expired (ready):      {expired}')
+    print(f'  unreferenced removed: {removed}')
+    print(f'  space reclaimed:      {format_bytes(dedup_bytes + removed_bytes)}')
+    print(f'  store:                {objects} objects, {format_bytes(stored_bytes)}')
+
 @app.route('/api/loadlock/<int:ll_id>/history', methods=['GET'])
 def get_history(ll_id):
     """Получает историю изменений"""
     history = manager.get_loadlock_history(ll_id)
-    
-    result = []
-    for h in history:
-        result.append({
-            'old_status': h[0],
-            'new_status': h[1],
-            'timestamp': h[2],
-            'notes': h[3],
-            'old_status_info': LOADLOCK_STATUSES.get(h[0], {}),
-            'new_status_info': LOADLOCK_STATUSES.get(h[1], {})
-        })
-    
-    return jsonify(result), 200
+    return jsonify([serialize_history(h) for h in history]), 200
+
+def serialize_history(h):
+    """Преобразует строку status_history в JSON-объект"""
+    return {
+        'old_status': h[0],
+        'new_status': h[1],
+        'timestamp': h[2],
+        'notes': h[3],
+        'old_status_info': LOADLOCK_STATUSES.get(h[0], {}),
+        'new_status_info': LOADLOCK_STATUSES.get(h[1], {})
+    }
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    """Загружает и обрабатывает изображение"""
-    if 'file' not in request.files:
+    """Загружает изображение и ставит его в очередь распознавания"""
+    # Разбор формы пишет файл на диск - фаза ingest в Server-Timing
+    with phase('ingest'):
+        files = request.files
+    if 'file' not in files:
         return jsonify({'error': 'File not found'}), 400
     
-    file = request.files['file']
+    file = files['file']
     if file.filename == '':
         return jsonify({'error': 'File not selected'}), 400
     
-    if not allowed_file(file.filename):
+    # Тело уже записано на диск при разборе формы (HashingSpool); формат
+    # определяется по сигнатуре файла, а не по расширению в имени
+    spool = file.stream
+    extension = spool.extension
+    if extension is None:
         return jsonify({'error': 'Unsupported file format'}), 400
     
-    # Сохраняем файл
-    filename = secure_filename(f"hora_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
-    
-    # Обрабатываем изображение
-    response = manager.extract_hora_number(filepath)
-    
-    if not response:
-        return jsonify({'error': 'Error processing image'}), 500
+    # Повторная загрузка того же фото не занимает места: файл с этим хэшем уже есть
+    with phase('ingest'):
+        filepath = spool.store_in(upload_store, extension)
+    UPLOAD_BYTES.labels('upload').observe(spool.size)
     
-    # Парсим ответ
-    data = manager.parse_hora_response(response)
+    # Распознавание выполняется в фоне, клиент опрашивает /api/jobs/<id>
+    job_id = job_queue.enqueue('recognize', {'image_path': filepath, 'sha256': spool.sha256})
     
-    if not data:
-        return jsonify({'error': 'Error parsing response'}), 500
-    
-    if data.get('hora_number') == 'NOT_FOUND':
-        return jsonify({
-            'success': False,
-            'message': 'Could not recognize instruction number',
-            'additional_info': data.get('additional_info', '')
-        }), 200
-    
-    hora_number = data.get('hora_number', 'UNKNOWN')
-    confidence = data.get('confidence', 'unknown')
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f"/api/jobs/{job_id}"
+    }), 202
+
+@app.route('/api/upload/bulk', methods=['POST'])
+def bulk_upload():
+    """Массовый импорт: много файлов и/или ZIP-архивы в поле files; задача распознавания на файл"""
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'File not found'}), 400
     
-    # Добавляем в БД
-    added, loadlock_id = manager.add_loadlock(
-        hora_number, 
-        name=f"LoadLock {hora_number}",
-        image_path=filepath,
-        notes=f"Confidence: {confidence}"
-    )
+    importer = BulkImporter.from_env(app.config['UPLOAD_FOLDER'], upload_store)
+    try:
+        with phase('ingest'):
+            saved, rejected = importer.save_uploads(files)
+    except BulkImportError as e:
+        return jsonify({'error': str(e)}), 400
+    for entry in saved:
+        UPLOAD_BYTES.labels('bulk').observe(entry['size'])
     
+    # Распознавание - в обработчиках очереди, клиент опрашивает отчет пакета
+    batch_id = job_queue.enqueue_batch('recognize', [
+        {'image_path': entry['image_path'], 'sha256': entry['sha256'], 'file': entry['file']}
+        for entry in saved
+    ], rejected)
     return jsonify({
-        'success': True,
-        'hora_number': hora_number,
-        'confidence': confidence,
-        'loadlock_id': loadlock_id,
-        'already_exists': not added
-    }), 200
+        'batch_id': batch_id,
+        'status_url': f"/api/upload/bulk/{batch_id}",
+        'queued': len(saved),
+        'rejected': len(rejected)
+    }), 202
+
+@app.route('/api/upload/bulk/<batch_id>', methods=['GET'])
+def get_bulk_upload(batch_id):
+    """Отчет массового импорта по каждому файлу (done - все файлы обработаны)"""
+    batch = job_queue.get_batch(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch_report(batch)), 200
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Получает состояние фоновой задачи"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
 
 @app.route('/api/loadlock/<int:ll_id>/sample', methods=['POST'])
 def add_sample(ll_id):
@@ -467,18 +1459,17 @@ def add_sample(ll_id):
 def get_samples(ll_id):
     """Получает образцы"""
     samples = manager.get_loadlock_samples(ll_id)
-    
-    result = []
-    for s in samples:
-        result.append({
-            'id': s[0],
-            'sample_name': s[1],
-            'material': s[2],
-            'date_added': s[3],
-            'notes': s[4]
-        })
-    
-    return jsonify(result), 200
+    return jsonify([serialize_sample(s) for s in samples]), 200
+
+def serialize_sample(s):
+    """Преобразует строку samples в JSON-объект"""
+    return {
+        'id': s[0],
+        'sample_name': s[1],
+        'material': s[2],
+        'date_added': s[3],
+        'notes': s[4]
+    }
 
 @app.route('/api/loadlock/<int:ll_id>', methods=['DELETE'])
 def delete_loadlock(ll_id):
@@ -0,0 +1,484 @@
+"""
+ASGI-режим (Starlette): загрузки, задачи и JSON-маршруты LoadLock на цикле событий
+
+Запрос к vision API идет через неблокирующий клиент (httpx), поэтому ожидание ответа
+не занимает поток: один процесс держит сотни распознаваний одновременно. SQLite и
+обработка изображений выполняются в небольшом пуле потоков. Остальные маршруты
+(/, /api/export, фото, массовый импорт, /metrics) отдает Flask-приложение
+app.py, подключенное через WSGI. Flask-режим (gunicorn app:app) остается основным.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5001
+"""
+
+import asyncio
+import functools
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import app as loadlock
+from job_queue import JobError
+from metrics import HTTP_IN_PROGRESS, HTTP_LATENCY, JOB_LATENCY, UPLOAD_BYTES
+from upload_ingest import HashingSpool
+from vision_batcher import AsyncVisionBatcher
+from vision_client import VisionAPIError, create_async_vision_client
+
+manager = loadlock.manager
+job_queue = loadlock.job_queue
+
+MAX_CONTENT_LENGTH = loadlock.app.config['MAX_CONTENT_LENGTH']
+# Пул для SQLite и обработки изображений; ожидание API в нем не сидит, поэтому он небольшой
+blocking_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ASGI_DB_THREADS', 8)),
+                                       thread_name_prefix='asgi-db')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Выполняет блокирующий вызов в пуле, не занимая цикл событий"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
+
+async def json_response(body, status_code=200, headers=None):
+    """JSON тем же провайдером, что у Flask (одинаковые ответы); большие списки - в пуле"""
+    content = await run_blocking(loadlock.app.json.dumps, body)
+    return Response(content, status_code=status_code, headers=headers,
+                    media_type='application/json')
+
+
+async def read_json(request):
+    """Тело запроса как JSON или None, если оно не разбирается"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def timed_route(func):
+    """Метрики маршрута под тем же endpoint, что и во Flask"""
+    @functools.wraps(func)
+    async def wrapper(request):
+        started = time.perf_counter()
+        HTTP_IN_PROGRESS.inc()
+        status = 500
+        try:
+            response = await func(request)
+            status = response.status_code
+            return response
+        finally:
+            HTTP_IN_PROGRESS.dec()
+            HTTP_LATENCY.labels(func.__name__, request.method, str(status)).observe(
+                time.perf_counter() - started)
+    return wrapper
+
+
+class UploadReceiver:
+    """Разбирает multipart-тело по мере поступления и собирает данные поля file.
+
+    Данные забираются take() после каждой части тела и пишутся в HashingSpool,
+    поэтому файл не копируется во временный файл формы и в памяти не накапливается.
+    """
+
+    def __init__(self, boundary, field=b'file'):
+        self.field = field
+        # None - поле file не встретилось
+        self.filename = None
+        self.complete = False
+        self._chunks = []
+        self._in_file = False
+        self._headers = {}
+        self._header_field = b''
+        self._header_value = b''
+        self.parser = MultipartParser(boundary, callbacks={
+            'on_part_begin': self._part_begin,
+            'on_header_field': self._header_field_data,
+            'on_header_value': self._header_value_data,
+            'on_header_end': self._header_end,
+            'on_headers_finished': self._headers_finished,
+            'on_part_data': self._part_data,
+            'on_part_end': self._part_end,
+            'on_end': self._end,
+        })
+
+    def feed(self, chunk):
+        """Разбирает очередную часть тела; MultipartParseError при испорченном теле"""
+        self.parser.write(chunk)
+
+    def take(self):
+        """Данные файла, пришедшие с прошлого вызова"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+    def _part_begin(self):
+        self._headers = {}
+
+    def _header_field_data(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _header_value_data(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b''
+
+    def _headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b'content-disposition'))
+        # Берется только первое поле file с именем файла, как request.files['file']
+        self._in_file = (self.filename is None and options.get(b'name') == self.field
+                         and b'filename' in options)
+        if self._in_file:
+            self.filename = options[b'filename'].decode('utf-8', 'replace')
+
+    def _part_data(self, data, start, end):
+        if self._in_file:
+            self._chunks.append(bytes(data[start:end]))
+
+    def _part_end(self):
+        self._in_file = False
+
+    def _end(self):
+        self.complete = True
+
+
+async def receive_upload(request, directory, max_bytes):
+    """Пишет поле file из тела запроса в HashingSpool по частям.
+
+    Возвращает (spool, filename); spool - None, если файла нет. Лимит max_bytes
+    проверяется по мере чтения, в том числе без Content-Length (chunked).
+    RequestEntityTooLarge при превышении, ValueError при испорченном теле.
+    """
+    content_type, options = parse_options_header(request.headers.get('content-type'))
+    if content_type != b'multipart/form-data' or not options.get(b'boundary'):
+        return None, None
+
+    receiver = UploadReceiver(options[b'boundary'])
+    spool = None
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_bytes:
+                raise RequestEntityTooLarge()
+            receiver.feed(chunk)
+            data = receiver.take()
+            if data:
+                if spool is None:
+                    spool = await run_blocking(HashingSpool, directory, max_bytes=max_bytes)
+                await run_blocking(spool.write, data)
+        if not receiver.complete:
+            raise ValueError('Incomplete multipart body')
+    except MultipartParseError as e:
+        if spool is not None:
+            await run_blocking(spool.discard)
+        raise ValueError(str(e)) from e
+    except BaseException:
+        if spool is not None:
+            await run_blocking(spool.discard)
+        raise
+
+    if spool is None and receiver.filename:
+        # Пустой файл: spool все равно нужен, чтобы ответить как Flask (неверный формат)
+        spool = await run_blocking(HashingSpool, directory, max_bytes=max_bytes)
+    if spool is not None:
+        await run_blocking(spool.close)
+    return spool, receiver.filename
+
+
+class AsyncRecognizer:
+    """Задачи распознавания, выполняемые на цикле событий этого процесса.
+
+    Задача ставится в jobs.db как обычно (queued) и забирается, только когда есть
+    свободное место из max_concurrent; пока она выполняется, процесс обновляет ее
+    heartbeat. Задачу, которую раньше забрал другой обработчик, процесс не трогает.
+    """
+
+    def __init__(self, vision, max_concurrent=200):
+        self.vision = vision
+        self.batcher = AsyncVisionBatcher.from_env(vision, manager.model)
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.worker_name = f"{socket.gethostname()}:{os.getpid()}:asgi"
+        self.tasks = set()
+
+    async def submit(self, image_path, sha256):
+        """Ставит задачу в очередь и запускает ее ожидание в фоне; возвращает id задачи"""
+        payload = {'image_path': image_path, 'sha256': sha256}
+        # Не будим обработчики JobWorkerPool этого процесса: задачу заберет цикл событий
+        job_id = await run_blocking(job_queue.enqueue, 'recognize', payload, wake=False)
+        task = asyncio.create_task(self._run(job_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job_id
+
+    async def _run(self, job_id):
+        async with self.semaphore:
+            job = await run_blocking(job_queue.claim_job, job_id, self.worker_name)
+            if job is None:
+                return
+            payload = job['payload']
+            started = time.perf_counter()
+            outcome = 'failed'
+            try:
+                with job_queue.running(job_id):
+                    result = await self.recognize_upload(job_id, payload['image_path'],
+                                                         payload.get('sha256'))
+                    result = await run_blocking(loadlock.recognition_job_result, result)
+            except JobError as e:
+                await run_blocking(job_queue.fail, job_id, e)
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                await run_blocking(job_queue.fail, job_id, e)
+            else:
+                outcome = 'done'
+                await run_blocking(job_queue.complete, job_id, result)
+            finally:
+                JOB_LATENCY.labels('recognize', outcome).observe(time.perf_counter() - started)
+
+    async def recognize_upload(self, job_id, image_path, content_hash):
+        """То же, что LoadLockManager.recognize_upload, но запрос к API не блокирует поток"""
+        async def report(stage):
+            await run_blocking(job_queue.set_progress, job_id, stage)
+
+        await report('local_ocr')
+        reader = manager.label_reader
+        data = await run_blocking(reader.read_confident, image_path) if reader else None
+
+        if data is None:
+            await report('recognizing')
+            response = await self.extract_hora_number(image_path, content_hash)
+            if not response:
+                return {'error': 'Error processing image'}
+
+            await report('parsing')
+            data = manager.parse_hora_response(response)
+            if not data:
+                return {'error': 'Error parsing response'}
+
+        data.setdefault('source', 'remote')
+        return await run_blocking(manager.save_recognition, image_path, data,
+                                  functools.partial(job_queue.set_progress, job_id))
+
+    async def extract_hora_number(self, image_path, content_hash=None):
+        """Ответ модели (или кэша) строкой JSON; None при ошибке"""
+        if not os.path.exists(image_path):
+            return None
+        cache_key, cached = await run_blocking(manager.cached_recognition, image_path,
+                                               content_hash=content_hash)
+        if cached is not None:
+            return cached
+
+        image_source, stats = await run_blocking(manager.preprocessor.prepare_source, image_path)
+        try:
+            # Одновременные распознавания уходят пакетами, как в LoadLockManager
+            answer = await self.batcher.complete(image_source, loadlock.HORA_PROMPT)
+        except VisionAPIError as e:
+            print(f"API Error: {e}")
+            return None
+        if answer is None:
+            return None
+        await run_blocking(manager.remember_recognition, cache_key, answer)
+        return answer
+
+    async def drain(self, timeout):
+        """Ждет распознавания при остановке; незабранные задачи остаются в очереди (queued)"""
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+
+@timed_route
+async def get_loadlocks(request):
+    """Получает LoadLock: весь список, изменения после ?since=<seq> или страницу с фильтрами"""
+    seq = await run_blocking(manager.get_change_seq)
+    etag = f'"ll-{seq}"'
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    args = request.query_params
+    since = loadlock.parse_int(args.get('since'))
+    if since is None and loadlock.PAGE_PARAMS & set(args.keys()):
+        body, status = await run_blocking(loadlock.loadlocks_page, args, seq)
+        if status != 200:
+            return await json_response(body, status)
+    elif since is None:
+        loadlocks = await run_blocking(manager.get_all_loadlocks)
+        body = [loadlock.serialize_loadlock(ll) for ll in loadlocks]
+    else:
+        seq, changed, deleted, reset = await run_blocking(manager.get_loadlock_changes, since)
+        body = {
+            'seq': seq,
+            'reset': reset,
+            'changed': [loadlock.serialize_loadlock(ll) for ll in changed],
+            'deleted': deleted
+        }
+        etag = f'"ll-{seq}"'
+    return await json_response(body, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+
+@timed_route
+async def upload_file(request):
+    """Загружает изображение и запускает распознавание на цикле событий"""
+    length = loadlock.parse_int(request.headers.get('content-length'))
+    if length is not None and length > MAX_CONTENT_LENGTH:
+        return await json_response({'error': 'File too large'}, 413)
+
+    try:
+        spool, filename = await receive_upload(request, loadlock.UPLOAD_FOLDER, MAX_CONTENT_LENGTH)
+    except RequestEntityTooLarge:
+        return await json_response({'error': 'File too large'}, 413)
+    except ValueError:
+        return await json_response({'error': 'Malformed upload'}, 400)
+    if filename is None:
+        return await json_response({'error': 'File not found'}, 400)
+    if not filename:
+        if spool is not None:
+            await run_blocking(spool.discard)
+        return await json_response({'error': 'File not selected'}, 400)
+
+    # Формат по сигнатуре файла, повторная загрузка того же фото не занимает места
+    extension = spool.extension
+    if extension is None:
+        await run_blocking(spool.discard)
+        return await json_response({'error': 'Unsupported file format'}, 400)
+    filepath = await run_blocking(spool.store_in, loadlock.upload_store, extension)
+    UPLOAD_BYTES.labels('upload').observe(spool.size)
+
+    job_id = await request.app.state.recognizer.submit(filepath, spool.sha256)
+    return await json_response({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f"/api/jobs/{job_id}"
+    }, 202)
+
+
+@timed_route
+async def stream_events(request):
+    """Поток Server-Sent Events: соединение ждет на цикле событий, без потока и лимита"""
+    last_event_id = loadlock.parse_int(request.headers.get('last-event-id'))
+    return StreamingResponse(
+        manager.events.astream(last_event_id),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@timed_route
+async def get_job(request):
+    """Получает состояние фоновой задачи"""
+    job = await run_blocking(job_queue.get, request.path_params['job_id'])
+    if job is None:
+        return await json_response({'error': 'Job not found'}, 404)
+    return await json_response(job)
+
+
+@timed_route
+async def update_status(request):
+    """Обновляет статус LoadLock"""
+    data = await read_json(request)
+    if not isinstance(data, dict):
+        return await json_response({'error': 'Failed to update status'}, 400)
+    updated = await run_blocking(manager.update_status, request.path_params['ll_id'],
+                                 data.get('status'), data.get('notes', ''))
+    if updated:
+        return await json_response({'success': True})
+    return await json_response({'error': 'Failed to update status'}, 400)
+
+
+@timed_route
+async def bulk_update_status(request):
+    """Массово меняет статус: по списку ids или всем LoadLock в статусе from_status"""
+    data = await read_json(request) or {}
+    new_status, ids, from_status = data.get('status'), data.get('ids'), data.get('from_status')
+    error = loadlock.bulk_status_error(new_status, ids, from_status)
+    if error:
+        return await json_response({'error': error}, 400)
+
+    results = await run_blocking(manager.bulk_update_status, new_status, loadlock_ids=ids,
+                                 from_status=from_status, notes=data.get('notes', ''))
+    return await json_response({
+        'success': True,
+        'updated': sum(1 for r in results if r.get('changed')),
+        'results': results
+    })
+
+
+@timed_route
+async def get_history(request):
+    """Получает историю изменений"""
+    history = await run_blocking(manager.get_loadlock_history, request.path_params['ll_id'])
+    return await json_response([loadlock.serialize_history(h) for h in history])
+
+
+@timed_route
+async def add_sample(request):
+    """Добавляет образец"""
+    data = await read_json(request)
+    if not isinstance(data, dict):
+        return await json_response({'error': 'Failed to add sample'}, 400)
+    added = await run_blocking(manager.add_sample, request.path_params['ll_id'],
+                               data.get('sample_name'), data.get('material', ''),
+                               data.get('notes', ''))
+    if added:
+        return await json_response({'success': True})
+    return await json_response({'error': 'Failed to add sample'}, 400)
+
+
+@timed_route
+async def get_samples(request):
+    """Получает образцы"""
+    samples = await run_blocking(manager.get_loadlock_samples, request.path_params['ll_id'])
+    return await json_response([loadlock.serialize_sample(s) for s in samples])
+
+
+@timed_route
+async def delete_loadlock(request):
+    """Удаляет LoadLock"""
+    try:
+        await run_blocking(manager.delete_loadlock, request.path_params['ll_id'])
+        return await json_response({'success': True})
+    except Exception as e:
+        return await json_response({'error': str(e)}, 500)
+
+
+@asynccontextmanager
+async def lifespan(application):
+    """Асинхронный клиент API живет в цикле событий сервера"""
+    vision = create_async_vision_client(manager.api_key, manager.base_url)
+    recognizer = AsyncRecognizer(vision, int(os.environ.get('ASGI_MAX_RECOGNITIONS', 200)))
+    application.state.recognizer = recognizer
+    try:
+        yield
+    finally:
+        await recognizer.drain(float(os.environ.get('ASGI_SHUTDOWN_TIMEOUT', 30)))
+        await vision.aclose()
+
+
+routes = [
+    Route('/api/loadlocks', get_loadlocks, methods=['GET']),
+    Route('/api/loadlocks/status', bulk_update_status, methods=['POST']),
+    Route('/api/upload', upload_file, methods=['POST']),
+    Route('/api/events', stream_events, methods=['GET']),
+    Route('/api/jobs/{job_id}', get_job, methods=['GET']),
+    Route('/api/loadlock/{ll_id:int}/status', update_status, methods=['POST']),
+    Route('/api/loadlock/{ll_id:int}/history', get_history, methods=['GET']),
+    Route('/api/loadlock/{ll_id:int}/sample', add_sample, methods=['POST']),
+    Route('/api/loadlock/{ll_id:int}/samples', get_samples, methods=['GET']),
+    Route('/api/loadlock/{ll_id:int}', delete_loadlock, methods=['DELETE']),
+    # Все остальное - Flask-приложение в пуле потоков
+    Mount('/', WSGIMiddleware(loadlock.app, workers=int(os.environ.get('ASGI_WSGI_THREADS', 16)))),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5001)))
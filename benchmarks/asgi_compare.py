@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Сравнение Flask (gunicorn app:app) и ASGI-режима (uvicorn asgi_app:app) под загрузками
+
+Оба сервера по очереди получают одинаковую нагрузку load_test.py против заглушки API с
+долгим ответом; печатается таблица: распознаваний в минуту, p50/p95 от загрузки до
+результата и задержки запросов дашборда. Результаты - в benchmarks/results/*_asgi_compare.json.
+
+Пример:
+    python3 benchmarks/asgi_compare.py --wsgi 1x16 --asgi 1 --users 200 --latency-ms 3000
+"""
+
+import argparse
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+from load_test import RESULTS_DIR, git_commit, parse_configs, parse_mix, run_config
+from mock_vision_api import add_profile_arguments
+
+ROWS = [
+    ('uploads/min', lambda run: run['uploads_per_minute']),
+    ('recognition p50, ms', lambda run: run['endpoints'].get('recognition_e2e', {}).get('p50_ms')),
+    ('recognition p95, ms', lambda run: run['endpoints'].get('recognition_e2e', {}).get('p95_ms')),
+    ('upload p95, ms', lambda run: run['endpoints'].get('upload', {}).get('p95_ms')),
+    ('poll p95, ms', lambda run: run['endpoints'].get('loadlocks_delta', {}).get('p95_ms')),
+    ('requests/s', lambda run: run['total_rps']),
+    ('API requests', lambda run: run['mock_api']['requests']),
+]
+
+
+def print_comparison(runs):
+    """Таблица: строки - показатели, столбцы - конфигурации"""
+    labels = [run['config']['label'] for run in runs]
+    print(f"\n{'':<22}" + ''.join(f"{label:>14}" for label in labels))
+    for name, value in ROWS:
+        cells = ''.join(f"{'-' if value(run) is None else value(run):>14}" for run in runs)
+        print(f"{name:<22}{cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flask (gunicorn) против ASGI (uvicorn)')
+    parser.add_argument('--wsgi', default='1x16', help='gunicorn workers x threads')
+    parser.add_argument('--asgi', type=int, default=1, help='процессов uvicorn')
+    parser.add_argument('--users', type=int, default=100, help='виртуальных пользователей')
+    parser.add_argument('--duration', type=float, default=60, help='длительность замера, сек')
+    parser.add_argument('--warmup', type=float, default=5, help='прогрев без учета, сек')
+    parser.add_argument('--think-ms', type=float, default=500, help='пауза между действиями, мс')
+    parser.add_argument('--mix', default='upload=50,poll=50', help='веса операций load_test.py')
+    parser.add_argument('--seed', type=int, default=8, help='LoadLock для наполнения базы')
+    parser.add_argument('--upload-workers', type=int, default=2,
+                        help='UPLOAD_WORKERS: потоки распознавания Flask-процесса')
+    parser.add_argument('--vision-rpm', type=float, default=60000, help='VISION_API_RPM приложения')
+    parser.add_argument('--vision-burst', type=int, default=1000, help='VISION_API_BURST приложения')
+    parser.add_argument('--job-timeout', type=float, default=300, help='ожидание задачи, сек')
+    parser.add_argument('--results-dir', default=str(RESULTS_DIR))
+    add_profile_arguments(parser)
+    parser.set_defaults(latency_ms=3000, jitter_ms=500)
+    args = parser.parse_args()
+
+    # Пакеты запросов есть только у Flask-режима - сравниваем одиночные запросы
+    os.environ['VISION_BATCH_SIZE'] = '1'
+    args.external_worker = 0
+    args.keep_data = False
+    mix = parse_mix(args.mix)
+
+    runs = []
+    (workers, threads), = parse_configs(args.wsgi)
+    args.server = 'gunicorn'
+    runs.append(run_config(args, workers, threads, mix))
+    args.server = 'asgi'
+    runs.append(run_config(args, args.asgi, 1, mix))
+    print_comparison(runs)
+
+    results_dir = Path(args.results_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    path = results_dir / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_asgi_compare.json"
+    path.write_text(json.dumps({
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'settings': {key: value for key, value in vars(args).items() if key != 'server'},
+        'runs': runs
+    }, indent=2, ensure_ascii=False))
+    print(f"\n✓ Results: {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Замер пиковой памяти на одну загрузку: прием /api/upload и подготовка запроса к vision API
+
+Сравнивает старый путь (чтение файла целиком, base64-строка, JSON с полной копией) с
+потоковым (HashingSpool, уменьшенное декодирование, StreamingJSONBody). С --ceiling-mb
+завершается с кодом 1, если потоковый путь превысил потолок.
+
+    python3 benchmarks/ingest_memory.py --size-mb 16 --ceiling-mb 48
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from image_preprocess import ImagePreprocessor  # noqa: E402
+from vision_client import StreamingJSONBody  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def make_jpeg(path, size_mb):
+    """JPEG примерно нужного размера (шум плохо сжимается)"""
+    side = int((size_mb * MB / 1.8) ** 0.5)
+    image = np.random.randint(0, 256, (side, int(side * 1.5), 3), dtype=np.uint8)
+    cv2.imwrite(str(path), image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return os.path.getsize(path)
+
+
+def measure(func):
+    """Пик памяти Python и numpy (tracemalloc) при вызове func"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def legacy_request(image_path):
+    """Как было: файл целиком в память, base64-строка, payload в json"""
+    with open(image_path, 'rb') as image_file:
+        data = image_file.read()
+    uri = f"data:image/jpeg;base64,{base64.standard_b64encode(data).decode('utf-8')}"
+    payload = {"messages": [{"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": uri}}]}]}
+    json.dumps(payload).encode('utf-8')
+
+
+def streaming_request(image_path, preprocessor):
+    """Сейчас: уменьшенное декодирование и потоковое тело запроса"""
+    source, _ = preprocessor.prepare_source(image_path)
+    body = StreamingJSONBody({"messages": [{"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": source}}]}]})
+    while body.read(8192):
+        pass
+
+
+def upload(client, data):
+    client.post('/api/upload', data={'file': (io.BytesIO(data), 'label.jpg')},
+                content_type='multipart/form-data')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пиковая память на одну загрузку')
+    parser.add_argument('--size-mb', type=float, default=15)
+    parser.add_argument('--ceiling-mb', type=float, default=None,
+                        help='потолок для потокового пути; при превышении код возврата 1')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='loadlock-ingest-')
+    os.environ.setdefault('OPENAI_API_KEY', 'bench-key')
+    os.environ['LOADLOCK_DATA_DIR'] = work_dir
+    os.environ['UPLOAD_WORKERS'] = '0'
+    import app  # noqa: E402 - после настройки окружения
+
+    image_path = Path(work_dir) / 'big.jpg'
+    size = make_jpeg(image_path, args.size_mb)
+    preprocessor = ImagePreprocessor.from_env()
+    print(f"Image: {size / MB:.1f} MB")
+
+    results = {
+        'legacy_request': measure(lambda: legacy_request(image_path)),
+        'streaming_request': measure(lambda: streaming_request(image_path, preprocessor)),
+    }
+
+    # Тело запроса к Flask целиком в памяти теста, поэтому его не считаем
+    data = image_path.read_bytes()
+    client = app.app.test_client()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    upload(client, data)
+    results['upload_ingest'] = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    for name, peak in results.items():
+        print(f"  {name:<20} peak {peak / MB:8.1f} MB")
+
+    streaming_peak = max(results['streaming_request'], results['upload_ingest'])
+    if args.ceiling_mb is not None and streaming_peak > args.ceiling_mb * MB:
+        print(f"❌ Peak {streaming_peak / MB:.1f} MB exceeds ceiling {args.ceiling_mb} MB")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
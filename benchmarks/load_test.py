@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест app:app против локальной заглушки vision API
+
+Запускает приложение (gunicorn с разными workers x threads) на временной папке данных,
+гоняет смесь запросов дашборда и загрузок и сохраняет пропускную способность и
+p50/p95/p99 по каждому эндпоинту в benchmarks/results/*.json.
+
+Примеры:
+    python3 benchmarks/load_test.py --configs 1x4,2x8,4x16 --users 30 --duration 60
+    python3 benchmarks/load_test.py --server asgi --configs 1 --users 200
+    python3 benchmarks/load_test.py --latency-ms 2000 --rate-limit-rate 0.05
+    python3 benchmarks/load_test.py --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+import requests
+
+from mock_vision_api import MockVisionServer, add_profile_arguments, profile_from_args
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+STATUSES = ['inserted', 'working', 'missing', 'qc', 'packaging', 'ready']
+DEFAULT_MIX = 'poll=60,history=15,status=15,upload=10'
+
+
+def parse_mix(text):
+    """Разбирает смесь операций: 'poll=60,upload=10' -> {'poll': 60, 'upload': 10}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise ValueError(f"Unknown operations: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def parse_configs(text):
+    """Разбирает конфигурации gunicorn: '1x4,2x8' -> [(1, 4), (2, 8)]"""
+    configs = []
+    for part in text.split(','):
+        workers, _, threads = part.lower().partition('x')
+        configs.append((int(workers), int(threads or 1)))
+    return configs
+
+
+def percentile(values, p):
+    """Перцентиль по методу ближайшего ранга (values отсортированы)"""
+    if not values:
+        return None
+    rank = max(1, int(round(p / 100 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+
+def free_port():
+    """Свободный TCP-порт на localhost"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_label_image():
+    """Уникальное JPEG-фото «этикетки» (не попадает в кэш распознавания)"""
+    image = np.full((480, 640, 3), 235, dtype=np.uint8)
+    cv2.rectangle(image, (60, 140), (580, 340), (40, 40, 40), 3)
+    number = str(random.randint(100000, 999999))
+    cv2.putText(image, number, (110, 270), cv2.FONT_HERSHEY_SIMPLEX, 3, (20, 20, 20), 8)
+    cv2.putText(image, uuid.uuid4().hex[:12], (70, 460), cv2.FONT_HERSHEY_PLAIN, 1.5, (90, 90, 90), 2)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return encoded.tobytes()
+
+
+class Recorder:
+    """Собирает замеры: (операция, время начала, длительность, успех)"""
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, name, started, elapsed, ok):
+        with self._lock:
+            self.samples.append((name, started, elapsed, ok))
+
+    def timed(self, session, name, method, url, **kwargs):
+        """Выполняет HTTP-запрос и записывает замер"""
+        started = time.time()
+        try:
+            response = session.request(method, url, timeout=120, **kwargs)
+        except requests.exceptions.RequestException:
+            self.add(name, started, time.time() - started, False)
+            return None
+        self.add(name, started, time.time() - started, response.status_code < 400)
+        return response
+
+    def summary(self, since, until):
+        """Пропускная способность и задержки по каждой операции за окно [since, until]"""
+        window = max(until - since, 1e-9)
+        grouped = {}
+        for name, started, elapsed, ok in self.samples:
+            if since <= started <= until:
+                grouped.setdefault(name, []).append((elapsed, ok))
+
+        endpoints = {}
+        for name, items in sorted(grouped.items()):
+            latencies = sorted(elapsed * 1000 for elapsed, _ in items)
+            errors = sum(1 for _, ok in items if not ok)
+            endpoints[name] = {
+                'count': len(items),
+                'errors': errors,
+                'error_rate': round(errors / len(items), 4),
+                'throughput_rps': round(len(items) / window, 2),
+                'mean_ms': round(sum(latencies) / len(latencies), 1),
+                'p50_ms': round(percentile(latencies, 50), 1),
+                'p95_ms': round(percentile(latencies, 95), 1),
+                'p99_ms': round(percentile(latencies, 99), 1),
+                'max_ms': round(latencies[-1], 1)
+            }
+        return endpoints
+
+
+class VirtualUser:
+    """Один экран/оператор: опрашивает список, меняет статусы, загружает фото"""
+
+    def __init__(self, base_url, recorder, shared_ids, mix, think_ms, job_timeout):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.shared_ids = shared_ids
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.think_ms = think_ms
+        self.job_timeout = job_timeout
+        self.session = requests.Session()
+        self.etag = None
+        self.seq = None
+
+    def run(self, deadline):
+        while time.time() < deadline:
+            operation = random.choices(self.operations, self.weights)[0]
+            OPERATIONS[operation](self)
+            if self.think_ms:
+                time.sleep(random.uniform(0.5, 1.5) * self.think_ms / 1000)
+
+    def _random_id(self):
+        return random.choice(self.shared_ids) if self.shared_ids else None
+
+    def poll(self):
+        """Опрос списка как на дашборде: первый раз полностью, дальше дельтой с ETag"""
+        if self.seq is None:
+            response = self.recorder.timed(self.session, 'loadlocks_full', 'GET',
+                                           f"{self.base_url}/api/loadlocks")
+        else:
+            response = self.recorder.timed(
+                self.session, 'loadlocks_delta', 'GET',
+                f"{self.base_url}/api/loadlocks", params={'since': self.seq},
+                headers={'If-None-Match': self.etag} if self.etag else {}
+            )
+        if response is not None and response.status_code in (200, 304):
+            self.etag = response.headers.get('ETag', self.etag)
+            if self.etag:
+                self.seq = int(self.etag.strip('"').split('-')[-1])
+
+    def history(self):
+        loadlock_id = self._random_id()
+        if loadlock_id is not None:
+            self.recorder.timed(self.session, 'history', 'GET',
+                                f"{self.base_url}/api/loadlock/{loadlock_id}/history")
+
+    def status(self):
+        loadlock_id = self._random_id()
+        if loadlock_id is not None:
+            self.recorder.timed(self.session, 'status_update', 'POST',
+                                f"{self.base_url}/api/loadlock/{loadlock_id}/status",
+                                json={'status': random.choice(STATUSES), 'notes': 'load test'})
+
+    def upload(self):
+        """Загрузка фото и ожидание фоновой задачи, как в интерфейсе"""
+        started = time.time()
+        response = self.recorder.timed(
+            self.session, 'upload', 'POST', f"{self.base_url}/api/upload",
+            files={'file': (f"bench_{uuid.uuid4().hex[:8]}.jpg", make_label_image(), 'image/jpeg')}
+        )
+        if response is None or response.status_code != 202:
+            return
+        job_url = f"{self.base_url}{response.json()['status_url']}"
+
+        while time.time() - started < self.job_timeout:
+            time.sleep(0.5)
+            job_response = self.recorder.timed(self.session, 'job_status', 'GET', job_url)
+            if job_response is None or job_response.status_code != 200:
+                continue
+            job = job_response.json()
+            if job['status'] == 'done':
+                result = job.get('result') or {}
+                if result.get('loadlock_id'):
+                    self.shared_ids.append(result['loadlock_id'])
+                self.recorder.add('recognition_e2e', started, time.time() - started, True)
+                return
+            if job['status'] == 'failed':
+                self.recorder.add('recognition_e2e', started, time.time() - started, False)
+                return
+        self.recorder.add('recognition_e2e', started, time.time() - started, False)
+
+
+OPERATIONS = {
+    'poll': VirtualUser.poll,
+    'history': VirtualUser.history,
+    'status': VirtualUser.status,
+    'upload': VirtualUser.upload,
+}
+
+
+class AppUnderTest:
+    """Приложение на временной папке данных (и при необходимости отдельный worker.py)"""
+
+    def __init__(self, args, workers, threads, vision_base_url):
+        self.args = args
+        self.workers = workers
+        self.threads = threads
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.data_dir = tempfile.mkdtemp(prefix='loadlock-bench-')
+        self.env = {
+            **os.environ,
+            'LOADLOCK_DATA_DIR': self.data_dir,
+            'OPENAI_API_KEY': 'bench-key',
+            'VISION_API_BASE_URL': vision_base_url,
+            'VISION_API_RPM': str(args.vision_rpm),
+            'VISION_API_BURST': str(args.vision_burst),
+            'LOCAL_OCR_ENABLED': '0',
+            'UPLOAD_WORKERS': '0' if args.external_worker else str(args.upload_workers),
+            'PORT': str(self.port),
+            'PYTHONUNBUFFERED': '1',
+            # Общие метрики сервера и worker.py, как в развертывании
+            'PROMETHEUS_MULTIPROC_DIR': os.path.join(self.data_dir, 'metrics'),
+        }
+        self.processes = []
+
+    def start(self):
+        os.makedirs(self.env['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+        log = open(Path(self.data_dir) / 'server.log', 'wb')
+        if self.args.server == 'gunicorn':
+            command = [sys.executable, '-m', 'gunicorn', 'app:app',
+                       '-b', f"127.0.0.1:{self.port}",
+                       '-w', str(self.workers), '--threads', str(self.threads)]
+        elif self.args.server == 'asgi':
+            # threads в ASGI-режиме не нужны: распознавания ждут API на цикле событий
+            command = [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--host', '127.0.0.1',
+                       '--port', str(self.port), '--workers', str(self.workers),
+                       '--log-level', 'warning']
+        else:
+            command = [sys.executable, 'app.py']
+        self.processes.append(subprocess.Popen(command, cwd=REPO_DIR, env=self.env,
+                                               stdout=log, stderr=subprocess.STDOUT))
+        if self.args.external_worker:
+            worker_env = {**self.env, 'WORKER_THREADS': str(self.args.external_worker)}
+            self.processes.append(subprocess.Popen([sys.executable, 'worker.py'], cwd=REPO_DIR,
+                                                   env=worker_env, stdout=log,
+                                                   stderr=subprocess.STDOUT))
+        self._wait_ready()
+
+    def _wait_ready(self, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.processes[0].poll() is not None:
+                raise RuntimeError(f"Server exited, see {self.data_dir}/server.log")
+            try:
+                if requests.get(f"{self.base_url}/api/loadlocks", timeout=2).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.3)
+        raise RuntimeError('Server did not start in time')
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not self.args.keep_data:
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def seed(app_url, count, recorder, job_timeout):
+    """Наполняет базу через обычные загрузки и возвращает id LoadLock"""
+    ids = []
+    per_thread = (count + 3) // 4
+
+    def upload_many():
+        user = VirtualUser(app_url, recorder, ids, {'upload': 1}, 0, job_timeout)
+        for _ in range(per_thread):
+            user.upload()
+
+    threads = [threading.Thread(target=upload_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return ids
+
+
+def run_config(args, workers, threads, mix):
+    """Один прогон: заглушка API + приложение + виртуальные пользователи"""
+    mock = MockVisionServer(profile_from_args(args)).start()
+    app = AppUnderTest(args, workers, threads, mock.base_url)
+    label = {'dev': 'dev', 'asgi': f"asgi-{workers}"}.get(args.server, f"{workers}x{threads}")
+    print(f"\n▶ {label}: {args.users} users, {args.duration}s (+{args.warmup}s warmup)")
+    try:
+        app.start()
+        shared_ids = seed(app.base_url, args.seed, Recorder(), args.job_timeout)
+        print(f"  seeded {len(shared_ids)} loadlocks")
+
+        recorder = Recorder()
+        started = time.time()
+        measure_from = started + args.warmup
+        deadline = measure_from + args.duration
+        users = [VirtualUser(app.base_url, recorder, shared_ids, mix, args.think_ms, args.job_timeout)
+                 for _ in range(args.users)]
+        threads_list = [threading.Thread(target=user.run, args=(deadline,), daemon=True)
+                        for user in users]
+        for thread in threads_list:
+            thread.start()
+        for thread in threads_list:
+            thread.join(deadline - time.time() + args.job_timeout + 5)
+
+        endpoints = recorder.summary(measure_from, deadline)
+    finally:
+        app.stop()
+        mock.stop()
+
+    recognitions = endpoints.get('recognition_e2e', {})
+    http_endpoints = {name: stats for name, stats in endpoints.items() if name != 'recognition_e2e'}
+    result = {
+        'config': {'server': args.server, 'workers': workers, 'threads': threads,
+                   'label': label},
+        'endpoints': endpoints,
+        'total_rps': round(sum(stats['throughput_rps'] for stats in http_endpoints.values()), 2),
+        'uploads_per_minute': round(recognitions.get('throughput_rps', 0) * 60, 1),
+        'mock_api': mock.profile.stats
+    }
+    print_run(result)
+    return result
+
+
+def print_run(result):
+    """Печатает таблицу одного прогона"""
+    print(f"  {'endpoint':<18}{'count':>8}{'err%':>7}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in result['endpoints'].items():
+        print(f"  {name:<18}{stats['count']:>8}{stats['error_rate'] * 100:>7.1f}"
+              f"{stats['throughput_rps']:>9.1f}{stats['p50_ms']:>9.0f}"
+              f"{stats['p95_ms']:>9.0f}{stats['p99_ms']:>9.0f}")
+    print(f"  total: {result['total_rps']} req/s, {result['uploads_per_minute']} uploads/min, "
+          f"mock API: {result['mock_api']}")
+
+
+def git_commit():
+    """Текущий коммит, чтобы результаты можно было сопоставить с кодом"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, current_path, threshold):
+    """Сравнивает два файла результатов; код возврата 1 при регрессии p95 или rps"""
+    baseline = json.loads(Path(baseline_path).read_text())
+    current = json.loads(Path(current_path).read_text())
+    base_runs = {run['config']['label']: run for run in baseline['runs']}
+    regressions = 0
+
+    for run in current['runs']:
+        label = run['config']['label']
+        base = base_runs.get(label)
+        if base is None:
+            print(f"\n{label}: no baseline run")
+            continue
+        print(f"\n{label}: {base['total_rps']} -> {run['total_rps']} req/s")
+        for name, stats in run['endpoints'].items():
+            old = base['endpoints'].get(name)
+            if not old:
+                continue
+            change = (stats['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0
+            rps_change = ((stats['throughput_rps'] - old['throughput_rps']) / old['throughput_rps']
+                          if old['throughput_rps'] else 0)
+            flag = ''
+            if change > threshold or rps_change < -threshold:
+                flag = '  ❌ regression'
+                regressions += 1
+            print(f"  {name:<18} p95 {old['p95_ms']:>8.0f} -> {stats['p95_ms']:>8.0f} ms "
+                  f"({change:+.0%}), rps {old['throughput_rps']:.1f} -> "
+                  f"{stats['throughput_rps']:.1f}{flag}")
+
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест LoadLock Manager')
+    parser.add_argument('--configs', default='1x4,2x8',
+                        help='конфигурации gunicorn workers x threads через запятую')
+    parser.add_argument('--server', choices=['gunicorn', 'asgi', 'dev'], default='gunicorn',
+                        help='dev - встроенный сервер Flask (без gunicorn), asgi - uvicorn asgi_app:app')
+    parser.add_argument('--users', type=int, default=20, help='виртуальных пользователей')
+    parser.add_argument('--duration', type=float, default=60, help='длительность замера, сек')
+    parser.add_argument('--warmup', type=float, default=5, help='прогрев без учета, сек')
+    parser.add_argument('--think-ms', type=float, default=200, help='пауза между действиями, мс')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='веса операций poll/history/status/upload')
+    parser.add_argument('--seed', type=int, default=20, help='LoadLock для наполнения базы')
+    parser.add_argument('--upload-workers', type=int, default=2,
+                        help='UPLOAD_WORKERS в каждом процессе приложения')
+    parser.add_argument('--external-worker', type=int, default=0,
+                        help='запустить worker.py с этим числом потоков (UPLOAD_WORKERS=0)')
+    parser.add_argument('--vision-rpm', type=float, default=6000, help='VISION_API_RPM приложения')
+    parser.add_argument('--vision-burst', type=int, default=50, help='VISION_API_BURST приложения')
+    parser.add_argument('--job-timeout', type=float, default=120, help='ожидание задачи, сек')
+    parser.add_argument('--label', default='', help='метка в имени файла результатов')
+    parser.add_argument('--results-dir', default=str(RESULTS_DIR))
+    parser.add_argument('--keep-data', action='store_true', help='не удалять папку данных')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='сравнить два файла результатов вместо запуска')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='допустимое ухудшение p95/rps при сравнении (0.2 = 20%%)')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(*args.compare, args.threshold))
+
+    mix = parse_mix(args.mix)
+    configs = [(1, 1)] if args.server == 'dev' else parse_configs(args.configs)
+
+    runs = [run_config(args, workers, threads, mix) for workers, threads in configs]
+
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'label': args.label,
+        'settings': {
+            'users': args.users, 'duration': args.duration, 'warmup': args.warmup,
+            'think_ms': args.think_ms, 'mix': mix, 'seed': args.seed,
+            'upload_workers': args.upload_workers, 'external_worker': args.external_worker,
+            'vision_rpm': args.vision_rpm,
+            'mock_api': {
+                'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms,
+                'error_rate': args.error_rate, 'rate_limit_rate': args.rate_limit_rate,
+                'not_found_rate': args.not_found_rate
+            }
+        },
+        'runs': runs
+    }
+
+    results_dir = Path(args.results_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    suffix = f"_{args.label}" if args.label else ''
+    path = results_dir / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}{suffix}.json"
+    path.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    print(f"\n✓ Results: {path}")
+
+
+if __name__ == '__main__':
+    main()
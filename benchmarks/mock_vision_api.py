@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка vision API (/v1/chat/completions) с настраиваемой задержкой и ошибками
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockProfile:
+    """Профиль ответов: задержка, доля ошибок 5xx и 429"""
+
+    def __init__(self, latency_ms=800, jitter_ms=200, error_rate=0.0,
+                 rate_limit_rate=0.0, retry_after=1, not_found_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.not_found_rate = not_found_rate
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0}
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        """Увеличивает счетчик статистики"""
+        with self._lock:
+            self.stats[key] += 1
+
+    def delay(self):
+        """Задержка ответа в секундах"""
+        return max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+
+    def result(self):
+        """Результат для одного фото"""
+        if random.random() < self.not_found_rate:
+            return {'hora_number': 'NOT_FOUND', 'confidence': 'low', 'additional_info': 'mock'}
+        return {
+            'hora_number': str(random.randint(100000, 999999)),
+            'confidence': 'high',
+            'location': 'mock',
+            'additional_info': ''
+        }
+
+    def answer(self, images=1):
+        """Текст ответа модели: объект для parse_hora_response, для пакета - массив с index"""
+        if images <= 1:
+            return json.dumps(self.result())
+        return json.dumps([{**self.result(), 'index': index} for index in range(1, images + 1)])
+
+
+def count_images(body):
+    """Число изображений в запросе chat/completions"""
+    try:
+        messages = json.loads(body).get('messages', [])
+    except (ValueError, AttributeError):
+        return 1
+    return sum(1 for message in messages if isinstance(message.get('content'), list)
+               for part in message['content'] if part.get('type') == 'image_url')
+
+
+def make_handler(profile):
+    """Создает обработчик HTTP-запросов с заданным профилем"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, headers=None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+            profile.count('requests')
+
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send(404, {'error': {'message': 'Not found'}})
+                return
+
+            time.sleep(profile.delay())
+            roll = random.random()
+            if roll < profile.rate_limit_rate:
+                profile.count('rate_limited')
+                self._send(429, {'error': {'message': 'Rate limit reached'}},
+                           {'Retry-After': str(profile.retry_after)})
+                return
+            if roll < profile.rate_limit_rate + profile.error_rate:
+                profile.count('errors')
+                self._send(500, {'error': {'message': 'Mock server error'}})
+                return
+
+            self._send(200, {
+                'id': 'chatcmpl-mock',
+                'object': 'chat.completion',
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': profile.answer(count_images(body))},
+                    'finish_reason': 'stop'
+                }]
+            })
+
+    return Handler
+
+
+class MockVisionServer:
+    """Заглушка API в фоновом потоке текущего процесса"""
+
+    def __init__(self, profile, host='127.0.0.1', port=0):
+        self.profile = profile
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(profile))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """Адрес для VISION_API_BASE_URL"""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Запускает сервер в фоне"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name='mock-vision-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Останавливает сервер"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_profile_arguments(parser):
+    """Аргументы командной строки для профиля заглушки"""
+    parser.add_argument('--latency-ms', type=float, default=800,
+                        help='средняя задержка ответа API, мс')
+    parser.add_argument('--jitter-ms', type=float, default=200,
+                        help='разброс задержки (стандартное отклонение), мс')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='доля ответов 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After для ответов 429, сек')
+    parser.add_argument('--not-found-rate', type=float, default=0.0,
+                        help='доля ответов NOT_FOUND')
+
+
+def profile_from_args(args):
+    """Создает профиль из разобранных аргументов"""
+    return MockProfile(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        not_found_rate=args.not_found_rate
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заглушка vision API для нагрузочных тестов')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockVisionServer(profile_from_args(args), args.host, args.port)
+    print(f"Mock vision API: VISION_API_BASE_URL={server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f"Stats: {server.profile.stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Хранилище загруженных фото по содержимому: objects/ab/cd/<sha256>.<ext>
+
+Одинаковые фото хранятся один раз. Ссылки на файлы - loadlocks.image_path и
+machines.image_path; файл без ссылок удаляется сборкой мусора после периода ожидания.
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from image_preprocess import sniff_image_type
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """SHA-256 файла (читается кусками)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_extension(path):
+    """Расширение по сигнатуре файла, иначе по имени"""
+    with open(path, 'rb') as source:
+        return sniff_image_type(source.read(16)) or Path(path).suffix.lower() or '.bin'
+
+
+class BlobStore:
+    """Файлы по SHA-256 содержимого в двухуровневой структуре каталогов"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, default_root):
+        """Создает хранилище в UPLOAD_STORE_DIR или в default_root"""
+        return cls(os.getenv('UPLOAD_STORE_DIR') or default_root)
+
+    def path_for(self, sha256, extension):
+        """Путь объекта: objects/ab/cd/abcd...<ext>"""
+        return self.root / sha256[:2] / sha256[2:4] / f"{sha256}{extension}"
+
+    def contains(self, path):
+        """Лежит ли файл внутри хранилища"""
+        try:
+            Path(path).resolve().relative_to(self.root.resolve())
+            return True
+        except ValueError:
+            return False
+
+    def put_file(self, src_path, sha256, extension):
+        """Переносит файл в хранилище; если такой объект уже есть - src удаляется"""
+        target = self.path_for(sha256, extension)
+        if target.exists():
+            os.remove(src_path)
+            # Повторная загрузка продлевает период ожидания сборки мусора
+            os.utime(target)
+            return str(target)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src_path, target)
+        return str(target)
+
+    def put_path(self, path, move=False):
+        """Кладет существующий файл в хранилище (move - перенести, иначе скопировать)"""
+        sha256 = file_sha256(path)
+        extension = file_extension(path)
+        if not move:
+            if self.path_for(sha256, extension).exists():
+                return str(self.path_for(sha256, extension))
+            # Копия рядом с объектом, чтобы перенос был атомарным rename
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.put_')
+            os.close(fd)
+            shutil.copyfile(path, tmp_path)
+            path = tmp_path
+        return self.put_file(path, sha256, extension)
+
+    def iter_objects(self):
+        """Все объекты хранилища (без временных файлов)"""
+        for path in self.root.glob('??/??/*'):
+            if path.is_file() and not path.name.startswith('.'):
+                yield path
+
+    def sweep(self, referenced, min_age_seconds=24 * 3600, dry_run=False):
+        """Удаляет объекты без ссылок старше min_age_seconds: (число, байты).
+
+        Период ожидания защищает свежие загрузки, которые еще ждут распознавания
+        в очереди и пока не записаны в базу.
+        """
+        referenced = {str(Path(path).resolve()) for path in referenced}
+        cutoff = time.time() - min_age_seconds
+        removed, reclaimed = 0, 0
+        for path in self.iter_objects():
+            stat = path.stat()
+            if stat.st_mtime > cutoff or str(path.resolve()) in referenced:
+                continue
+            removed += 1
+            reclaimed += stat.st_size
+            if not dry_run:
+                path.unlink()
+        # Временные файлы прерванных копирований
+        for path in self.root.glob('.put_*'):
+            if path.stat().st_mtime < cutoff and not dry_run:
+                path.unlink()
+        return removed, reclaimed
+
+    def size(self):
+        """Число объектов и их суммарный размер"""
+        count, total = 0, 0
+        for path in self.iter_objects():
+            count += 1
+            total += path.stat().st_size
+        return count, total
+
+
+class ImageReferences:
+    """Ссылки на фото из нескольких баз: [(путь к БД, таблица, столбец), ...]"""
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def _connect(self, db_path):
+        conn = sqlite3.connect(str(db_path), timeout=5, isolation_level=None)
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def _existing_sources(self):
+        for db_path, table, column in self.sources:
+            if not os.path.exists(db_path):
+                continue
+            conn = self._connect(db_path)
+            found = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone()
+            if found:
+                yield conn, table, column
+            else:
+                conn.close()
+
+    def counts(self):
+        """Счетчик ссылок: путь -> число строк, которые на него ссылаются"""
+        refs = Counter()
+        for conn, table, column in self._existing_sources():
+            for path, count in conn.execute(
+                f"SELECT {column}, COUNT(*) FROM {table} "
+                f"WHERE {column} IS NOT NULL AND {column} != '' GROUP BY {column}"
+            ):
+                refs[path] += count
+            conn.close()
+        return refs
+
+    def rewrite(self, old_path, new_path):
+        """Заменяет путь во всех базах; возвращает число измененных строк"""
+        changed = 0
+        for conn, table, column in self._existing_sources():
+            cursor = conn.execute(
+                f"UPDATE {table} SET {column} = ? WHERE {column} = ?", (new_path, old_path)
+            )
+            changed += cursor.rowcount
+            conn.close()
+        return changed
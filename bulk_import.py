@@ -0,0 +1,157 @@
+"""
+Массовый импорт фото этикеток (много файлов или ZIP): файлы сохраняются в хранилище,
+распознавание - по задаче на файл в общей очереди, отчет собирается по задачам пакета
+"""
+
+import os
+import zipfile
+import zlib
+from datetime import datetime, timezone
+
+from upload_ingest import HashingSpool
+
+CHUNK_SIZE = 1024 * 1024
+
+# Ошибки чтения одного файла архива: CRC и структура, поток deflate, неизвестный метод
+# сжатия, шифрование (RuntimeError: нужен пароль), обрыв данных
+ZIP_MEMBER_ERRORS = (zipfile.BadZipFile, zlib.error, NotImplementedError, RuntimeError, EOFError)
+
+
+class BulkImportError(Exception):
+    """Архив или набор файлов не может быть принят"""
+
+
+class BulkImporter:
+    """Сохраняет файлы и содержимое ZIP по частям, проверяя формат по сигнатуре, как /api/upload"""
+
+    def __init__(self, upload_dir, store, max_files=500, max_uncompressed=1024 * 1024 * 1024):
+        self.upload_dir = str(upload_dir)
+        # BlobStore: принятые файлы переносятся туда под хэшем содержимого
+        self.store = store
+        self.max_files = max_files
+        # Защита от ZIP-бомб: суммарный размер распакованных файлов
+        self.max_uncompressed = max_uncompressed
+
+    @classmethod
+    def from_env(cls, upload_dir, store):
+        """Создает импортер с настройками из переменных окружения"""
+        return cls(
+            upload_dir, store,
+            max_files=int(os.getenv('BULK_IMPORT_MAX_FILES', 500))
+        )
+
+    def _ingest(self, source, name, saved, rejected):
+        """Пишет файл в HashingSpool и кладет в хранилище, если это изображение"""
+        if len(saved) >= self.max_files:
+            raise BulkImportError(f'Too many files (max {self.max_files})')
+        spool = HashingSpool(self.upload_dir)
+        try:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                spool.write(chunk)
+        except BaseException:
+            spool.discard()
+            raise
+
+        extension = spool.extension
+        if extension is None:
+            spool.discard()
+            rejected.append({'file': name, 'status': 'failed', 'error': 'Unsupported file format'})
+            return
+        saved.append({'file': name, 'image_path': spool.store_in(self.store, extension),
+                      'sha256': spool.sha256, 'size': spool.size})
+
+    def save_uploads(self, files):
+        """Потоково сохраняет загруженные файлы и содержимое ZIP: (сохраненные, отклоненные)"""
+        saved = []
+        rejected = []
+        total_uncompressed = 0
+
+        for upload in files:
+            name = upload.filename or ''
+            if not name.lower().endswith('.zip'):
+                self._ingest(upload.stream, name, saved, rejected)
+                continue
+            try:
+                archive = zipfile.ZipFile(upload.stream)
+            except zipfile.BadZipFile:
+                rejected.append({'file': name, 'status': 'failed', 'error': 'Bad ZIP archive'})
+                continue
+            with archive:
+                for info in archive.infolist():
+                    member = info.filename
+                    if info.is_dir() or member.startswith('__MACOSX/'):
+                        continue
+                    total_uncompressed += info.file_size
+                    if total_uncompressed > self.max_uncompressed:
+                        raise BulkImportError('Archive is too large when uncompressed')
+                    # Распаковка по частям - архив не читается в память целиком.
+                    # Битый, зашифрованный или сжатый неизвестным методом файл архива
+                    # отклоняется сам по себе; его спул удаляет _ingest
+                    try:
+                        with archive.open(info) as src:
+                            self._ingest(src, member, saved, rejected)
+                    except ZIP_MEMBER_ERRORS as e:
+                        rejected.append({'file': member, 'status': 'failed',
+                                         'error': f'Bad ZIP member: {e}'})
+
+        return saved, rejected
+
+
+def batch_entry(job):
+    """Строка отчета импорта по задаче распознавания одного файла"""
+    entry = {'file': job['payload'].get('file')}
+    if job['status'] in ('queued', 'running'):
+        entry['status'] = 'pending'
+        return entry
+    if job['status'] == 'failed':
+        entry.update(status='failed', error=job['error'])
+        return entry
+
+    result = job['result'] or {}
+    entry['source'] = result.get('source')
+    if not result.get('success'):
+        entry.update(status='not_found', additional_info=result.get('additional_info', ''))
+        return entry
+    entry.update(
+        status='duplicate' if result.get('already_exists') else 'recognized',
+        hora_number=result.get('hora_number'),
+        confidence=result.get('confidence'),
+        already_exists=result.get('already_exists'),
+        loadlock_id=result.get('loadlock_id')
+    )
+    return entry
+
+
+def parse_timestamp(value):
+    """CURRENT_TIMESTAMP SQLite ('YYYY-MM-DD HH:MM:SS', UTC) как datetime без зоны"""
+    return datetime.fromisoformat(value) if value else None
+
+
+def batch_report(batch, now=None):
+    """Отчет пакета импорта: файлы, сводка по статусам, done - все задачи завершены.
+
+    Время - от создания пакета до последней завершенной задачи (пока пакет идет - до now),
+    files_per_minute - завершенные задачи за это время; точность - секунды.
+    """
+    report = list(batch['rejected']) + [batch_entry(job) for job in batch['jobs']]
+    summary = {}
+    for entry in report:
+        summary[entry['status']] = summary.get(entry['status'], 0) + 1
+    done = 'pending' not in summary
+
+    finished = [parse_timestamp(job['finished_at']) for job in batch['jobs'] if job['finished_at']]
+    if done:
+        end = max(finished, default=parse_timestamp(batch['created_at']))
+    else:
+        end = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    elapsed = max(0.0, (end - parse_timestamp(batch['created_at'])).total_seconds())
+    return {
+        'batch_id': batch['id'],
+        'created_at': batch['created_at'],
+        'done': done,
+        'files': report,
+        'summary': summary,
+        'total_files': len(report),
+        'elapsed_seconds': elapsed,
+        'files_per_minute': round(len(finished) / elapsed * 60, 1) if elapsed > 0 else None
+    }
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Съемка этикетки с веб-камеры: кадры читает фоновый поток, снимок делается сам,
+когда кадр резкий и камера неподвижна несколько кадров подряд
+
+Без окна (CAMERA_HEADLESS=1 или --headless) работает и с записанным видео:
+    python3 camera_capture.py --source label.mp4 --headless --out frame.jpg
+"""
+
+import argparse
+import os
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+
+CAMERA_INDEXES = (0, 1, 2)
+# Ширина уменьшенного кадра для оценки движения
+MOTION_WIDTH = 160
+
+FrameScore = namedtuple('FrameScore', 'index sharpness motion')
+
+
+def open_camera(source=None, indexes=CAMERA_INDEXES):
+    """Открывает источник кадров: (cap, имя) или (None, None).
+
+    source - путь к видео или номер камеры; без него перебираются камеры 0, 1, 2.
+    """
+    if source is None:
+        candidates = list(indexes)
+    else:
+        candidates = [int(source) if str(source).isdigit() else str(source)]
+    for candidate in candidates:
+        cap = cv2.VideoCapture(candidate)
+        if cap.isOpened():
+            if isinstance(candidate, int):
+                # Минимальный буфер драйвера: последний кадр, а не кадр полсекунды назад
+                cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            return cap, candidate
+        cap.release()
+    return None, None
+
+
+def sharpness(gray):
+    """Резкость: дисперсия лапласиана (размытый кадр - малая дисперсия)"""
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+
+class FrameScorer:
+    """Оценивает резкость центральной части кадра (там этикетка) и движение между кадрами"""
+
+    def __init__(self, roi_fraction=0.6, max_side=640):
+        self.roi_fraction = roi_fraction
+        self.max_side = max_side
+        self._previous = None
+        self._index = 0
+
+    def score(self, frame):
+        height, width = frame.shape[:2]
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+        # Резкость на фиксированном масштабе, иначе порог зависел бы от разрешения камеры
+        margin_y = int(height * (1 - self.roi_fraction) / 2)
+        margin_x = int(width * (1 - self.roi_fraction) / 2)
+        roi = gray[margin_y:height - margin_y, margin_x:width - margin_x]
+        longest = max(roi.shape[:2])
+        if longest > self.max_side:
+            scale = self.max_side / longest
+            roi = cv2.resize(roi, (round(roi.shape[1] * scale), round(roi.shape[0] * scale)),
+                             interpolation=cv2.INTER_AREA)
+
+        small = cv2.resize(gray, (MOTION_WIDTH, max(1, round(height * MOTION_WIDTH / width))),
+                           interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (3, 3), 0)
+        motion = float('inf') if self._previous is None else float(cv2.absdiff(small, self._previous).mean())
+        self._previous = small
+
+        self._index += 1
+        return FrameScore(self._index, sharpness(roi), motion)
+
+
+class AutoCapture:
+    """Решает, когда снимать: stable_frames подряд резких и неподвижных кадров"""
+
+    def __init__(self, min_sharpness=120.0, max_motion=3.0, stable_frames=8):
+        self.min_sharpness = min_sharpness
+        self.max_motion = max_motion
+        self.stable_frames = stable_frames
+        self.streak = 0
+        self.best = None
+
+    @classmethod
+    def from_env(cls):
+        """Пороги из CAPTURE_MIN_SHARPNESS, CAPTURE_MAX_MOTION, CAPTURE_STABLE_FRAMES"""
+        return cls(
+            min_sharpness=float(os.getenv('CAPTURE_MIN_SHARPNESS', 120)),
+            max_motion=float(os.getenv('CAPTURE_MAX_MOTION', 3)),
+            stable_frames=int(os.getenv('CAPTURE_STABLE_FRAMES', 8))
+        )
+
+    def update(self, frame, score):
+        """Учитывает кадр; возвращает самый резкий кадр серии, когда серия набрана"""
+        if score.sharpness >= self.min_sharpness and score.motion <= self.max_motion:
+            self.streak += 1
+            if self.best is None or score.sharpness > self.best[1].sharpness:
+                self.best = (frame, score)
+        else:
+            self.reset()
+        if self.streak >= self.stable_frames:
+            return self.best
+        return None
+
+    def reset(self):
+        """Начинает новую серию"""
+        self.streak = 0
+        self.best = None
+
+    @property
+    def progress(self):
+        return min(1.0, self.streak / self.stable_frames)
+
+
+class FrameGrabber:
+    """Фоновый поток: читает каждый кадр, оценивает его и хранит последний.
+
+    Решение о снимке принимается здесь же, на каждом кадре, поэтому медленное окно
+    превью не пропускает кадры серии, а видео без окна дает тот же результат, что и камера.
+    """
+
+    def __init__(self, cap, scorer=None, auto=None, on_frame=None):
+        self.cap = cap
+        self.scorer = scorer or FrameScorer()
+        self.auto = auto
+        # on_frame(frame, score) - вызывается в потоке чтения для каждого кадра
+        self.on_frame = on_frame
+        self.frames = 0
+        self.captured = None
+        self.finished = threading.Event()
+        self._latest = (None, None)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='frame-grabber', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+
+    def latest(self):
+        """(кадр, FrameScore) последнего прочитанного кадра"""
+        with self._lock:
+            return self._latest
+
+    def wait(self, timeout=None):
+        """Ждет снимка или конца видео; True, если снимок сделан"""
+        self.finished.wait(timeout)
+        return self.captured is not None
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                ok, frame = self.cap.read()
+                if not ok:
+                    break
+                score = self.scorer.score(frame)
+                self.frames += 1
+                with self._lock:
+                    self._latest = (frame, score)
+                if self.on_frame is not None:
+                    self.on_frame(frame, score)
+                if self.auto is not None:
+                    best = self.auto.update(frame, score)
+                    if best is not None:
+                        self.captured = best
+                        break
+        finally:
+            self.finished.set()
+
+
+def draw_overlay(frame, score, auto):
+    """Превью с резкостью и заполнением серии кадров"""
+    view = frame.copy()
+    if score is None:
+        return view
+    color = (0, 200, 0) if auto and score.sharpness >= auto.min_sharpness else (0, 0, 255)
+    cv2.putText(view, f"sharpness {score.sharpness:.0f}  motion {score.motion:.1f}", (10, 30),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+    if auto:
+        width = view.shape[1] - 20
+        cv2.rectangle(view, (10, 45), (10 + int(width * auto.progress), 55), (0, 200, 0), -1)
+    return view
+
+
+def capture_frame(cap, title, auto=True, headless=False, timeout=None):
+    """Делает снимок: автоматически по резкости, SPACE - вручную, q - отмена.
+
+    Возвращает кадр или None. Источник cap закрывается.
+    """
+    auto_capture = AutoCapture.from_env() if auto else None
+    grabber = FrameGrabber(cap, auto=auto_capture).start()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    frame = None
+    try:
+        if headless:
+            if grabber.wait(timeout):
+                frame = grabber.captured[0]
+            return frame
+
+        while not grabber.finished.is_set():
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            latest, score = grabber.latest()
+            if latest is not None:
+                cv2.imshow(title, draw_overlay(latest, score, auto_capture))
+            key = cv2.waitKey(15) & 0xFF
+            if key == ord(' ') and latest is not None:
+                frame = latest
+                break
+            elif key == ord('q'):
+                break
+        if frame is None and grabber.captured is not None:
+            frame = grabber.captured[0]
+        return frame
+    finally:
+        grabber.stop()
+        cap.release()
+        if not headless:
+            cv2.destroyAllWindows()
+
+
+def main():
+    """Снимок из камеры или видео в файл (для проверки порогов на записи)"""
+    parser = argparse.ArgumentParser(description='Автоматический снимок резкого кадра')
+    parser.add_argument('--source', help='видеофайл или номер камеры (по умолчанию камеры 0, 1, 2)')
+    parser.add_argument('--headless', action='store_true', help='без окна превью')
+    parser.add_argument('--timeout', type=float, default=None, help='секунд до отмены')
+    parser.add_argument('--out', default='capture.jpg')
+    args = parser.parse_args()
+
+    cap, name = open_camera(args.source)
+    if cap is None:
+        print("❌ Ошибка: невозможно открыть источник кадров")
+        return 1
+    print(f"✓ Источник {name} открыт")
+    frame = capture_frame(cap, 'Capture (SPACE - фото, q - выход)', headless=args.headless,
+                          timeout=args.timeout)
+    if frame is None:
+        print("Снимок не сделан")
+        return 1
+    cv2.imwrite(args.out, frame)
+    print(f"✓ Сохранено: {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
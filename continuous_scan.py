@@ -0,0 +1,160 @@
+"""
+Непрерывное сканирование этикеток с видеопотока (обход участка без меню и SPACE)
+
+Новая этикетка в кадре определяется по перцептивному хэшу кадра (dHash): после снимка
+сканер ждет смены сцены, а повтор недавно снятой этикетки не отправляется. Распознавание
+идет в фоновых потоках, пока камера продолжает читать кадры.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from camera_capture import AutoCapture, FrameGrabber, draw_overlay
+
+
+def dhash(frame, size=8):
+    """Разностный хэш кадра: 64 бита, похожие кадры отличаются в немногих битах"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+
+def hamming(a, b):
+    """Число различающихся битов двух хэшей"""
+    return bin(a ^ b).count('1')
+
+
+class LabelChangeDetector:
+    """Отбирает кадры с новой этикеткой.
+
+    Снимок - резкая неподвижная серия кадров (AutoCapture). После снимка следующая серия
+    принимается только когда хэш кадра ушел от снятого дальше change_distance (этикетка
+    сменилась), а снимок, близкий к одному из memory последних, считается повтором.
+    """
+
+    def __init__(self, auto=None, change_distance=14, duplicate_distance=6, memory=20):
+        self.auto = auto or AutoCapture.from_env()
+        self.change_distance = change_distance
+        self.duplicate_distance = duplicate_distance
+        self.recent = deque(maxlen=memory)
+        self.last_hash = None
+        self.captures = 0
+        self.duplicates = 0
+
+    @classmethod
+    def from_env(cls):
+        """Пороги из SCAN_CHANGE_DISTANCE, SCAN_DUPLICATE_DISTANCE, SCAN_MEMORY"""
+        return cls(
+            change_distance=int(os.getenv('SCAN_CHANGE_DISTANCE', 14)),
+            duplicate_distance=int(os.getenv('SCAN_DUPLICATE_DISTANCE', 6)),
+            memory=int(os.getenv('SCAN_MEMORY', 20))
+        )
+
+    @property
+    def armed(self):
+        return self.last_hash is None
+
+    def update(self, frame, score):
+        """Учитывает кадр; возвращает кадр новой этикетки или None"""
+        if not self.armed:
+            if hamming(dhash(frame), self.last_hash) < self.change_distance:
+                return None
+            # Сцена сменилась - ждем новую устойчивую серию
+            self.last_hash = None
+            self.auto.reset()
+
+        best = self.auto.update(frame, score)
+        if best is None:
+            return None
+        self.auto.reset()
+        captured = best[0]
+        self.last_hash = dhash(captured)
+        if any(hamming(self.last_hash, seen) <= self.duplicate_distance for seen in self.recent):
+            self.duplicates += 1
+            return None
+        self.recent.append(self.last_hash)
+        self.captures += 1
+        return captured
+
+
+class ContinuousScanner:
+    """Читает поток, сохраняет снимки новых этикеток и распознает их в фоне.
+
+    recognize(image_path) -> строка результата; выполняется в пуле из workers потоков.
+    """
+
+    def __init__(self, recognize, output_dir, detector=None, workers=2):
+        self.recognize = recognize
+        self.output_dir = output_dir
+        self.detector = detector or LabelChangeDetector.from_env()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan-recognize')
+        self._print_lock = threading.Lock()
+
+    def _on_frame(self, frame, score):
+        captured = self.detector.update(frame, score)
+        if captured is None:
+            return
+        number = self.detector.captures
+        image_path = os.path.join(
+            self.output_dir, f"hora_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{number:03d}.jpg"
+        )
+        cv2.imwrite(image_path, captured)
+        self._print(f"📸 Этикетка #{number} (кадр {score.index}) - распознается в фоне")
+        future = self.executor.submit(self.recognize, image_path)
+        future.add_done_callback(lambda done, number=number: self._report(number, done))
+
+    def _report(self, number, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = f"❌ Ошибка: {e}"
+        self._print(f"   #{number}: {result}")
+
+    def _print(self, message):
+        with self._print_lock:
+            print(message, flush=True)
+
+    def run(self, cap, title='Сканирование (q - выход)', headless=False, timeout=None):
+        """Сканирует до конца видео, q или timeout; ждет распознавания всех снимков.
+
+        Возвращает статистику: кадры, кадры/с, снимки, повторы, время.
+        """
+        grabber = FrameGrabber(cap, on_frame=self._on_frame).start()
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        try:
+            while not grabber.finished.is_set():
+                if deadline is not None and time.monotonic() > deadline:
+                    break
+                if headless:
+                    grabber.finished.wait(0.1)
+                    continue
+                frame, score = grabber.latest()
+                if frame is not None:
+                    cv2.imshow(title, draw_overlay(frame, score, self.detector.auto))
+                if cv2.waitKey(15) & 0xFF == ord('q'):
+                    break
+        finally:
+            grabber.stop()
+            cap.release()
+            if not headless:
+                cv2.destroyAllWindows()
+        scan_seconds = time.monotonic() - started
+
+        self.executor.shutdown(wait=True)
+        return {
+            'frames': grabber.frames,
+            'fps': grabber.frames / scan_seconds if scan_seconds else 0.0,
+            'captures': self.detector.captures,
+            'duplicates': self.detector.duplicates,
+            'scan_seconds': scan_seconds,
+            'total_seconds': time.monotonic() - started,
+        }
@@ -0,0 +1,95 @@
+"""
+Управление подключениями к SQLite: одно соединение на рабочий поток, режим WAL
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from profiling import phase
+
+
+class ConnectionManager:
+    """Хранит по одному постоянному соединению SQLite на каждый поток"""
+
+    def __init__(self, db_path, cache_size_kb=8192, busy_timeout_ms=5000,
+                 cached_statements=256):
+        self.db_path = str(db_path)
+        self.cache_size_kb = cache_size_kb
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+
+    def _connect(self):
+        """Открывает соединение и настраивает PRAGMA"""
+        # isolation_level=None - autocommit: чтения не держат транзакцию,
+        # а записи явно открывают BEGIN IMMEDIATE в transaction()
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,
+            cached_statements=self.cached_statements
+        )
+        # WAL: читатели не блокируются писателем и наоборот
+        conn.execute('PRAGMA journal_mode=WAL')
+        # В режиме WAL NORMAL безопасен для целостности и не делает fsync на каждый commit
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{self.cache_size_kb}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA busy_timeout={self.busy_timeout_ms}')
+        # Внешние ключи в SQLite проверяются только при явном включении на соединении
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    @property
+    def connection(self):
+        """Возвращает соединение текущего потока, создавая его при необходимости"""
+        conn = getattr(self._local, 'conn', None)
+        # После fork (gunicorn) соединение родителя использовать нельзя
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        """Выполняет запрос на чтение и возвращает курсор"""
+        with phase('db'):
+            return self.connection.execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """Открывает транзакцию на запись; commit при успехе, rollback при ошибке"""
+        conn = self.connection
+        cursor = conn.cursor()
+        with phase('db'):
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+                cursor.execute('COMMIT')
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def snapshot(self):
+        """Открывает читающую транзакцию: все запросы внутри видят один снимок БД"""
+        conn = self.connection
+        cursor = conn.cursor()
+        with phase('db'):
+            cursor.execute('BEGIN')
+            try:
+                yield cursor
+            finally:
+                cursor.execute('COMMIT')
+                cursor.close()
+
+    def close(self):
+        """Закрывает соединение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,309 @@
+"""
+Пакетное извлечение данных из папки документов: пул потоков, манифест по хэшу файла
+(прерванный прогон продолжается без повторных запросов к API) и общий файл результатов
+
+    python3 document_extractor.py --batch scans/ --workers 8
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+from blob_store import file_sha256
+from db_connection import ConnectionManager
+from migrations import migrate
+from vision_client import RETRY_STATUSES, VisionAPIError
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+
+# Миграции манифеста: индекс в списке + 1 = версия схемы
+BATCH_MIGRATIONS = [
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS batch_files (
+            sha256 TEXT NOT NULL,
+            prompt_key TEXT NOT NULL,
+            path TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (sha256, prompt_key)
+        )
+        ''',
+    ],
+]
+
+
+def iter_images(root):
+    """Изображения в дереве папок (по расширению), в стабильном порядке; скрытые папки пропускаются"""
+    for directory, subdirs, files in os.walk(root):
+        subdirs[:] = sorted(name for name in subdirs if not name.startswith('.'))
+        for name in sorted(files):
+            if Path(name).suffix.lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(directory, name)
+
+
+def prompt_key(prompt):
+    """Ключ промпта: результат для другого промпта - другая запись манифеста"""
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+
+def parse_answer(answer):
+    """Ответ модели как JSON, если это JSON, иначе строка (как в save_results)"""
+    try:
+        return json.loads(answer)
+    except (TypeError, json.JSONDecodeError):
+        return answer
+
+
+def transient_error(error):
+    """Временная ошибка API: сеть, код из RETRY_STATUSES или успешный код с битым ответом"""
+    status = error.status_code
+    return status is None or status < 400 or status in RETRY_STATUSES
+
+
+class BatchManifest:
+    """Состояние файлов пакета в SQLite: done - ответ получен, failed - попытки кончились"""
+
+    def __init__(self, db_path):
+        self.db = ConnectionManager(db_path)
+        migrate(self.db.connection, BATCH_MIGRATIONS)
+
+    def get(self, sha256, key):
+        """Запись файла или None"""
+        return self.db.execute(
+            'SELECT status, attempts, result, error FROM batch_files WHERE sha256 = ? AND prompt_key = ?',
+            (sha256, key)
+        ).fetchone()
+
+    def record(self, sha256, key, path, status, attempts, result=None, error=None):
+        """Сохраняет исход обработки файла (сразу, чтобы прерывание не теряло готовое)"""
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                '''
+                INSERT INTO batch_files (sha256, prompt_key, path, status, attempts, result, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (sha256, prompt_key) DO UPDATE SET
+                    path = excluded.path, status = excluded.status, attempts = excluded.attempts,
+                    result = excluded.result, error = excluded.error, updated_at = excluded.updated_at
+                ''',
+                (sha256, key, path, status, attempts, result, error,
+                 datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+
+    def close(self):
+        self.db.close()
+
+
+class BatchRunner:
+    """Прогоняет папку через DocumentExtractor.request_extraction в пуле из workers потоков.
+
+    Готовые по манифесту файлы пропускаются, одинаковые по содержимому файлы отправляются
+    один раз. Сетевые ошибки и временные коды ответа повторяет сам клиент vision API;
+    здесь до retries раз с растущей паузой повторяется только ответ без результата.
+    """
+
+    def __init__(self, extractor, manifest, workers=4, retries=2, retry_delay=2.0, prompt=None):
+        self.extractor = extractor
+        self.manifest = manifest
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.prompt = prompt
+        # Пустой промпт в ключе - промпт по умолчанию
+        self.prompt_key = prompt_key(prompt or '')
+        self.counts = Counter()
+        self.hashes = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _claim(self, sha256):
+        """Событие, если файл с тем же содержимым уже обрабатывается, иначе None (файл наш)"""
+        with self._lock:
+            event = self._inflight.get(sha256)
+            if event is None:
+                self._inflight[sha256] = threading.Event()
+            return event
+
+    def _release(self, sha256):
+        with self._lock:
+            self._inflight.pop(sha256).set()
+
+    def process(self, path):
+        """Обрабатывает один файл; возвращает исход: done, skipped или failed"""
+        sha256 = file_sha256(path)
+        self.hashes[path] = sha256
+        other = self._claim(sha256)
+        if other is not None:
+            # Копия уже отправлена другим потоком - ждем и берем ее результат из манифеста
+            other.wait()
+            row = self.manifest.get(sha256, self.prompt_key)
+            return 'skipped' if row and row[0] == 'done' else 'failed'
+        try:
+            row = self.manifest.get(sha256, self.prompt_key)
+            if row and row[0] == 'done':
+                return 'skipped'
+            attempts = row[1] if row else 0
+            return self._extract(path, sha256, attempts)
+        finally:
+            self._release(sha256)
+
+    def _extract(self, path, sha256, attempts):
+        for attempt in range(self.retries + 1):
+            attempts += 1
+            try:
+                answer = self.extractor.request_extraction(path, self.prompt, verbose=False)
+            except VisionAPIError as e:
+                # Клиент уже исчерпал свои повторы или ошибка постоянная (400, 401, 404)
+                if transient_error(e):
+                    with self._lock:
+                        self.counts['transient'] += 1
+                self.manifest.record(sha256, self.prompt_key, path, 'failed', attempts, error=str(e))
+                return 'failed'
+            except (OSError, ValueError) as e:
+                # Файл не читается, не декодируется или больше VISION_MAX_DECODE_PIXELS
+                # (ImageTooLargeError) - повтор не поможет
+                self.manifest.record(sha256, self.prompt_key, path, 'failed', attempts, error=str(e))
+                return 'failed'
+            if answer is not None:
+                self.manifest.record(sha256, self.prompt_key, path, 'done', attempts, result=answer)
+                return 'done'
+            # Ответ без вариантов клиент считает успешным - повторяем файл
+            if attempt >= self.retries:
+                self.manifest.record(sha256, self.prompt_key, path, 'failed', attempts,
+                                     error='Unexpected API response format')
+                return 'failed'
+            with self._lock:
+                self.counts['retries'] += 1
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+    def _count(self, future):
+        """Учитывает исход завершенного файла"""
+        future.counted = True
+        try:
+            outcome = future.result()
+        except Exception as e:
+            print(f"❌ Ошибка обработки: {e}")
+            outcome = 'failed'
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def run(self, root, on_progress=None):
+        """Обрабатывает дерево root; возвращает статистику прогона.
+
+        on_progress(stats) вызывается после каждого файла. При Ctrl+C ждет только уже
+        начатые файлы (stats['interrupted']) - все готовое сохранено в манифесте.
+        """
+        files = list(iter_images(root))
+        vision_stats = self.extractor.vision.stats
+        http_retries = vision_stats['retries']
+        started = time.monotonic()
+
+        def snapshot():
+            elapsed = time.monotonic() - started
+            sent = self.counts['done'] + self.counts['failed']
+            return {
+                'files': len(files),
+                'finished': sum(self.counts[key] for key in ('done', 'skipped', 'failed')),
+                'done': self.counts['done'],
+                'skipped': self.counts['skipped'],
+                'failed': self.counts['failed'],
+                # Из failed: временные ошибки API (повторный прогон может помочь)
+                'transient': self.counts['transient'],
+                'retries': self.counts['retries'],
+                # Повторы HTTP внутри клиента (клиент общий на процесс - разница за прогон)
+                'http_retries': vision_stats['retries'] - http_retries,
+                'elapsed': elapsed,
+                'files_per_minute': sent * 60 / elapsed if elapsed else 0.0,
+            }
+
+        interrupted = False
+        futures = []
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='document-batch')
+        try:
+            futures = [executor.submit(self.process, path) for path in files]
+            for future in as_completed(futures):
+                self._count(future)
+                if on_progress is not None:
+                    on_progress(snapshot())
+        except KeyboardInterrupt:
+            print("\nПрерывание: ждем начатые файлы, остальное продолжится при следующем запуске")
+            executor.shutdown(wait=True, cancel_futures=True)
+            interrupted = True
+            # Начатые до прерывания файлы дорабатывают и тоже попадают в итоги
+            for future in futures:
+                if not future.cancelled() and not getattr(future, 'counted', False):
+                    self._count(future)
+        finally:
+            executor.shutdown(wait=True)
+        stats = snapshot()
+        stats['paths'] = files
+        stats['interrupted'] = interrupted
+        return stats
+
+    def write_results(self, root, paths, output_path):
+        """Общий файл результатов: по записи на каждый файл прогона (копии - с общим результатом)"""
+        entries = []
+        for path in paths:
+            sha256 = self.hashes.get(path)
+            row = self.manifest.get(sha256, self.prompt_key) if sha256 else None
+            status, attempts, result, error = row or ('pending', 0, None, None)
+            entries.append({
+                'path': os.path.relpath(path, root),
+                'sha256': sha256,
+                'status': status,
+                'attempts': attempts,
+                'result': parse_answer(result) if result is not None else None,
+                'error': error,
+            })
+        with open(output_path, 'w', encoding='utf-8') as output:
+            json.dump({
+                'root': os.path.abspath(root),
+                'generated_at': datetime.now().isoformat(timespec='seconds'),
+                'files': entries,
+            }, output, ensure_ascii=False, indent=2)
+        return output_path
+
+
+def run_batch(extractor, root, workers=4, retries=2, manifest_path=None, output_path=None):
+    """Пакетный прогон с выводом прогресса и итогов; возвращает код выхода"""
+    if not os.path.isdir(root):
+        print(f"Ошибка: папка {root} не найдена")
+        return 1
+    manifest = BatchManifest(manifest_path or extractor.output_dir / 'batch_manifest.db')
+    runner = BatchRunner(extractor, manifest, workers=workers, retries=retries)
+
+    def report(stats):
+        print(f"[{stats['finished']}/{stats['files']}] готово {stats['done']}, "
+              f"пропущено {stats['skipped']}, ошибок {stats['failed']}, "
+              f"{stats['files_per_minute']:.1f} файлов/мин", flush=True)
+
+    print(f"Пакетная обработка: {root} ({workers} потоков)")
+    try:
+        stats = runner.run(root, on_progress=report)
+        if output_path is None:
+            output_path = extractor.output_dir / f"batch_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        runner.write_results(root, stats['paths'], output_path)
+    finally:
+        manifest.close()
+
+    print("\n" + "=" * 50)
+    print(f"Файлов: {stats['files']}")
+    print(f"Обработано: {stats['done']}, без запроса (готовые и копии): {stats['skipped']}, ошибок: {stats['failed']}")
+    if stats['transient']:
+        print(f"Временных ошибок API: {stats['transient']} - эти файлы отправит повторный запуск")
+    print(f"Повторов файлов: {stats['retries']}, повторов HTTP: {stats['http_retries']}")
+    print(f"Время: {stats['elapsed']:.1f} с, {stats['files_per_minute']:.1f} файлов/мин")
+    print(f"Результаты сохранены: {output_path}")
+    if stats['interrupted']:
+        print("Прогон прерван - запустите команду еще раз, готовые файлы будут пропущены")
+        return 130
+    return 1 if stats['failed'] else 0
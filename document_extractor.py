@@ -3,67 +3,68 @@
 Скрипт для фотографирования документа и извлечения данных с помощью ИИ
 """
 
+import argparse
 import cv2
 import base64
 import json
 import os
 from pathlib import Path
-import requests
 from dotenv import load_dotenv
 
+from camera_capture import capture_frame, open_camera
+from document_batch import run_batch
+from image_preprocess import ImagePreprocessor, ImageTooLargeError
+from vision_client import VisionAPIError, get_vision_client
+
 # Загружаем переменные окружения
 load_dotenv()
 
+DEFAULT_PROMPT = """Please extract and analyze the text content from this document image.
+Return the results as JSON with this structure:
+{
+    "document_type": "description of document type",
+    "text_content": "all extracted text",
+    "key_information": {
+        "field1": "value1",
+        "field2": "value2"
+    },
+    "notes": "any additional observations"
+}"""
+
 class DocumentExtractor:
     def __init__(self):
         self.api_key = os.getenv('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("Переменная OPENAI_API_KEY не установлена")
         
-        self.base_url = "https://api.openai.com/v1"
-        self.output_dir = Path("/Users/valerysandler/script/output")
-        self.output_dir.mkdir(exist_ok=True)
+        self.base_url = os.getenv('VISION_API_BASE_URL', "https://api.openai.com/v1")
+        # Один пул соединений и общий лимит запросов на процесс
+        self.vision = get_vision_client(self.api_key, self.base_url)
+        # DOCUMENT_OUTPUT_DIR - папка результатов, по умолчанию output/ рядом со скриптом
+        self.output_dir = Path(os.getenv('DOCUMENT_OUTPUT_DIR') or
+                               Path(os.path.dirname(os.path.abspath(__file__))) / "output")
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.preprocessor = ImagePreprocessor.from_env(max_side=2048)
     
     def capture_document(self, save_path=None):
         """Захватывает фото документа с веб-камеры"""
         print("Открываю веб-камеру...")
         
-        # Пробуем разные индексы камер
-        for camera_index in [0, 1, 2]:
-            cap = cv2.VideoCapture(camera_index)
-            if cap.isOpened():
-                print(f"✓ Камера {camera_index} открыта успешно!")
-                break
-        else:
+        # Пробуем разные индексы камер (или CAMERA_SOURCE - номер камеры/видеофайл)
+        cap, camera = open_camera(os.getenv('CAMERA_SOURCE'))
+        if cap is None:
             print("\n❌ Ошибка: невозможно открыть веб-камеру")
             print("\nРешения для Mac:")
             print("1. Проверьте разрешения: System Settings > Privacy & Security > Camera")
             print("2. Дайте разрешение Terminal на доступ к камере")
             print("3. Используйте опцию загрузить изображение вручную\n")
             return None
+        print(f"✓ Камера {camera} открыта успешно!")
         
-        print("Нажмите SPACE для фото, q для выхода без фото")
-        
-        captured_image = None
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            # Отображаем превью
-            cv2.imshow('Документ (SPACE - фото, q - выход)', frame)
-            
-            key = cv2.waitKey(1) & 0xFF
-            if key == ord(' '):  # SPACE
-                captured_image = frame
-                print("Фото сделано!")
-                break
-            elif key == ord('q'):
-                print("Выход без фото")
-                break
-        
-        cap.release()
-        cv2.destroyAllWindows()
+        print("Держите документ неподвижно - фото сделается само (SPACE - сразу, q - выход без фото)")
+        captured_image = capture_frame(cap, 'Документ (SPACE - фото, q - выход)',
+                                       headless=os.getenv('CAMERA_HEADLESS') == '1')
+        print("Фото сделано!" if captured_image is not None else "Выход без фото")
         
         if captured_image is not None and save_path:
             cv2.imwrite(save_path, captured_image)
@@ -84,100 +85,54 @@ class DocumentExtractor:
         with open(image_path, 'rb') as image_file:
             return base64.standard_b64encode(image_file.read()).decode('utf-8')
     
+    def request_extraction(self, image_path, prompt=None, verbose=True):
+        """Запрос к API без обработки ошибок: ответ модели или None.
+        
+        VisionAPIError поднимается дальше - пакетный режим сам решает, повторять ли файл.
+        """
+        # Уменьшаем и перекодируем изображение; для документов нужен больший размер
+        image_source, stats = self.preprocessor.prepare_source(image_path)
+        if verbose:
+            print(f"Изображение: {stats['original_bytes'] // 1024} KB → "
+                  f"{stats['sent_bytes'] // 1024} KB (сэкономлено {stats['saved_bytes'] // 1024} KB)")
+            print("Отправляю изображение на анализ...")
+        
+        content = [
+            {"type": "image_url", "image_url": {"url": image_source}},
+            {"type": "text", "text": prompt or DEFAULT_PROMPT}
+        ]
+        return self.vision.complete(content, max_tokens=2048, model="gpt-4o")
+    
     def extract_data(self, image_path, prompt=None):
         """Отправляет изображение в OpenAI для извлечения данных"""
         if not os.path.exists(image_path):
             print(f"Ошибка: файл {image_path} не найден")
             return None
         
-        if prompt is None:
-            prompt = """Please extract and analyze the text content from this document image.
-            Return the results as JSON with this structure:
-            {
-                "document_type": "description of document type",
-                "text_content": "all extracted text",
-                "key_information": {
-                    "field1": "value1",
-                    "field2": "value2"
-                },
-                "notes": "any additional observations"
-            }"""
-        
-        # Кодируем изображение
-        image_base64 = self.image_to_base64(image_path)
-        
-        # Определяем тип изображения
-        ext = Path(image_path).suffix.lower()
-        media_type_map = {
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png',
-            '.gif': 'image/gif',
-            '.webp': 'image/webp'
-        }
-        media_type = media_type_map.get(ext, 'image/jpeg')
-        
-        print("Отправляю изображение на анализ...")
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        payload = {
-            "model": "gpt-4o",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{media_type};base64,{image_base64}"
-                            }
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 2048
-        }
-        
         try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=60
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            if 'choices' in result and len(result['choices']) > 0:
-                content = result['choices'][0]['message']['content']
-                # Проверяем, не отказала ли модель
-                if "я не могу" in content.lower() or "unable to" in content.lower():
-                    print("\n⚠️  Модель не смогла обработать изображение")
-                    print("Попробуйте:")
-                    print("- Улучшить качество изображения")
-                    print("- Убедиться, что это реальный документ с текстом")
-                    print("- Использовать более четкое изображение")
-                return content
-            else:
-                print("Ошибка: неожиданный формат ответа от API")
-                return None
-                
-        except requests.exceptions.RequestException as e:
+            answer = self.request_extraction(image_path, prompt)
+        except ImageTooLargeError as e:
+            print(f"❌ Изображение слишком большое: {image_path} ({e})")
+            return None
+        except VisionAPIError as e:
             print(f"Ошибка при запросе к API: {e}")
-            if "404" in str(e):
+            if e.status_code == 404:
                 print("\nПопробуйте использовать другую модель:")
                 print("- gpt-4o (рекомендуется)")
                 print("- gpt-4-turbo")
                 print("- gpt-3.5-turbo")
             return None
+        if answer is None:
+            print("Ошибка: неожиданный формат ответа от API")
+            return None
+        # Проверяем, не отказала ли модель
+        if "я не могу" in answer.lower() or "unable to" in answer.lower():
+            print("\n⚠️  Модель не смогла обработать изображение")
+            print("Попробуйте:")
+            print("- Улучшить качество изображения")
+            print("- Убедиться, что это реальный документ с текстом")
+            print("- Использовать более четкое изображение")
+        return answer
     
     def save_results(self, results, filename=None):
         """Сохраняет результаты в файл"""
@@ -204,6 +159,15 @@ class DocumentExtractor:
 
 def main():
     """Основная функция"""
+    parser = argparse.ArgumentParser(description='Извлечение данных из документов')
+    parser.add_argument('--batch', metavar='DIR', help='обработать все изображения папки (с подпапками) и выйти')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BATCH_WORKERS', 4)),
+                        help='параллельных запросов в пакетном режиме')
+    parser.add_argument('--retries', type=int, default=2, help='повторов файла после ответа API без результата')
+    parser.add_argument('--manifest', help='файл манифеста (по умолчанию output/batch_manifest.db)')
+    parser.add_argument('--output', help='общий файл результатов (по умолчанию output/batch_results_*.json)')
+    args = parser.parse_args()
+    
     print("=" * 50)
     print("Экстрактор данных из документов")
     print("=" * 50)
@@ -213,7 +177,11 @@ def main():
     except ValueError as e:
         print(f"Ошибка инициализации: {e}")
         print("\nУбедитесь, что файл .env содержит OPENAI_API_KEY")
-        return
+        return 1
+    
+    if args.batch:
+        return run_batch(extractor, args.batch, workers=args.workers, retries=args.retries,
+                         manifest_path=args.manifest, output_path=args.output)
     
     # Выбираем источник изображения
     print("\nВыберите источник изображения:")
@@ -259,4 +227,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
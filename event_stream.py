@@ -0,0 +1,232 @@
+"""
+Server-Sent Events: рассылка событий LoadLock всем открытым экранам
+"""
+
+import asyncio
+import json
+import queue
+import threading
+import time
+
+
+class SubscriberQueue(queue.Queue):
+    """Очередь подписчика, которого обслуживает поток (Flask-запрос)"""
+
+    def offer(self, item):
+        """Кладет событие; False, если клиент не успевает читать"""
+        try:
+            self.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        """Сбрасывает накопленное и завершает поток клиента"""
+        with self.mutex:
+            self.queue.clear()
+        self.put_nowait(None)
+
+
+class AsyncSubscriber:
+    """Очередь подписчика на цикле событий (ASGI): события приходят из потока опроса"""
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.queue = asyncio.Queue()
+
+    def offer(self, item):
+        if self.queue.qsize() >= self.maxsize:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            # Цикл событий уже остановлен (сервер завершается)
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self._close)
+        except RuntimeError:
+            pass
+
+    def _close(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self, timeout):
+        """Следующее событие; asyncio.TimeoutError, если за timeout ничего не пришло"""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class EventBroadcaster:
+    """Читает новые строки event_log и раздает их SSE-подписчикам процесса.
+
+    События пишутся в event_log в той же транзакции, что и изменение данных,
+    поэтому каждый процесс gunicorn видит записи всех остальных процессов.
+    """
+
+    def __init__(self, db, poll_interval=0.5, heartbeat_interval=15,
+                 retention_seconds=3600, queue_size=1000):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.retention_seconds = retention_seconds
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._last_id = None
+
+    def notify(self):
+        """Будит поток опроса сразу после commit в этом процессе"""
+        self._wakeup.set()
+
+    def _current_id(self):
+        """Последний id в event_log"""
+        return self.db.execute('SELECT COALESCE(MAX(id), 0) FROM event_log').fetchone()[0]
+
+    def _fetch_after(self, event_id):
+        """События после event_id: список (id, тип, данные)"""
+        rows = self.db.execute('''
+            SELECT id, event, loadlock_id, data FROM event_log
+            WHERE id > ? ORDER BY id
+        ''', (event_id,)).fetchall()
+        return [(row[0], row[1], {'loadlock_id': row[2], **json.loads(row[3] or '{}')})
+                for row in rows]
+
+    def _ensure_thread(self):
+        """Запускает поток опроса при первом подписчике"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sse-broadcaster', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """Один запрос к БД на процесс за интервал, независимо от числа экранов"""
+        last_prune = 0
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+            with self._lock:
+                subscribers = list(self._subscribers)
+                if not subscribers:
+                    # Без подписчиков не держим позицию - ее задаст следующий subscribe()
+                    self._last_id = None
+                    continue
+
+            try:
+                events = self._fetch_after(self._last_id)
+                if time.time() - last_prune > 60:
+                    self._prune()
+                    last_prune = time.time()
+            except Exception as e:
+                print(f"SSE error: {e}")
+                continue
+
+            for event in events:
+                self._last_id = event[0]
+                for subscriber in subscribers:
+                    if not subscriber.offer(event):
+                        # Медленный клиент: отключаем, он переподключится с Last-Event-ID
+                        self.unsubscribe(subscriber)
+                        subscriber.close()
+
+    def _prune(self):
+        """Удаляет старые события"""
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                "DELETE FROM event_log WHERE created_at < datetime('now', ?)",
+                (f'-{int(self.retention_seconds)} seconds',)
+            )
+
+    def subscribe(self, subscriber=None, max_subscribers=None):
+        """Регистрирует подписчика (по умолчанию - очередь для потока) и возвращает его;
+        None, если в процессе уже max_subscribers подписчиков"""
+        self._ensure_thread()
+        if subscriber is None:
+            subscriber = SubscriberQueue(self.queue_size)
+        with self._lock:
+            if max_subscribers is not None and len(self._subscribers) >= max_subscribers:
+                return None
+            if self._last_id is None:
+                self._last_id = self._current_id()
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Удаляет подписчика"""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @staticmethod
+    def format_event(event_id, event, data):
+        """Форматирует событие по протоколу text/event-stream"""
+        payload = json.dumps(data, ensure_ascii=False)
+        return f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n"
+
+    def stream(self, last_event_id=None, subscriber=None):
+        """Генератор SSE: досылает пропущенное после last_event_id, затем живые события"""
+        subscriber = subscriber or self.subscribe()
+        try:
+            yield "retry: 3000\n\n"
+
+            sent_id = last_event_id if last_event_id is not None else self._current_id()
+            if last_event_id is not None:
+                for event_id, event, data in self._fetch_after(last_event_id):
+                    yield self.format_event(event_id, event, data)
+                    sent_id = event_id
+
+            while True:
+                try:
+                    item = subscriber.get(timeout=self.heartbeat_interval)
+                except queue.Empty:
+                    # Комментарий-пинг держит соединение и выявляет отключившихся клиентов
+                    yield ": ping\n\n"
+                    continue
+                if item is None:
+                    return
+                event_id, event, data = item
+                if event_id <= sent_id:
+                    continue
+                yield self.format_event(event_id, event, data)
+                sent_id = event_id
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def astream(self, last_event_id=None):
+        """То же, что stream, для цикла событий: соединение не занимает поток"""
+        loop = asyncio.get_running_loop()
+        subscriber = await asyncio.to_thread(
+            self.subscribe, AsyncSubscriber(loop, self.queue_size)
+        )
+        try:
+            yield "retry: 3000\n\n"
+
+            if last_event_id is not None:
+                sent_id = last_event_id
+                for event_id, event, data in await asyncio.to_thread(self._fetch_after, last_event_id):
+                    yield self.format_event(event_id, event, data)
+                    sent_id = event_id
+            else:
+                sent_id = await asyncio.to_thread(self._current_id)
+
+            while True:
+                try:
+                    item = await subscriber.get(self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if item is None:
+                    return
+                event_id, event, data = item
+                if event_id <= sent_id:
+                    continue
+                yield self.format_event(event_id, event, data)
+                sent_id = event_id
+        finally:
+            self.unsubscribe(subscriber)
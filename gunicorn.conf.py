@@ -0,0 +1,49 @@
+"""
+Настройки gunicorn (читаются автоматически из текущей папки)
+"""
+
+import glob
+import os
+
+# gthread: долгие SSE-соединения (/api/events) занимают поток, а не весь процесс.
+# Потоков под SSE на процесс не больше SSE_MAX_STREAMS (по умолчанию threads / 2), сверх
+# этого экраны получают 503 и опрашивают список; много экранов - ASGI-режим (asgi_app.py)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+timeout = 120
+keepalive = 5
+
+# Метрики Prometheus со всех процессов: multiprocess-режим с общей папкой. Папка задается
+# явно и одна на gunicorn и worker.py (задачи отдельного обработчика видны в /metrics);
+# без нее /metrics показывает только ответивший процесс
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def on_starting(server):
+    """Удаляет метрики завершившихся процессов; файлы живых (worker.py) остаются"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        if server.cfg.workers > 1:
+            server.log.warning('PROMETHEUS_MULTIPROC_DIR is not set: /metrics covers one worker only')
+        return
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, '*.db')):
+        # Имя файла prometheus_client: <тип>_<pid>.db
+        pid = os.path.basename(path)[:-3].rsplit('_', 1)[-1]
+        if pid.isdigit() and not pid_alive(int(pid)):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    """Live-метрики (запросы в обработке, обработчики очереди) завершенного процесса не учитываются"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
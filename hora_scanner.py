@@ -4,86 +4,101 @@
 и добавления его в базу данных
 """
 
+import argparse
 import cv2
 import base64
 import json
 import os
 from pathlib import Path
-import requests
 from dotenv import load_dotenv
 from datetime import datetime
 import sqlite3
 
+from recognition_cache import HORA_PROMPT, RecognitionCache
+from image_preprocess import ImagePreprocessor, ImageTooLargeError
+from label_reader import LocalLabelReader
+from migrations import migrate
+from vision_client import VisionAPIError, get_vision_client
+from vision_batcher import VisionBatcher
+from blob_store import BlobStore
+from camera_capture import capture_frame, open_camera
+from continuous_scan import ContinuousScanner
+from table_export import export_table, parse_date_range, write_export
+
 load_dotenv()
 
+# Миграции machines.db: индекс в списке + 1 = версия схемы (PRAGMA user_version)
+MACHINES_MIGRATIONS = [
+    # 1: таблица машин
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS machines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hora_number TEXT NOT NULL UNIQUE,
+            date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            image_path TEXT,
+            status TEXT DEFAULT 'registered',
+            notes TEXT
+        )
+        ''',
+    ],
+    # 2: индекс под сортировку списка машин
+    [
+        'CREATE INDEX IF NOT EXISTS idx_machines_date_added ON machines(date_added)',
+    ],
+]
+
 class MachineNumberExtractor:
     def __init__(self):
         self.api_key = os.getenv('OPENAI_API_KEY')
         if not self.api_key:
             raise ValueError("Переменная OPENAI_API_KEY не установлена")
         
-        self.base_url = "https://api.openai.com/v1"
-        self.output_dir = Path("/Users/valerysandler/script/output")
-        self.output_dir.mkdir(exist_ok=True)
+        self.base_url = os.getenv('VISION_API_BASE_URL', "https://api.openai.com/v1")
+        # Один пул соединений и общий лимит запросов на процесс
+        self.vision = get_vision_client(self.api_key, self.base_url)
+        self.model = "gpt-4o"
+        self.batcher = VisionBatcher.from_env(self.vision, self.model)
+        # Та же папка данных, что и у app.py (LOADLOCK_DATA_DIR или папка скрипта),
+        # чтобы кэш распознавания был общим
+        data_dir = Path(os.environ.get('LOADLOCK_DATA_DIR', os.path.dirname(os.path.abspath(__file__))))
+        self.output_dir = data_dir / "output"
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Общее с app.py хранилище фото по содержимому (ссылки учитывает compact-uploads)
+        self.store = BlobStore.from_env(data_dir / "uploads" / "objects")
         
         # Инициализируем базу данных
         self.db_path = self.output_dir / "machines.db"
         self.init_database()
+        
+        self.cache = RecognitionCache.from_env(self.output_dir / "recognition_cache.db")
+        self.preprocessor = ImagePreprocessor.from_env()
+        self.label_reader = LocalLabelReader.from_env()
     
     def init_database(self):
-        """Создает базу данных для хранения номеров машин"""
+        """Создает базу данных для хранения номеров машин (применяет недостающие миграции)"""
         conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS machines (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                hora_number TEXT NOT NULL UNIQUE,
-                date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                image_path TEXT,
-                status TEXT DEFAULT 'registered',
-                notes TEXT
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        try:
+            migrate(conn, MACHINES_MIGRATIONS)
+        finally:
+            conn.close()
         print(f"✓ База данных инициализирована: {self.db_path}")
     
     def capture_document(self, save_path=None):
         """Захватывает фото номера הוראה с веб-камеры"""
         print("Открываю веб-камеру...")
         
-        for camera_index in [0, 1, 2]:
-            cap = cv2.VideoCapture(camera_index)
-            if cap.isOpened():
-                print(f"✓ Камера {camera_index} открыта")
-                break
-        else:
+        # CAMERA_SOURCE - номер камеры или видеофайл вместо перебора камер 0, 1, 2
+        cap, camera = open_camera(os.getenv('CAMERA_SOURCE'))
+        if cap is None:
             print("❌ Ошибка: невозможно открыть веб-камеру")
             return None
+        print(f"✓ Камера {camera} открыта")
         
-        print("Нажмите SPACE для фото, q для выхода")
-        
-        captured_image = None
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            cv2.imshow('Фото номера הוראה (SPACE - фото, q - выход)', frame)
-            
-            key = cv2.waitKey(1) & 0xFF
-            if key == ord(' '):
-                captured_image = frame
-                print("✓ Фото сделано!")
-                break
-            elif key == ord('q'):
-                print("Отмена")
-                break
-        
-        cap.release()
-        cv2.destroyAllWindows()
+        print("Держите этикетку неподвижно - фото сделается само (SPACE - сразу, q - выход)")
+        captured_image = capture_frame(cap, 'Фото номера הוראה (SPACE - фото, q - выход)',
+                                       headless=os.getenv('CAMERA_HEADLESS') == '1')
+        print("✓ Фото сделано!" if captured_image is not None else "Отмена")
         
         if captured_image is not None and save_path:
             cv2.imwrite(save_path, captured_image)
@@ -110,76 +125,36 @@ class MachineNumberExtractor:
             print(f"❌ Файл не найден: {image_path}")
             return None
         
-        # Специальный промпт для распознавания номера הוראה
-        prompt = """You are a specialist in recognizing machine instruction numbers (מספר הוראה) in industrial workshops.
-
-Analyze this image carefully and:
-1. Find and extract the "מספר הוראה" (instruction number) - this is usually a number on a label/tag on the machine
-2. Return ONLY a JSON object with this exact structure:
-{
-    "hora_number": "THE NUMBER YOU FOUND (e.g., 12345 or H-12345)",
-    "confidence": "high/medium/low",
-    "location": "where on the image the number is located",
-    "additional_info": "any other visible text or identifiers"
-}
-
-If you cannot find a clear instruction number, still return JSON with "hora_number": "NOT_FOUND" and explain why in "additional_info"."""
+        cache_key = self.cache.make_key(image_path, HORA_PROMPT, self.model)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            print("⚡ Результат взят из кэша")
+            return json.dumps({**cached, 'source': 'cache'}, ensure_ascii=False)
         
-        image_base64 = self.image_to_base64(image_path)
-        ext = Path(image_path).suffix.lower()
-        media_type_map = {
-            '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
-            '.gif': 'image/gif', '.webp': 'image/webp'
-        }
-        media_type = media_type_map.get(ext, 'image/jpeg')
+        # Уменьшаем и перекодируем фото перед отправкой
+        try:
+            image_source, stats = self.preprocessor.prepare_source(image_path)
+        except ImageTooLargeError as e:
+            print(f"❌ Изображение слишком большое: {image_path} ({e})")
+            return None
+        print(f"📉 Изображение: {stats['original_bytes'] // 1024} KB → "
+              f"{stats['sent_bytes'] // 1024} KB (сэкономлено {stats['saved_bytes'] // 1024} KB)")
         
         print("🔍 Анализирую изображение...")
         
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        payload = {
-            "model": "gpt-4o",
-            "messages": [{
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{media_type};base64,{image_base64}"
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ]
-            }],
-            "max_tokens": 500
-        }
-        
         try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=60
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            if 'choices' in result and len(result['choices']) > 0:
-                content = result['choices'][0]['message']['content']
-                return content
-            else:
-                print("❌ Неожиданный ответ от API")
-                return None
-                
-        except requests.exceptions.RequestException as e:
+            # Фото, одновременно ждущие распознавания, уходят одним пакетным запросом
+            answer = self.batcher.complete(image_source, HORA_PROMPT)
+        except VisionAPIError as e:
             print(f"❌ Ошибка API: {e}")
             return None
+        if answer is None:
+            print("❌ Неожиданный ответ от API")
+            return None
+        data = self.parse_hora_response(answer)
+        if data and data.get('hora_number') != 'NOT_FOUND':
+            self.cache.put(cache_key, data)
+        return answer
     
     def parse_hora_response(self, response_text):
         """Парсит ответ ИИ и извлекает номер הוראה"""
@@ -198,6 +173,11 @@ If you cannot find a clear instruction number, still return JSON with "hora_numb
     
     def add_to_database(self, hora_number, image_path, notes=""):
         """Добавляет номер הוראה в базу данных"""
+        if image_path and os.path.exists(image_path):
+            # Снимок камеры из output/ переносится в хранилище, файл пользователя копируется
+            captured = Path(image_path).resolve().parent == self.output_dir.resolve()
+            image_path = self.store.put_path(image_path, move=captured)
+        
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
@@ -229,22 +209,27 @@ If you cannot find a clear instruction number, still return JSON with "hora_numb
         
         return machines
     
-    def export_to_csv(self):
-        """Экспортирует базу данных в CSV"""
-        machines = self.get_all_machines()
-        csv_path = self.output_dir / f"machines_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        
-        with open(csv_path, 'w', encoding='utf-8') as f:
-            f.write("ID,Номер הוראה,Дата добавления,Путь изображения,Статус,Примечания\n")
-            for machine in machines:
-                f.write(f"{machine[0]},{machine[1]},{machine[2]},{machine[3]},{machine[4]},{machine[5]}\n")
-        
-        print(f"✓ Экспортировано в: {csv_path}")
-        return csv_path
+    def export_to_csv(self, fmt='csv', date_from=None, date_to=None):
+        """Экспортирует базу данных в CSV или JSONL (потоково, с экранированием полей)"""
+        since, until = parse_date_range(date_from, date_to)
+        export_path = self.output_dir / f"machines_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        write_export(export_path, export_table(self.db_path, 'machines', fmt, since, until))
+        
+        print(f"✓ Экспортировано в: {export_path}")
+        return export_path
 
 
 def main():
     """Основная функция"""
+    parser = argparse.ArgumentParser(description='Распознавание номеров הוראה')
+    parser.add_argument('--scan', action='store_true', help='сразу непрерывное сканирование')
+    parser.add_argument('--source', help='видеофайл или номер камеры для --scan')
+    parser.add_argument('--headless', action='store_true', help='без окна превью')
+    parser.add_argument('--export', choices=['csv', 'jsonl'], help='экспортировать базу и выйти')
+    parser.add_argument('--from', dest='date_from', help='экспорт: с даты (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='date_to', help='экспорт: по дату включительно')
+    args = parser.parse_args()
+    
     print("=" * 60)
     print("📱 Система распознавания номеров הוראה для клинрума")
     print("=" * 60)
@@ -255,17 +240,28 @@ def main():
         print(f"❌ Ошибка: {e}")
         return
     
+    if args.scan:
+        scan_continuously(extractor, source=args.source, headless=args.headless)
+        return
+    if args.export:
+        try:
+            extractor.export_to_csv(args.export, args.date_from, args.date_to)
+        except ValueError as e:
+            print(f"❌ Ошибка: {e}")
+        return
+    
     while True:
         print("\n" + "=" * 60)
         print("Меню:")
         print("1. 📸 Сфотографировать номер הוראה (камера)")
-        print("2. 📁 Загрузить фото из файла")
-        print("3. 📊 Показать все машины в базе данных")
-        print("4. 💾 Экспортировать в CSV")
-        print("5. ❌ Выход")
+        print("2. 🎥 Непрерывное сканирование (камера)")
+        print("3. 📁 Загрузить фото из файла")
+        print("4. 📊 Показать все машины в базе данных")
+        print("5. 💾 Экспортировать в CSV")
+        print("6. ❌ Выход")
         print("=" * 60)
         
-        choice = input("Выберите опцию (1-5): ").strip()
+        choice = input("Выберите опцию (1-6): ").strip()
         
         if choice == "1":
             # Фотографируем
@@ -276,6 +272,11 @@ def main():
                 process_image(extractor, str(image_path))
         
         elif choice == "2":
+            # Обход участка: снимки новых этикеток без меню и SPACE
+            scan_continuously(extractor, source=os.getenv('CAMERA_SOURCE'),
+                              headless=os.getenv('CAMERA_HEADLESS') == '1')
+        
+        elif choice == "3":
             # Загружаем файл
             file_path = input("Введите путь к файлу: ").strip()
             image_path = extractor.load_image_from_file(file_path)
@@ -283,15 +284,15 @@ def main():
             if image_path:
                 process_image(extractor, image_path)
         
-        elif choice == "3":
+        elif choice == "4":
             # Показываем все машины
             show_machines(extractor)
         
-        elif choice == "4":
+        elif choice == "5":
             # Экспортируем в CSV
             extractor.export_to_csv()
         
-        elif choice == "5":
+        elif choice == "6":
             print("\n👋 До свидания!")
             break
         
@@ -299,36 +300,79 @@ def main():
             print("❌ Неверная опция")
 
 
-def process_image(extractor, image_path):
-    """Обрабатывает изображение и добавляет номер в БД"""
+def recognize_label(extractor, image_path, verbose=True):
+    """Распознает номер на фото: словарь с hora_number или None при ошибке API"""
+    # Сначала пробуем прочитать этикетку локально, без запроса к API
+    data = extractor.label_reader.read_confident(image_path) if extractor.label_reader else None
+    
+    if data:
+        if verbose:
+            print(f"\n⚡ Номер прочитан локально (уверенность {data['score']:.2f})")
+        return data
+    
     response = extractor.extract_hora_number(image_path)
+    if not response:
+        return None
     
-    if response:
+    if verbose:
         print("\n" + "=" * 60)
         print("Результат анализа:")
         print("=" * 60)
         print(response)
-        
-        # Парсим ответ
-        data = extractor.parse_hora_response(response)
-        
-        if data and data.get('hora_number') != 'NOT_FOUND':
-            hora_number = data.get('hora_number', 'UNKNOWN')
-            confidence = data.get('confidence', 'unknown')
-            additional_info = data.get('additional_info', '')
-            
-            print(f"\n✓ Найден номер הוראה: {hora_number}")
-            print(f"  Уверенность: {confidence}")
-            print(f"  Информация: {additional_info}")
-            
-            # Добавляем в базу данных
-            notes = f"Confidence: {confidence}, Info: {additional_info}"
-            extractor.add_to_database(hora_number, image_path, notes)
-        else:
-            print("\n❌ Не удалось распознать номер הוראה")
-            print("   Попробуйте еще раз с более четким изображением")
-    else:
+    
+    # Парсим ответ
+    return extractor.parse_hora_response(response)
+
+
+def scan_continuously(extractor, source=None, headless=False):
+    """Непрерывное сканирование: новые этикетки распознаются в фоне, пока камера работает"""
+    cap, camera = open_camera(source)
+    if cap is None:
+        print("❌ Ошибка: невозможно открыть веб-камеру")
+        return None
+    print(f"✓ Источник {camera} открыт. Наводите камеру на этикетки по очереди (q - закончить)")
+    
+    def recognize(image_path):
+        data = recognize_label(extractor, image_path, verbose=False)
+        if not data or data.get('hora_number') in (None, 'NOT_FOUND'):
+            return "❌ номер не распознан"
+        source = data.get('source', 'remote')
+        hora_number = data['hora_number']
+        added = extractor.add_to_database(hora_number, image_path, f"Source: {source}, continuous scan")
+        return f"✓ {hora_number} ({source}){'' if added else ' - уже в базе'}"
+    
+    scanner = ContinuousScanner(recognize, str(extractor.output_dir),
+                                workers=int(os.getenv('SCAN_WORKERS', 2)))
+    stats = scanner.run(cap, headless=headless)
+    print(f"\n📊 Кадров: {stats['frames']} ({stats['fps']:.1f} к/с), этикеток: {stats['captures']}, "
+          f"повторов отброшено: {stats['duplicates']}, время: {stats['total_seconds']:.1f} с")
+    return stats
+
+
+def process_image(extractor, image_path):
+    """Обрабатывает изображение и добавляет номер в БД"""
+    data = recognize_label(extractor, image_path)
+    if data is None:
         print("❌ Ошибка при обработке изображения")
+        return
+    
+    if data and data.get('hora_number') != 'NOT_FOUND':
+        hora_number = data.get('hora_number', 'UNKNOWN')
+        confidence = data.get('confidence', 'unknown')
+        additional_info = data.get('additional_info', '')
+        source = data.get('source', 'remote')
+        
+        print(f"\n✓ Найден номер הוראה: {hora_number}")
+        print(f"  Уверенность: {confidence}")
+        print(f"  Информация: {additional_info}")
+        print(f"  Источник: {source}")
+        
+        # Добавляем в базу данных
+        notes = f"Confidence: {confidence}, Info: {additional_info}, Source: {source}"
+        extractor.add_to_database(hora_number, image_path, notes)
+    else:
+        print("\n❌ Не удалось распознать номер הוראה")
+        print("   Попробуйте еще раз с более четким изображением")
 
 
 def show_machines(extractor):
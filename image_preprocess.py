@@ -0,0 +1,222 @@
+"""
+Подготовка изображений перед отправкой в vision API: уменьшение и перекодирование
+"""
+
+import os
+import struct
+from pathlib import Path
+
+import cv2
+
+from vision_client import ImageSource
+
+MEDIA_TYPES = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+    '.gif': 'image/gif', '.webp': 'image/webp'
+}
+
+# Уменьшенное декодирование JPEG: libjpeg сразу отдает 1/2, 1/4 или 1/8 пикселей
+REDUCED_READ_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class ImageTooLargeError(ValueError):
+    """Изображение не помещается в лимит пикселей для декодирования"""
+
+
+def sniff_image_type(header):
+    """Определяет формат по сигнатуре первых байтов: расширение ('.jpg', ...) или None"""
+    if header.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return '.gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+def image_dimensions(image_path):
+    """Читает (ширина, высота) из заголовка файла без декодирования или None"""
+    with open(image_path, 'rb') as image_file:
+        header = image_file.read(32)
+        kind = sniff_image_type(header)
+        if kind == '.png' and header[12:16] == b'IHDR':
+            return struct.unpack('>II', header[16:24])
+        if kind == '.gif':
+            return struct.unpack('<HH', header[6:10])
+        if kind == '.webp':
+            chunk = header[12:16]
+            if chunk == b'VP8X':
+                width = int.from_bytes(header[24:27], 'little') + 1
+                height = int.from_bytes(header[27:30], 'little') + 1
+                return width, height
+            if chunk == b'VP8L':
+                bits = int.from_bytes(header[21:25], 'little')
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b'VP8 ':
+                image_file.seek(26)
+                width, height = struct.unpack('<HH', image_file.read(4))
+                return width & 0x3FFF, height & 0x3FFF
+            return None
+        if kind != '.jpg':
+            return None
+
+        # JPEG: идем по маркерам до SOFn
+        image_file.seek(2)
+        while True:
+            byte = image_file.read(1)
+            while byte and byte != b'\xff':
+                byte = image_file.read(1)
+            while byte == b'\xff':
+                byte = image_file.read(1)
+            if not byte:
+                return None
+            marker = byte[0]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                continue
+            length_bytes = image_file.read(2)
+            if len(length_bytes) < 2:
+                return None
+            length = struct.unpack('>H', length_bytes)[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                data = image_file.read(5)
+                if len(data) < 5:
+                    return None
+                height, width = struct.unpack('>HH', data[1:5])
+                return width, height
+            image_file.seek(length - 2, os.SEEK_CUR)
+
+
+class ImagePreprocessor:
+    """Уменьшает фото до max_side, исправляет ориентацию и перекодирует в JPEG/WebP"""
+
+    def __init__(self, max_side=1600, output_format='jpeg', quality=85,
+                 grayscale='auto', saturation_threshold=25, max_decode_pixels=40_000_000):
+        self.max_side = max_side
+        self.output_format = output_format
+        self.quality = quality
+        # True/False или 'auto' - в серый только почти монохромные снимки
+        self.grayscale = grayscale
+        self.saturation_threshold = saturation_threshold
+        # Потолок памяти на декодирование: ширина x высота после уменьшения при чтении
+        self.max_decode_pixels = max_decode_pixels
+
+    @classmethod
+    def from_env(cls, **defaults):
+        """Создает препроцессор с настройками из переменных окружения"""
+        grayscale = os.getenv('VISION_GRAYSCALE', str(defaults.pop('grayscale', 'auto'))).lower()
+        if grayscale in ('1', 'true', 'yes'):
+            grayscale = True
+        elif grayscale in ('0', 'false', 'no'):
+            grayscale = False
+        else:
+            grayscale = 'auto'
+
+        return cls(
+            max_side=int(os.getenv('VISION_MAX_SIDE', defaults.pop('max_side', 1600))),
+            output_format=os.getenv('VISION_IMAGE_FORMAT', defaults.pop('output_format', 'jpeg')).lower(),
+            quality=int(os.getenv('VISION_IMAGE_QUALITY', defaults.pop('quality', 85))),
+            grayscale=grayscale,
+            max_decode_pixels=int(os.getenv('VISION_MAX_DECODE_PIXELS',
+                                            defaults.pop('max_decode_pixels', 40_000_000))),
+            **defaults
+        )
+
+    def _is_monochrome(self, image):
+        """Проверяет по насыщенности, что цвет не несет информации"""
+        small = cv2.resize(image, (64, 64), interpolation=cv2.INTER_AREA)
+        saturation = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)[:, :, 1]
+        return float(saturation.mean()) < self.saturation_threshold
+
+    def _encode(self, image):
+        """Кодирует изображение в выбранный формат"""
+        if self.output_format == 'webp':
+            ok, buffer = cv2.imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+            return ok, buffer, 'image/webp'
+        ok, buffer = cv2.imencode('.jpg', image, [
+            cv2.IMWRITE_JPEG_QUALITY, self.quality,
+            cv2.IMWRITE_JPEG_OPTIMIZE, 1
+        ])
+        return ok, buffer, 'image/jpeg'
+
+    def _read(self, image_path, stats):
+        """Декодирует изображение, по возможности сразу уменьшенным; None - не читается"""
+        size = image_dimensions(image_path)
+        # Уменьшенное чтение работает только для JPEG; остальные декодируются целиком
+        is_jpeg = Path(image_path).suffix.lower() in ('.jpg', '.jpeg')
+        factor = 1
+        if size:
+            stats['original_size'] = tuple(size)
+            longest = max(size)
+            # Наибольший коэффициент, при котором сторона остается не меньше max_side
+            for candidate in (8, 4, 2) if is_jpeg else ():
+                if longest // candidate >= self.max_side:
+                    factor = candidate
+                    break
+            if size[0] * size[1] // (factor * factor) > self.max_decode_pixels:
+                raise ImageTooLargeError(
+                    f"Image is too large to decode: {size[0]}x{size[1]}"
+                )
+
+        if factor > 1:
+            stats['decode_factor'] = factor
+            # imread применяет EXIF-ориентацию и для уменьшенного чтения
+            return cv2.imread(str(image_path), REDUCED_READ_FLAGS[factor])
+        # imread применяет EXIF-ориентацию (в отличие от IMREAD_IGNORE_ORIENTATION)
+        return cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+
+    def prepare_source(self, image_path):
+        """Возвращает (ImageSource, статистика): перекодированное фото или исходный файл"""
+        original_bytes = os.path.getsize(image_path)
+        fallback_type = MEDIA_TYPES.get(Path(image_path).suffix.lower(), 'image/jpeg')
+        stats = {'original_bytes': original_bytes, 'resized': False, 'grayscale': False}
+
+        image = self._read(image_path, stats)
+        if image is None:
+            # Например GIF - OpenCV его не читает, отправляем как есть (с диска, потоково)
+            stats.update(sent_bytes=original_bytes, saved_bytes=0, reencoded=False)
+            return ImageSource(fallback_type, path=str(image_path)), stats
+
+        height, width = image.shape[:2]
+        stats.setdefault('original_size', (width, height))
+        longest = max(height, width)
+        if longest > self.max_side:
+            scale = self.max_side / longest
+            image = cv2.resize(image, (round(width * scale), round(height * scale)),
+                               interpolation=cv2.INTER_AREA)
+            stats['resized'] = True
+        elif stats.get('decode_factor'):
+            stats['resized'] = True
+
+        if self.grayscale is True or (self.grayscale == 'auto' and self._is_monochrome(image)):
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            stats['grayscale'] = True
+
+        ok, buffer, media_type = self._encode(image)
+        if not ok or (len(buffer) >= original_bytes and not stats['resized']):
+            # Перекодирование не дало выигрыша - оставляем оригинал
+            stats.update(sent_bytes=original_bytes, saved_bytes=0, reencoded=False)
+            return ImageSource(fallback_type, path=str(image_path)), stats
+
+        data = buffer.tobytes()
+        stats['sent_size'] = (image.shape[1], image.shape[0])
+        stats.update(sent_bytes=len(data), saved_bytes=original_bytes - len(data), reencoded=True)
+        return ImageSource(media_type, data=data), stats
+
+    def prepare(self, image_path):
+        """Возвращает (байты, media type, статистика) для отправки в API"""
+        source, stats = self.prepare_source(image_path)
+        if source.data is not None:
+            return source.data, source.media_type, stats
+        with open(source.path, 'rb') as image_file:
+            return image_file.read(), source.media_type, stats
+
+    def to_data_uri(self, image_path):
+        """Возвращает (data URI для image_url, статистика)"""
+        source, stats = self.prepare_source(image_path)
+        return source.to_uri(), stats
@@ -0,0 +1,410 @@
+"""
+Надежная очередь фоновых задач на SQLite и пул потоков-обработчиков
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from db_connection import ConnectionManager
+from metrics import JOB_LATENCY, JOB_WORKERS, JOB_WORKERS_BUSY
+from migrations import migrate
+
+# Миграции jobs.db: индекс в списке + 1 = версия схемы
+JOBS_MIGRATIONS = [
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress TEXT,
+            result TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            heartbeat_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)',
+    ],
+    [
+        # Пакеты задач (массовый импорт): отчет собирается по задачам пакета
+        '''
+        CREATE TABLE IF NOT EXISTS job_batches (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            rejected TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'ALTER TABLE jobs ADD COLUMN batch_id TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id)',
+    ],
+]
+
+
+class JobError(Exception):
+    """Ошибка выполнения задачи, сообщение которой попадает в поле error"""
+
+
+class JobQueue:
+    """Очередь задач, хранящаяся в SQLite и переживающая перезапуск процесса"""
+
+    def __init__(self, db_path, stale_after=300, max_attempts=3, batch_concurrency=None):
+        self.db = ConnectionManager(db_path)
+        # Сколько задач одного пакета (массовый импорт) выполняется одновременно во всех
+        # процессах: остальные обработчики свободны для одиночных загрузок; None - без лимита
+        self.batch_concurrency = batch_concurrency
+        # Задача в статусе running без heartbeat дольше stale_after секунд
+        # считается брошенной (процесс-обработчик упал) и возвращается в очередь
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        # Пока задача выполняется, heartbeat обновляется фоновым потоком: один запрос к API
+        # с повторами может идти дольше stale_after, и без этого задачу выполнили бы дважды
+        self.heartbeat_interval = stale_after / 5
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._heartbeat_thread = None
+        # Будит обработчики этого процесса сразу после enqueue
+        self.wakeup = threading.Event()
+        self.init_database()
+
+    def init_database(self):
+        """Создает таблицу задач (применяет недостающие миграции)"""
+        migrate(self.db.connection, JOBS_MIGRATIONS)
+
+    def enqueue(self, kind, payload, wake=True):
+        """Ставит задачу в очередь и возвращает ее id (wake=False - не будить обработчики процесса)"""
+        job_id = uuid.uuid4().hex
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                'INSERT INTO jobs (id, kind, payload) VALUES (?, ?, ?)',
+                (job_id, kind, json.dumps(payload, ensure_ascii=False))
+            )
+        if wake:
+            self.wakeup.set()
+        return job_id
+
+    def enqueue_batch(self, kind, payloads, rejected=()):
+        """Ставит пакет задач одной транзакцией и возвращает id пакета.
+
+        rejected - записи, не ставшие задачами (попадают в отчет пакета как есть).
+        """
+        batch_id = uuid.uuid4().hex
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                'INSERT INTO job_batches (id, kind, rejected) VALUES (?, ?, ?)',
+                (batch_id, kind, json.dumps(list(rejected), ensure_ascii=False))
+            )
+            cursor.executemany(
+                'INSERT INTO jobs (id, kind, payload, batch_id) VALUES (?, ?, ?, ?)',
+                [(uuid.uuid4().hex, kind, json.dumps(payload, ensure_ascii=False), batch_id)
+                 for payload in payloads]
+            )
+        self.wakeup.set()
+        return batch_id
+
+    def get_batch(self, batch_id):
+        """Пакет и состояние его задач (с payload) или None"""
+        row = self.db.execute(
+            'SELECT id, kind, rejected, created_at FROM job_batches WHERE id = ?', (batch_id,)
+        ).fetchone()
+        if not row:
+            return None
+        jobs = self.db.execute('''
+            SELECT id, status, payload, result, error, finished_at FROM jobs
+            WHERE batch_id = ? ORDER BY rowid
+        ''', (batch_id,)).fetchall()
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'rejected': json.loads(row[2] or '[]'),
+            'created_at': row[3],
+            'jobs': [{
+                'id': job[0],
+                'status': job[1],
+                'payload': json.loads(job[2] or 'null'),
+                'result': json.loads(job[3]) if job[3] else None,
+                'error': job[4],
+                'finished_at': job[5]
+            } for job in jobs]
+        }
+
+    def claim(self, worker_name):
+        """Забирает следующую задачу из очереди или возвращает None"""
+        with self.db.transaction() as cursor:
+            self._recover_stale(cursor)
+            if self.batch_concurrency is None:
+                cursor.execute('''
+                    SELECT id, kind, payload FROM jobs
+                    WHERE status = 'queued'
+                    ORDER BY rowid
+                    LIMIT 1
+                ''')
+            else:
+                # Выбор и пометка в одной транзакции BEGIN IMMEDIATE: лимит общий для процессов
+                cursor.execute('''
+                    SELECT id, kind, payload FROM jobs
+                    WHERE status = 'queued'
+                      AND (batch_id IS NULL OR (
+                          SELECT COUNT(*) FROM jobs AS running
+                          WHERE running.batch_id = jobs.batch_id AND running.status = 'running'
+                      ) < ?)
+                    ORDER BY rowid
+                    LIMIT 1
+                ''', (self.batch_concurrency,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            self._mark_running(cursor, row[0], worker_name)
+        return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2] or 'null')}
+
+    def claim_job(self, job_id, worker_name):
+        """Забирает конкретную задачу, если она еще в очереди; иначе None"""
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                "SELECT id, kind, payload FROM jobs WHERE id = ? AND status = 'queued'", (job_id,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return None
+            self._mark_running(cursor, job_id, worker_name)
+        return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2] or 'null')}
+
+    def _mark_running(self, cursor, job_id, worker_name):
+        cursor.execute('''
+            UPDATE jobs
+            SET status = 'running', worker = ?, attempts = attempts + 1,
+                started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (worker_name, job_id))
+
+    def _recover_stale(self, cursor):
+        """Возвращает в очередь задачи упавших обработчиков"""
+        cutoff = f'-{int(self.stale_after)} seconds'
+        cursor.execute('''
+            UPDATE jobs SET status = 'failed', error = 'Worker lost',
+                            finished_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND heartbeat_at < datetime('now', ?)
+              AND attempts >= ?
+        ''', (cutoff, self.max_attempts))
+        cursor.execute('''
+            UPDATE jobs SET status = 'queued', worker = NULL
+            WHERE status = 'running' AND heartbeat_at < datetime('now', ?)
+        ''', (cutoff,))
+
+    @contextmanager
+    def running(self, job_id):
+        """Поддерживает heartbeat задачи, пока выполняется блок"""
+        with self._running_lock:
+            self._running.add(job_id)
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(
+                    target=self._heartbeat_loop, name='job-heartbeat', daemon=True
+                )
+                self._heartbeat_thread.start()
+        try:
+            yield
+        finally:
+            with self._running_lock:
+                self._running.discard(job_id)
+
+    def heartbeat(self, job_ids):
+        """Отмечает, что задачи еще выполняются"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        with self.db.transaction() as cursor:
+            cursor.execute(f'''
+                UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP
+                WHERE status = 'running' AND id IN ({', '.join('?' * len(job_ids))})
+            ''', job_ids)
+
+    def _heartbeat_loop(self):
+        """Фоновый поток: heartbeat всех выполняемых в процессе задач"""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._running_lock:
+                job_ids = list(self._running)
+            try:
+                self.heartbeat(job_ids)
+            except Exception as e:
+                print(f"Job heartbeat error: {e}")
+
+    def set_progress(self, job_id, progress):
+        """Обновляет этап выполнения задачи (и heartbeat)"""
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE jobs SET progress = ?, heartbeat_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (progress, job_id))
+
+    def complete(self, job_id, result):
+        """Помечает задачу выполненной"""
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE jobs SET status = 'done', progress = 'done', result = ?,
+                                finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (json.dumps(result, ensure_ascii=False), job_id))
+
+    def fail(self, job_id, error):
+        """Помечает задачу завершенной с ошибкой"""
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE jobs SET status = 'failed', error = ?,
+                                finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (str(error), job_id))
+
+    def get(self, job_id):
+        """Возвращает состояние задачи или None"""
+        row = self.db.execute('''
+            SELECT id, kind, status, progress, result, error, attempts,
+                   created_at, started_at, finished_at
+            FROM jobs WHERE id = ?
+        ''', (job_id,)).fetchone()
+        if not row:
+            return None
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'status': row[2],
+            'progress': row[3],
+            'result': json.loads(row[4]) if row[4] else None,
+            'error': row[5],
+            'attempts': row[6],
+            'created_at': row[7],
+            'started_at': row[8],
+            'finished_at': row[9]
+        }
+
+    def pending_payload_values(self, key):
+        """Значения поля key в payload задач, которые еще не завершены (queued/running)"""
+        rows = self.db.execute(
+            "SELECT payload FROM jobs WHERE status IN ('queued', 'running')"
+        ).fetchall()
+        values = set()
+        for (payload,) in rows:
+            payload = json.loads(payload or 'null')
+            if isinstance(payload, dict) and payload.get(key) is not None:
+                values.add(payload[key])
+        return values
+
+    def status_counts(self):
+        """Число задач по статусам (для метрик)"""
+        rows = self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict(rows)
+
+    def purge_finished(self, older_than_days=7):
+        """Удаляет старые завершенные задачи"""
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM jobs
+                WHERE status IN ('done', 'failed')
+                  AND finished_at < datetime('now', ?)
+            ''', (f'-{int(older_than_days)} days',))
+            deleted = cursor.rowcount
+            cursor.execute('''
+                DELETE FROM job_batches
+                WHERE created_at < datetime('now', ?)
+                  AND NOT EXISTS (SELECT 1 FROM jobs WHERE jobs.batch_id = job_batches.id)
+            ''', (f'-{int(older_than_days)} days',))
+            return deleted
+
+
+class JobWorkerPool:
+    """Пул потоков, выполняющих задачи из JobQueue"""
+
+    def __init__(self, queue, handlers, size=2, poll_interval=1.0):
+        self.queue = queue
+        # kind -> handler(payload, progress) -> result
+        self.handlers = handlers
+        self.size = size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Запускает потоки-обработчики в фоне"""
+        self.queue.purge_finished()
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for i in range(self.size):
+            thread = threading.Thread(
+                target=self._run, args=(f"{prefix}:{i}",),
+                name=f"job-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        JOB_WORKERS.inc(self.size)
+
+    def stop(self, timeout=None):
+        """Останавливает обработчики после текущих задач"""
+        self._stop.set()
+        self.queue.wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        JOB_WORKERS.dec(len(self._threads))
+        self._threads = []
+
+    def run_forever(self):
+        """Запускает пул и блокирует текущий поток (для отдельного процесса worker)"""
+        self.start()
+        try:
+            while not self._stop.is_set():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _run(self, worker_name):
+        """Цикл одного обработчика"""
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(worker_name)
+            except Exception as e:
+                print(f"Job queue error: {e}")
+                job = None
+
+            if job is None:
+                self.queue.wakeup.wait(self.poll_interval)
+                self.queue.wakeup.clear()
+                continue
+
+            self._execute(job)
+
+    def _execute(self, job):
+        """Выполняет одну задачу и сохраняет результат"""
+        handler = self.handlers.get(job['kind'])
+        if handler is None:
+            self.queue.fail(job['id'], f"Unknown job kind: {job['kind']}")
+            return
+
+        def progress(stage):
+            self.queue.set_progress(job['id'], stage)
+
+        JOB_WORKERS_BUSY.inc()
+        started = time.perf_counter()
+        outcome = 'failed'
+        try:
+            with self.queue.running(job['id']):
+                result = handler(job['payload'], progress)
+        except JobError as e:
+            self.queue.fail(job['id'], e)
+        except Exception as e:
+            print(f"Job {job['id']} failed: {e}")
+            self.queue.fail(job['id'], e)
+        else:
+            outcome = 'done'
+            self.queue.complete(job['id'], result)
+        finally:
+            JOB_WORKERS_BUSY.dec()
+            JOB_LATENCY.labels(job['kind'], outcome).observe(time.perf_counter() - started)
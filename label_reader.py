@@ -0,0 +1,285 @@
+"""
+Локальное распознавание номера הוראה на этикетке средствами OpenCV (без API)
+"""
+
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from image_preprocess import image_dimensions
+
+DIGIT_SIZE = 20
+FONTS = [
+    cv2.FONT_HERSHEY_SIMPLEX,
+    cv2.FONT_HERSHEY_DUPLEX,
+    cv2.FONT_HERSHEY_COMPLEX,
+    cv2.FONT_HERSHEY_TRIPLEX,
+    cv2.FONT_HERSHEY_PLAIN,
+]
+
+# Уменьшенное декодирование JPEG сразу в серый: libjpeg отдает 1/2, 1/4 или 1/8 пикселей
+REDUCED_GRAY_FLAGS = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def normalize_digit(binary_crop):
+    """Приводит вырезанную цифру (белое на черном) к квадрату DIGIT_SIZE x DIGIT_SIZE"""
+    height, width = binary_crop.shape[:2]
+    side = max(height, width)
+    square = np.zeros((side, side), dtype=np.uint8)
+    y = (side - height) // 2
+    x = (side - width) // 2
+    square[y:y + height, x:x + width] = binary_crop
+    # Поле по краям, как у шаблонов
+    square = cv2.copyMakeBorder(square, 2, 2, 2, 2, cv2.BORDER_CONSTANT, value=0)
+    digit = cv2.resize(square, (DIGIT_SIZE, DIGIT_SIZE), interpolation=cv2.INTER_AREA)
+    return digit.astype(np.float32).reshape(-1) / 255.0
+
+
+def render_digit_templates():
+    """Генерирует синтетические шаблоны цифр шрифтами Hershey"""
+    samples, labels = [], []
+    for digit in range(10):
+        for font in FONTS:
+            for thickness in (2, 4, 6):
+                canvas = np.zeros((120, 100), dtype=np.uint8)
+                cv2.putText(canvas, str(digit), (10, 100), font, 3, 255, thickness)
+                ys, xs = np.nonzero(canvas)
+                crop = canvas[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+                samples.append(normalize_digit(crop))
+                labels.append(digit)
+    return samples, labels
+
+
+def load_digit_templates(templates_dir):
+    """Загружает шаблоны с настоящих этикеток: <цифра>/*.png или <цифра>_*.png"""
+    samples, labels = [], []
+    for path in sorted(Path(templates_dir).rglob('*')):
+        if path.suffix.lower() not in ('.png', '.jpg', '.jpeg'):
+            continue
+        name = path.parent.name if path.parent.name.isdigit() else path.name[0]
+        if not name.isdigit():
+            continue
+        image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            continue
+        _, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+        samples.append(normalize_digit(binary))
+        labels.append(int(name))
+    return samples, labels
+
+
+def parse_field(value):
+    """Разбирает LOCAL_OCR_FIELD 'x,y,w,h' (доли этикетки от 0 до 1) или None"""
+    try:
+        field = tuple(float(part) for part in value.split(','))
+    except ValueError:
+        return None
+    if len(field) != 4 or not all(0 <= part <= 1 for part in field) or 0 in field[2:]:
+        return None
+    return field
+
+
+class LocalLabelReader:
+    """Находит этикетку, бинаризует ее, сегментирует цифры и классифицирует их k-NN"""
+
+    def __init__(self, templates_dir=None, min_confidence=0.9, min_digits=3, k=3,
+                 max_side=1200, max_decode_pixels=40_000_000, field=(0.0, 0.0, 1.0, 1.0)):
+        # Поле номера הוראה на этикетке: (x, y, ширина, высота) в долях прямоугольника этикетки
+        self.field = field
+        self.min_confidence = min_confidence
+        self.min_digits = min_digits
+        self.k = k
+        self.max_side = max_side
+        # Тот же потолок памяти на декодирование, что у ImagePreprocessor
+        self.max_decode_pixels = max_decode_pixels
+
+        samples, labels = render_digit_templates()
+        # Число шаблонов с настоящих этикеток: без них точность на реальных фото не проверена
+        self.real_templates = 0
+        if templates_dir and os.path.isdir(templates_dir):
+            real_samples, real_labels = load_digit_templates(templates_dir)
+            samples += real_samples
+            labels += real_labels
+            self.real_templates = len(real_samples)
+
+        self.knn = cv2.ml.KNearest_create()
+        self.knn.train(
+            np.array(samples, dtype=np.float32),
+            cv2.ml.ROW_SAMPLE,
+            np.array(labels, dtype=np.float32).reshape(-1, 1)
+        )
+
+    @classmethod
+    def from_env(cls):
+        """Создает распознаватель по переменным окружения или None, если он выключен.
+
+        Включается явно (LOCAL_OCR_ENABLED=1) и только с откалиброванными настройками:
+        полем номера LOCAL_OCR_FIELD и шаблонами цифр с настоящих этикеток.
+        """
+        if os.getenv('LOCAL_OCR_ENABLED', '0').lower() not in ('1', 'true', 'yes'):
+            return None
+        field = parse_field(os.getenv('LOCAL_OCR_FIELD', ''))
+        if field is None:
+            print("Local OCR disabled: LOCAL_OCR_FIELD is not set (x,y,w,h of the label)")
+            return None
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        reader = cls(
+            templates_dir=os.getenv('LOCAL_OCR_TEMPLATES', os.path.join(base_dir, 'label_templates')),
+            min_confidence=float(os.getenv('LOCAL_OCR_MIN_CONFIDENCE', 0.9)),
+            max_decode_pixels=int(os.getenv('VISION_MAX_DECODE_PIXELS', 40_000_000)),
+            field=field
+        )
+        if reader.real_templates == 0:
+            print("Local OCR disabled: no digit templates from real labels in LOCAL_OCR_TEMPLATES")
+            return None
+        return reader
+
+    def _find_label_regions(self, gray):
+        """Ищет светлые прямоугольные области (этикетки); весь кадр - если этикетка не найдена
+        (снимок вплотную)"""
+        height, width = gray.shape
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        _, bright = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+        contours, _ = cv2.findContours(bright, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        regions = []
+        for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+            if cv2.contourArea(contour) < 0.02 * height * width:
+                break
+            approx = cv2.approxPolyDP(contour, 0.03 * cv2.arcLength(contour, True), True)
+            if len(approx) == 4:
+                regions.append(cv2.boundingRect(approx))
+        return regions or [(0, 0, width, height)]
+
+    def _field_region(self, x, y, w, h):
+        """Прямоугольник поля номера внутри этикетки"""
+        fx, fy, fw, fh = self.field
+        return (x + round(fx * w), y + round(fy * h),
+                max(1, round(fw * w)), max(1, round(fh * h)))
+
+    def _segment_digits(self, region):
+        """Возвращает единственную строку символов поля: список (x, y, w, h, бинарная маска)"""
+        binary = cv2.adaptiveThreshold(
+            region, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 31, 15
+        )
+        binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+
+        region_height = region.shape[0]
+        candidates = []
+        for i in range(1, count):
+            x, y, w, h, area = stats[i]
+            if h < 0.08 * region_height or h > 0.9 * region_height:
+                continue
+            if not 0.15 <= w / h <= 1.0 or area < 0.15 * w * h:
+                continue
+            candidates.append((x, y, w, h))
+
+        # Группируем в строки: близкий центр по y и похожая высота
+        lines = []
+        for box in sorted(candidates, key=lambda b: b[0]):
+            center = box[1] + box[3] / 2
+            for line in lines:
+                ref = line[-1]
+                if (abs(center - (ref[1] + ref[3] / 2)) < 0.4 * ref[3]
+                        and 0.7 < box[3] / ref[3] < 1.4
+                        and box[0] - (ref[0] + ref[2]) < 1.5 * ref[3]):
+                    line.append(box)
+                    break
+            else:
+                lines.append([box])
+
+        lines = [line for line in lines if len(line) >= self.min_digits]
+        # В поле номера должна быть ровно одна строка цифр, иначе поле выбрано неверно
+        if len(lines) != 1:
+            return []
+        return [(x, y, w, h, binary[y:y + h, x:x + w]) for x, y, w, h in lines[0]]
+
+    def _classify(self, boxes):
+        """Классифицирует цифры; уверенность - доля согласных соседей с учетом расстояния"""
+        samples = np.array([normalize_digit(mask) for *_, mask in boxes], dtype=np.float32)
+        _, results, neighbours, distances = self.knn.findNearest(samples, self.k)
+
+        digits, scores = [], []
+        for result, neighbour, distance in zip(results, neighbours, distances):
+            label = int(result[0])
+            agreement = float(np.mean(neighbour == label))
+            closeness = float(np.exp(-distance.min() / (DIGIT_SIZE * DIGIT_SIZE * 0.1)))
+            digits.append(str(label))
+            scores.append(agreement * closeness)
+        return ''.join(digits), min(scores)
+
+    def _read_gray(self, image_path):
+        """Декодирует фото в серый, JPEG - сразу уменьшенным; None - не читается или слишком велико"""
+        try:
+            size = image_dimensions(image_path)
+        except OSError:
+            return None
+        if size is None:
+            return None
+        longest = max(size)
+        factor = 1
+        for candidate in (8, 4, 2):
+            if longest // candidate >= self.max_side:
+                factor = candidate
+                break
+        # Уменьшенное чтение работает только для JPEG; остальные декодируются целиком
+        if Path(image_path).suffix.lower() not in ('.jpg', '.jpeg'):
+            factor = 1
+        if size[0] * size[1] // (factor * factor) > self.max_decode_pixels:
+            # Такое фото отклонит и подготовка для API - локально его не читаем
+            return None
+        if factor > 1:
+            return cv2.imread(str(image_path), REDUCED_GRAY_FLAGS[factor])
+        return cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+
+    def read(self, image_path):
+        """Пытается прочитать номер; возвращает dict в формате ответа API или None"""
+        gray = self._read_gray(image_path)
+        if gray is None:
+            return None
+
+        longest = max(gray.shape)
+        if longest > self.max_side:
+            scale = self.max_side / longest
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        best = None
+        for label in self._find_label_regions(gray):
+            x, y, w, h = self._field_region(*label)
+            boxes = self._segment_digits(gray[y:y + h, x:x + w])
+            if len(boxes) < self.min_digits:
+                continue
+            number, score = self._classify(boxes)
+            if best is None or score > best['score']:
+                best = {
+                    'hora_number': number,
+                    'score': round(score, 3),
+                    'location': f"label field at x={x}, y={y}, {w}x{h}"
+                }
+
+        if best is None:
+            return None
+
+        if best['score'] >= 0.95:
+            best['confidence'] = 'high'
+        elif best['score'] >= 0.8:
+            best['confidence'] = 'medium'
+        else:
+            best['confidence'] = 'low'
+        best['additional_info'] = 'local OpenCV recognizer'
+        best['source'] = 'local'
+        return best
+
+    def read_confident(self, image_path):
+        """Возвращает результат только если уверенность не ниже порога"""
+        result = self.read(image_path)
+        if result and result['score'] >= self.min_confidence:
+            return result
+        return None
@@ -0,0 +1,136 @@
+"""
+Метрики Prometheus: задержки маршрутов, методов LoadLockManager и vision API, очередь задач
+
+С несколькими процессами gunicorn метрики пишутся в общую папку PROMETHEUS_MULTIPROC_DIR
+(multiprocess-режим prometheus_client, см. gunicorn.conf.py), и /metrics любого процесса
+отдает сумму по всем. Запись метрики - счетчик в памяти или mmap-файле, без блокировок БД.
+"""
+
+import functools
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess, REGISTRY)
+from prometheus_client.core import GaugeMetricFamily
+
+# Быстрые ответы API (мс) и долгие распознавания (десятки секунд)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+UPLOAD_BUCKETS = tuple(1024 * kb for kb in (64, 256, 512, 1024, 2048, 4096, 8192, 16384))
+
+HTTP_LATENCY = Histogram(
+    'loadlock_http_request_duration_seconds', 'Время обработки запроса',
+    ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+HTTP_IN_PROGRESS = Gauge(
+    'loadlock_http_requests_in_progress', 'Запросы в обработке',
+    multiprocess_mode='livesum'
+)
+MANAGER_LATENCY = Histogram(
+    'loadlock_manager_call_duration_seconds', 'Время методов LoadLockManager',
+    ['method'], buckets=LATENCY_BUCKETS
+)
+VISION_LATENCY = Histogram(
+    'loadlock_vision_request_duration_seconds', 'Время одного запроса к vision API (попытки)',
+    ['status'], buckets=LATENCY_BUCKETS
+)
+VISION_REQUESTS = Counter(
+    'loadlock_vision_requests_total', 'Запросы к vision API по коду ответа (error - нет ответа)',
+    ['status']
+)
+VISION_TOKENS = Counter(
+    'loadlock_vision_tokens_total', 'Токены vision API', ['kind']
+)
+VISION_BATCH_IMAGES = Histogram(
+    'loadlock_vision_batch_images', 'Фото в одном пакетном запросе к vision API',
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16)
+)
+VISION_BATCH_FALLBACKS = Counter(
+    'loadlock_vision_batch_fallbacks_total', 'Фото, переспрошенные одиночным запросом после пакета'
+)
+UPLOAD_BYTES = Histogram(
+    'loadlock_upload_bytes', 'Размер загруженных фото', ['endpoint'], buckets=UPLOAD_BUCKETS
+)
+JOB_LATENCY = Histogram(
+    'loadlock_job_duration_seconds', 'Время выполнения фоновой задачи',
+    ['kind', 'result'], buckets=LATENCY_BUCKETS
+)
+JOB_WORKERS = Gauge(
+    'loadlock_job_workers', 'Потоки-обработчики очереди', multiprocess_mode='livesum'
+)
+JOB_WORKERS_BUSY = Gauge(
+    'loadlock_job_workers_busy', 'Обработчики, выполняющие задачу', multiprocess_mode='livesum'
+)
+
+
+def multiprocess_enabled():
+    return bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+
+def observe_vision_response(status, seconds, usage=None):
+    """Учитывает одну попытку запроса к vision API"""
+    status = str(status)
+    VISION_LATENCY.labels(status).observe(seconds)
+    VISION_REQUESTS.labels(status).inc()
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if usage and usage.get(kind):
+            VISION_TOKENS.labels(kind.split('_')[0]).inc(usage[kind])
+
+
+def timed_method(name, func):
+    """Оборачивает метод: время вызова попадает в MANAGER_LATENCY"""
+    histogram = MANAGER_LATENCY.labels(name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+
+def instrument_methods(cls, exclude=()):
+    """Замеряет время всех публичных методов класса"""
+    for name, value in list(vars(cls).items()):
+        if callable(value) and not name.startswith('_') and name not in exclude:
+            setattr(cls, name, timed_method(name, value))
+    return cls
+
+
+class QueueCollector:
+    """Глубина очереди по статусам задач; считается при каждом чтении /metrics"""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def collect(self):
+        family = GaugeMetricFamily('loadlock_jobs', 'Задачи в очереди по статусам', labels=['status'])
+        counts = self.queue.status_counts()
+        for status in ('queued', 'running', 'done', 'failed'):
+            family.add_metric([status], counts.get(status, 0))
+        yield family
+
+
+class MetricsExporter:
+    """Формирует ответ /metrics для одного процесса или для всех процессов gunicorn"""
+
+    def __init__(self, queue=None):
+        if multiprocess_enabled():
+            self.registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(self.registry)
+        else:
+            self.registry = REGISTRY
+        if queue is not None:
+            self.registry.register(QueueCollector(queue))
+
+    def render(self):
+        """Текст в формате Prometheus и его Content-Type"""
+        return generate_latest(self.registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Убирает live-метрики завершившегося процесса gunicorn (хук child_exit)"""
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
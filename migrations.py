@@ -0,0 +1,29 @@
+"""
+Версионные миграции схемы SQLite по PRAGMA user_version
+"""
+
+
+def migrate(conn, migrations):
+    """Применяет недостающие миграции и возвращает версию схемы.
+
+    migrations - список миграций, каждая - список SQL-команд; версия схемы
+    равна числу примененных миграций. Если схема актуальна, DDL не выполняется.
+    """
+    target = len(migrations)
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= target:
+        return target
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Повторная проверка под блокировкой: другой процесс мог успеть раньше
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        for statements in migrations[current:]:
+            for sql in statements:
+                conn.execute(sql)
+        # user_version меняется в той же транзакции, что и DDL
+        conn.execute(f'PRAGMA user_version = {max(current, target)}')
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return target
@@ -0,0 +1,233 @@
+"""
+Профилирование отдельных запросов: заголовок Server-Timing по фазам и выборочный
+статистический профайлер со стеками в формате flame graph (folded stacks)
+
+Настройки читаются из окружения при старте и меняются на лету через output/profiling.json
+(его пишет /api/admin/profiling) - файл общий для всех процессов gunicorn.
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+
+# Фазы запроса в порядке вывода в Server-Timing
+PHASES = ('db', 'vision', 'encode', 'ingest', 'serialize')
+
+_timings = ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def phase(name):
+    """Добавляет время блока к фазе текущего запроса (вне запроса ничего не делает)"""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] += time.perf_counter() - start
+
+
+def fold_stack(frame):
+    """Стек в виде 'внешняя;...;внутренняя функция' (формат flamegraph.pl и speedscope)"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """Фоновый поток, снимающий стеки потоков профилируемых запросов с интервалом interval"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # thread_id -> (Counter стеков, с какого момента снимать)
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id, delay=0.0):
+        """Начинает собирать стеки потока через delay секунд (до этого запрос ничего не стоит)"""
+        with self._lock:
+            self._active[thread_id] = (Counter(), time.monotonic() + delay)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, thread_id):
+        """Заканчивает сбор и возвращает Counter стеков потока"""
+        with self._lock:
+            stacks, _ = self._active.pop(thread_id, (Counter(), None))
+            return stacks
+
+    def _run(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                due = [thread_id for thread_id, (_, start_at) in self._active.items()
+                       if start_at <= now]
+                next_start = min((start_at for _, start_at in self._active.values()), default=None)
+            if not due:
+                # Спим до первого порога или до нового запроса
+                self._wakeup.wait(None if next_start is None else next_start - now)
+                self._wakeup.clear()
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id in due:
+                    entry = self._active.get(thread_id)
+                    frame = frames.get(thread_id)
+                    if entry is not None and frame is not None:
+                        entry[0][fold_stack(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+class ProfilingSettings:
+    """Настройки профилирования: окружение по умолчанию, файл - изменения на лету"""
+
+    def __init__(self, path, server_timing=False, sample_rate=0.0, slow_ms=0.0, reload_interval=1.0):
+        self.path = Path(path)
+        self.defaults = {'server_timing': server_timing, 'sample_rate': sample_rate, 'slow_ms': slow_ms}
+        self.values = dict(self.defaults)
+        self.reload_interval = reload_interval
+        self._checked_at = 0.0
+        self._mtime = None
+
+    @classmethod
+    def from_env(cls, path):
+        """Создает настройки из PROFILING_SERVER_TIMING, PROFILING_SAMPLE_RATE, PROFILING_SLOW_MS"""
+        return cls(
+            path,
+            server_timing=os.getenv('PROFILING_SERVER_TIMING', '0') == '1',
+            sample_rate=float(os.getenv('PROFILING_SAMPLE_RATE', 0)),
+            slow_ms=float(os.getenv('PROFILING_SLOW_MS', 0))
+        )
+
+    def current(self):
+        """Текущие настройки; файл проверяется не чаще раза в reload_interval секунд"""
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            try:
+                mtime = self.path.stat().st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self.values = dict(self.defaults)
+                if mtime is not None:
+                    try:
+                        self.values.update(self._validate(json.loads(self.path.read_text())))
+                    except (ValueError, OSError) as e:
+                        print(f"Profiling settings error: {e}")
+        return self.values
+
+    def _validate(self, data):
+        """Проверяет и приводит типы; ValueError при неверных значениях"""
+        if not isinstance(data, dict):
+            raise ValueError('Settings must be an object')
+        unknown = set(data) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+        values = {}
+        if 'server_timing' in data:
+            values['server_timing'] = bool(data['server_timing'])
+        if 'sample_rate' in data:
+            values['sample_rate'] = float(data['sample_rate'])
+            if not 0 <= values['sample_rate'] <= 1:
+                raise ValueError('sample_rate must be between 0 and 1')
+        if 'slow_ms' in data:
+            values['slow_ms'] = max(0.0, float(data['slow_ms']))
+        return values
+
+    def update(self, data):
+        """Сохраняет изменения в файл (видят все процессы) и возвращает новые настройки"""
+        values = dict(self.current())
+        values.update(self._validate(data))
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        tmp_path.write_text(json.dumps(values))
+        os.replace(tmp_path, self.path)
+        self._checked_at = 0.0
+        return self.current()
+
+    def reset(self):
+        """Возвращает настройки из окружения"""
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        self._checked_at = 0.0
+        return self.current()
+
+
+class RequestProfiler:
+    """Фазы и профиль одного запроса: begin() в начале, finish() в конце"""
+
+    def __init__(self, settings, profile_dir, sampler=None):
+        self.settings = settings
+        self.profile_dir = Path(profile_dir)
+        self.sampler = sampler or StackSampler()
+
+    def begin(self):
+        """Возвращает состояние запроса или None, если профилирование выключено"""
+        settings = self.settings.current()
+        sampled = random.random() < settings['sample_rate']
+        # Медленный запрос заранее не узнать: остальные запросы только регистрируются,
+        # а стеки с них снимаются, если запрос дошел до порога slow_ms
+        profiled = sampled or settings['slow_ms'] > 0
+        if not (settings['server_timing'] or profiled):
+            return None
+        state = {
+            'timings': defaultdict(float),
+            'server_timing': settings['server_timing'],
+            'sampled': sampled,
+            'slow_ms': settings['slow_ms'],
+            'thread_id': threading.get_ident() if profiled else None,
+        }
+        state['token'] = _timings.set(state['timings'])
+        if profiled:
+            delay = 0.0 if sampled else settings['slow_ms'] / 1000
+            self.sampler.start(state['thread_id'], delay=delay)
+        return state
+
+    def finish(self, state, elapsed, response=None, name='request'):
+        """Добавляет Server-Timing к ответу и сохраняет профиль, если запрос выбран или медленный"""
+        if state.get('finished'):
+            return None
+        state['finished'] = True
+        _timings.reset(state['token'])
+        if response is not None and state['server_timing']:
+            parts = [f"{key};dur={state['timings'][key] * 1000:.1f}"
+                     for key in PHASES if key in state['timings']]
+            parts.append(f"total;dur={elapsed * 1000:.1f}")
+            response.headers['Server-Timing'] = ', '.join(parts)
+        if state['thread_id'] is None:
+            return None
+        stacks = self.sampler.stop(state['thread_id'])
+        slow = state['slow_ms'] > 0 and elapsed * 1000 >= state['slow_ms']
+        if stacks and (state['sampled'] or slow):
+            return self.write_profile(stacks, name, elapsed)
+        return None
+
+    def write_profile(self, stacks, name, elapsed):
+        """Пишет стеки в output/profiles/<время>_<имя>_<мс>ms.folded"""
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        path = self.profile_dir / f"{stamp}_{name}_{elapsed * 1000:.0f}ms.folded"
+        path.write_text(''.join(f"{stack} {count}\n" for stack, count in stacks.most_common()))
+        return path
@@ -0,0 +1,121 @@
+"""
+Постоянный кэш результатов распознавания по хэшу содержимого изображения
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from db_connection import ConnectionManager
+from migrations import migrate
+
+# Промпт распознавания номера הוראה - общий для app.py и hora_scanner.py: он входит в ключ
+# кэша, и веб-приложение с консольным сканером пользуются одними записями
+HORA_PROMPT = """You are a specialist in recognizing machine instruction numbers (מספר הוראה) in vacuum chamber systems.
+
+Analyze this image carefully and extract the "מספר הוראה" (instruction number) - this is usually a number on a label/tag on the machine.
+Return ONLY a JSON object with this exact structure:
+{
+    "hora_number": "THE NUMBER YOU FOUND (e.g., 12345 or H-12345)",
+    "confidence": "high/medium/low",
+    "location": "where on the image the number is located",
+    "additional_info": "any other visible text or identifiers"
+}
+
+If you cannot find a clear instruction number, still return JSON with "hora_number": "NOT_FOUND" and explain why in "additional_info"."""
+
+# Миграции кэша: индекс в списке + 1 = версия схемы
+CACHE_MIGRATIONS = [
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS recognition_cache (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_recognition_cache_last_used ON recognition_cache(last_used)',
+    ],
+]
+
+
+class RecognitionCache:
+    """Кэш распознанных номеров הוראה с TTL и LRU-вытеснением"""
+
+    def __init__(self, db_path, ttl_seconds=30 * 24 * 3600, max_entries=10000):
+        self.db = ConnectionManager(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.init_database()
+
+    @classmethod
+    def from_env(cls, default_path):
+        """Создает кэш с настройками из переменных окружения"""
+        return cls(
+            os.getenv('RECOGNITION_CACHE_PATH') or default_path,
+            ttl_seconds=int(os.getenv('RECOGNITION_CACHE_TTL', 30 * 24 * 3600)),
+            max_entries=int(os.getenv('RECOGNITION_CACHE_MAX_ENTRIES', 10000))
+        )
+
+    def init_database(self):
+        """Создает таблицу кэша (применяет недостающие миграции)"""
+        migrate(self.db.connection, CACHE_MIGRATIONS)
+
+    @staticmethod
+    def file_hash(image_path):
+        """SHA-256 содержимого файла (читается кусками)"""
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as image_file:
+            for chunk in iter(lambda: image_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def make_key(cls, image_path, prompt, model, content_hash=None):
+        """Считает ключ: SHA-256 байтов изображения + промпт + модель.
+
+        content_hash - уже посчитанный при приеме загрузки SHA-256 файла,
+        чтобы не читать файл еще раз.
+        """
+        digest = hashlib.sha256((content_hash or cls.file_hash(image_path)).encode('ascii'))
+        digest.update(b'\0' + model.encode('utf-8'))
+        digest.update(b'\0' + prompt.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Возвращает сохраненный результат или None"""
+        row = self.db.execute(
+            'SELECT data, created_at FROM recognition_cache WHERE key = ?', (key,)
+        ).fetchone()
+        if not row:
+            return None
+
+        now = time.time()
+        with self.db.transaction() as cursor:
+            if now - row[1] > self.ttl_seconds:
+                cursor.execute('DELETE FROM recognition_cache WHERE key = ?', (key,))
+                return None
+            cursor.execute(
+                'UPDATE recognition_cache SET last_used = ? WHERE key = ?', (now, key)
+            )
+        return json.loads(row[0])
+
+    def put(self, key, data):
+        """Сохраняет результат и вытесняет самые давно использованные записи"""
+        now = time.time()
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO recognition_cache (key, data, created_at, last_used)
+                VALUES (?, ?, ?, ?)
+            ''', (key, json.dumps(data, ensure_ascii=False), now, now))
+
+            cursor.execute('SELECT COUNT(*) FROM recognition_cache')
+            overflow = cursor.fetchone()[0] - self.max_entries
+            if overflow > 0:
+                cursor.execute('''
+                    DELETE FROM recognition_cache WHERE key IN (
+                        SELECT key FROM recognition_cache ORDER BY last_used LIMIT ?
+                    )
+                ''', (overflow,))
@@ -0,0 +1,147 @@
+"""
+Потоковый экспорт таблиц SQLite в CSV и JSONL: курсор читается порциями, память не зависит
+от размера таблицы
+"""
+
+import csv
+import io
+import json
+import sqlite3
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+# date_column - для фильтра from/to, order_column - порядок выгрузки,
+# headers - заголовки CSV (по умолчанию имена столбцов)
+ExportSpec = namedtuple('ExportSpec', 'sql columns date_column order_column headers')
+
+EXPORT_SPECS = {
+    'loadlocks': ExportSpec(
+        'SELECT id, hora_number, name, status, current_sample, date_added, last_updated, '
+        'status_since, image_path, notes FROM loadlocks',
+        ('id', 'hora_number', 'name', 'status', 'current_sample', 'date_added', 'last_updated',
+         'status_since', 'image_path', 'notes'),
+        'date_added', 'id', None
+    ),
+    'status_history': ExportSpec(
+        'SELECT h.id, h.loadlock_id, l.hora_number, h.old_status, h.new_status, h.timestamp, h.notes '
+        'FROM status_history h LEFT JOIN loadlocks l ON l.id = h.loadlock_id',
+        ('id', 'loadlock_id', 'hora_number', 'old_status', 'new_status', 'timestamp', 'notes'),
+        'h.timestamp', 'h.id', None
+    ),
+    'samples': ExportSpec(
+        'SELECT s.id, s.loadlock_id, l.hora_number, s.sample_name, s.material, s.date_added, s.notes '
+        'FROM samples s LEFT JOIN loadlocks l ON l.id = s.loadlock_id',
+        ('id', 'loadlock_id', 'hora_number', 'sample_name', 'material', 'date_added', 'notes'),
+        's.date_added', 's.id', None
+    ),
+    'machines': ExportSpec(
+        'SELECT id, hora_number, date_added, image_path, status, notes FROM machines',
+        ('id', 'hora_number', 'date_added', 'image_path', 'status', 'notes'),
+        'date_added', 'id',
+        # Заголовки прежнего экспорта hora_scanner.py
+        ('ID', 'Номер הוראה', 'Дата добавления', 'Путь изображения', 'Статус', 'Примечания')
+    ),
+}
+
+# Порция строк из курсора и размер куска ответа
+FETCH_ROWS = 500
+CHUNK_CHARS = 64 * 1024
+
+
+def parse_date_range(date_from=None, date_to=None):
+    """Границы [since, until) в формате хранения 'YYYY-MM-DD HH:MM:SS' (None - без границы).
+
+    Обе границы включительно: дата без времени в date_to включает весь день, время - всю
+    секунду (в базе бывают доли секунды). ValueError при неверном формате.
+    """
+    since = until = None
+    if date_from:
+        since = datetime.fromisoformat(date_from).strftime('%Y-%m-%d %H:%M:%S')
+    if date_to:
+        moment = datetime.fromisoformat(date_to)
+        step = timedelta(days=1) if len(date_to) <= 10 else timedelta(seconds=1)
+        until = (moment.replace(microsecond=0) + step).strftime('%Y-%m-%d %H:%M:%S')
+    return since, until
+
+
+def build_query(spec, since=None, until=None):
+    """SQL и параметры выборки с фильтром по дате"""
+    conditions, params = [], []
+    if since:
+        conditions.append(f'{spec.date_column} >= ?')
+        params.append(since)
+    if until:
+        conditions.append(f'{spec.date_column} < ?')
+        params.append(until)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f'{spec.sql}{where} ORDER BY {spec.order_column}', params
+
+
+def iter_rows(db_path, sql, params=(), fetch_rows=FETCH_ROWS):
+    """Строки запроса порциями; отдельное соединение только для чтения держит один снимок БД"""
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, isolation_level=None)
+    try:
+        conn.execute('BEGIN')
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(fetch_rows)
+            if not rows:
+                break
+            yield from rows
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def iter_csv(header, rows):
+    """CSV с экранированием кавычек, запятых и переводов строк; куски до CHUNK_CHARS"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM: Excel иначе открывает иврит и кириллицу не в той кодировке
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_CHARS:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl(columns, rows):
+    """Одна JSON-строка на запись; куски до CHUNK_CHARS"""
+    chunk = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_CHARS:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def export_table(db_path, table, fmt='csv', since=None, until=None):
+    """Генератор кусков текста экспорта таблицы table в формате fmt"""
+    spec = EXPORT_SPECS[table]
+    sql, params = build_query(spec, since, until)
+    rows = iter_rows(db_path, sql, params)
+    if fmt == 'jsonl':
+        return iter_jsonl(spec.columns, rows)
+    return iter_csv(spec.headers or spec.columns, rows)
+
+
+def write_export(path, chunks):
+    """Пишет экспорт в файл; возвращает путь"""
+    with open(path, 'w', encoding='utf-8', newline='') as output:
+        for chunk in chunks:
+            output.write(chunk)
+    return path
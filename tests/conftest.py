@@ -0,0 +1,50 @@
+"""
+Общие фикстуры тестов: app.py импортируется один раз, данные - во временной папке
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# app.py читает окружение при импорте: отдельная папка данных, без фоновых обработчиков
+DATA_DIR = tempfile.mkdtemp(prefix='loadlock-tests-')
+os.environ['LOADLOCK_DATA_DIR'] = DATA_DIR
+os.environ['OPENAI_API_KEY'] = 'test'
+os.environ['UPLOAD_WORKERS'] = '0'
+os.environ['LOCAL_OCR_ENABLED'] = '0'
+os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def app_module():
+    """Модуль app.py (импортируется при первом обращении)"""
+    import app
+    return app
+
+
+@pytest.fixture
+def manager(app_module, tmp_path, monkeypatch):
+    """Отдельный LoadLockManager с пустой базой, подставленный в маршруты app.py"""
+    monkeypatch.setattr(app_module, 'OUTPUT_DIR', str(tmp_path))
+    loadlock = app_module.LoadLockManager()
+    monkeypatch.setattr(app_module, 'manager', loadlock)
+    yield loadlock
+    loadlock.db.close()
+    loadlock.cache.db.close()
+
+
+@pytest.fixture
+def client(app_module, manager):
+    """Тестовый клиент Flask для manager"""
+    return app_module.app.test_client()
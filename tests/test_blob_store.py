@@ -0,0 +1,173 @@
+"""
+Хранилище фото по содержимому: дедупликация, ссылки из баз и сборка мусора
+"""
+
+import os
+import sqlite3
+import time
+
+import pytest
+
+from blob_store import BlobStore, ImageReferences
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+def write_image(path, body):
+    """PNG-сигнатура + body: формат определяется, содержимое различается"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(PNG + body)
+    return path
+
+
+def make_old(path, seconds=48 * 3600):
+    """Сдвигает mtime в прошлое - объект старше периода ожидания"""
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(tmp_path / 'objects')
+
+
+def test_same_content_is_stored_once(store, tmp_path):
+    """Одинаковые файлы - один объект; копия оставляет исходник, перенос - убирает"""
+    first = write_image(tmp_path / 'a.jpg', b'same')
+    second = write_image(tmp_path / 'b.png', b'same')
+
+    copied = store.put_path(first)
+    moved = store.put_path(second, move=True)
+
+    assert copied == moved
+    assert copied.endswith('.png')
+    assert first.exists() and not second.exists()
+    assert store.size() == (1, len(PNG) + 4)
+    assert store.contains(copied) and not store.contains(first)
+
+
+def test_sweep_removes_only_old_unreferenced_objects(store, tmp_path):
+    """Сборка мусора: без ссылок и старше периода ожидания - удаляется, остальное - нет"""
+    kept = store.put_path(write_image(tmp_path / 'kept.png', b'kept'))
+    orphan = store.put_path(write_image(tmp_path / 'orphan.png', b'orphan'))
+    young = store.put_path(write_image(tmp_path / 'young.png', b'young'))
+    for path in (kept, orphan):
+        make_old(path)
+
+    assert store.sweep([kept], min_age_seconds=3600, dry_run=True) == (1, len(PNG) + 6)
+    assert os.path.exists(orphan)
+
+    assert store.sweep([kept], min_age_seconds=3600) == (1, len(PNG) + 6)
+    assert not os.path.exists(orphan)
+    assert os.path.exists(kept) and os.path.exists(young)
+
+
+def test_sweep_compares_resolved_paths(store, tmp_path):
+    """Ссылка через другой, но равный путь тоже защищает объект"""
+    path = store.put_path(write_image(tmp_path / 'a.png', b'a'))
+    make_old(path)
+    relative = os.path.relpath(path)
+
+    assert store.sweep([relative], min_age_seconds=0) == (0, 0)
+    assert os.path.exists(path)
+
+
+def test_reupload_extends_grace_period(store, tmp_path):
+    """Повторная загрузка того же фото продлевает жизнь объекта без ссылок"""
+    path = store.put_path(write_image(tmp_path / 'a.png', b'a'))
+    make_old(path)
+    store.put_path(write_image(tmp_path / 'again.png', b'a'), move=True)
+
+    assert store.sweep([], min_age_seconds=3600) == (0, 0)
+
+
+def test_sweep_removes_stale_temporary_copies(store):
+    """Брошенные временные файлы копирования удаляются после периода ожидания"""
+    temporary = store.root / '.put_abandoned'
+    temporary.write_bytes(b'partial')
+    make_old(temporary)
+
+    store.sweep([], min_age_seconds=3600)
+    assert not temporary.exists()
+
+
+def test_references_span_databases(tmp_path):
+    """Счетчик ссылок и замена пути - по всем базам; отсутствующая база пропускается"""
+    loadlock_db = tmp_path / 'loadlock.db'
+    machines_db = tmp_path / 'machines.db'
+    for db_path, table in ((loadlock_db, 'loadlocks'), (machines_db, 'machines')):
+        conn = sqlite3.connect(db_path)
+        conn.execute(f'CREATE TABLE {table} (id INTEGER PRIMARY KEY, image_path TEXT)')
+        conn.executemany(f'INSERT INTO {table} (image_path) VALUES (?)',
+                         [('shared.png',), ('',), (None,)])
+        conn.commit()
+        conn.close()
+    references = ImageReferences([
+        (loadlock_db, 'loadlocks', 'image_path'),
+        (machines_db, 'machines', 'image_path'),
+        (tmp_path / 'missing.db', 'loadlocks', 'image_path'),
+    ])
+
+    assert references.counts() == {'shared.png': 2}
+    assert references.rewrite('shared.png', 'objects/ab/cd/abcd.png') == 2
+    assert references.counts() == {'objects/ab/cd/abcd.png': 2}
+
+
+@pytest.fixture
+def data_dirs(app_module, manager, tmp_path, monkeypatch):
+    """Папки uploads/, хранилище, ссылки и очередь app.py - во временной папке"""
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    store = BlobStore(uploads / 'objects')
+    queue = app_module.JobQueue(tmp_path / 'jobs.db')
+    monkeypatch.setattr(app_module, 'UPLOAD_FOLDER', str(uploads))
+    monkeypatch.setattr(app_module, 'upload_store', store)
+    monkeypatch.setattr(app_module, 'job_queue', queue)
+    monkeypatch.setattr(app_module, 'image_references', app_module.ImageReferences([
+        (tmp_path / 'loadlock.db', 'loadlocks', 'image_path'),
+    ]))
+    yield uploads, store, queue
+    queue.db.close()
+
+
+def test_migration_moves_legacy_files_and_rewrites_paths(app_module, manager, data_dirs):
+    """Файлы старой раскладки uploads/ переносятся в хранилище, пути в базе заменяются"""
+    uploads, store, _ = data_dirs
+    legacy = write_image(uploads / 'photo.png', b'legacy')
+    _, loadlock_id = manager.add_loadlock('900', image_path=str(legacy))
+    duplicate = write_image(uploads / 'copy.png', b'legacy')
+
+    migrated, duplicates, reclaimed, skipped = app_module.migrate_legacy_uploads()
+
+    assert (migrated, duplicates, skipped) == (2, 1, 0)
+    assert reclaimed == len(PNG) + 6
+    assert not legacy.exists() and not duplicate.exists()
+    image_path = manager.get_loadlock_image(loadlock_id)[0]
+    assert store.contains(image_path) and os.path.exists(image_path)
+
+
+def test_migration_and_sweep_leave_queued_job_files(app_module, manager, data_dirs):
+    """Файл, который ждет незавершенная задача распознавания, не переносится и не удаляется"""
+    uploads, store, queue = data_dirs
+    waiting = write_image(uploads / 'waiting.png', b'waiting')
+    running = store.put_path(write_image(uploads / 'running.png', b'running'), move=True)
+    finished = store.put_path(write_image(uploads / 'finished.png', b'finished'), move=True)
+    queue.enqueue('recognize', {'image_path': str(waiting)})
+    queue.enqueue('recognize', {'image_path': running})
+    queue.claim('w1')
+    queue.claim('w1')
+    done_id = queue.enqueue('recognize', {'image_path': finished})
+    queue.claim('w1')
+    queue.complete(done_id, {})
+    for path in (running, finished):
+        make_old(path)
+
+    result = app_module.app.test_cli_runner().invoke(
+        args=['compact-uploads', '--grace-hours', '1', '--ready-days', '0']
+    )
+
+    assert result.exit_code == 0, result.output
+    assert 'skipped (queued):     1' in result.output
+    assert waiting.exists()
+    assert os.path.exists(running)
+    assert not os.path.exists(finished)
@@ -0,0 +1,189 @@
+"""
+Массовый импорт: отчет пакета, лимит одновременных задач импорта, разбор ZIP
+"""
+
+import io
+import struct
+import zipfile
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from blob_store import BlobStore
+from bulk_import import BulkImporter, batch_report
+from job_queue import JobQueue
+
+
+def job(status, finished_at=None, result=None, error=None, name='a.jpg'):
+    return {'id': name, 'status': status, 'payload': {'file': name},
+            'result': result, 'error': error, 'finished_at': finished_at}
+
+
+def test_report_throughput_of_finished_batch():
+    """Время - до последней завершенной задачи, файлов в минуту - по завершенным"""
+    batch = {
+        'id': 'b1', 'created_at': '2026-01-01 10:00:00',
+        'rejected': [{'file': 'x.txt', 'status': 'failed', 'error': 'Unsupported file format'}],
+        'jobs': [
+            job('done', '2026-01-01 10:00:20', {'success': True, 'hora_number': '1'}),
+            job('done', '2026-01-01 10:00:30', {'success': False}),
+            job('failed', '2026-01-01 10:00:10', error='Error processing image'),
+        ]
+    }
+    report = batch_report(batch)
+
+    assert report['done'] is True
+    assert report['elapsed_seconds'] == 30
+    assert report['files_per_minute'] == 6.0
+    assert report['summary'] == {'failed': 2, 'recognized': 1, 'not_found': 1}
+    assert report['total_files'] == 4
+
+
+def test_report_of_running_batch_counts_until_now():
+    """Пока пакет идет, время считается до текущего момента"""
+    batch = {
+        'id': 'b1', 'created_at': '2026-01-01 10:00:00', 'rejected': [],
+        'jobs': [job('done', '2026-01-01 10:00:05', {'success': True}), job('running')]
+    }
+    report = batch_report(batch, now=datetime(2026, 1, 1, 10, 1, 0))
+
+    assert report['done'] is False
+    assert report['elapsed_seconds'] == 60
+    assert report['files_per_minute'] == 1.0
+
+
+def test_report_without_jobs():
+    """Пакет только из отклоненных файлов завершен сразу, скорости нет"""
+    batch = {'id': 'b1', 'created_at': '2026-01-01 10:00:00',
+             'rejected': [{'file': 'x', 'status': 'failed'}], 'jobs': []}
+    report = batch_report(batch)
+    assert report['done'] is True
+    assert report['elapsed_seconds'] == 0
+    assert report['files_per_minute'] is None
+
+
+@pytest.fixture
+def queue(tmp_path):
+    job_queue = JobQueue(tmp_path / 'jobs.db', batch_concurrency=2)
+    yield job_queue
+    job_queue.db.close()
+
+
+def test_batch_concurrency_leaves_workers_for_single_uploads(queue):
+    """Задач одного импорта выполняется не больше batch_concurrency, одиночные идут сразу"""
+    batch_id = queue.enqueue_batch('recognize', [{'n': n} for n in range(5)])
+    single = queue.enqueue('recognize', {'single': True})
+
+    claimed = [queue.claim(f'w{n}') for n in range(3)]
+    assert [job['payload'] for job in claimed[:2]] == [{'n': 0}, {'n': 1}]
+    assert claimed[2]['id'] == single
+    assert queue.claim('w3') is None
+
+    queue.complete(claimed[0]['id'], {})
+    assert queue.claim('w4')['payload'] == {'n': 2}
+    statuses = [job['status'] for job in queue.get_batch(batch_id)['jobs']]
+    assert statuses == ['done', 'running', 'running', 'queued', 'queued']
+
+
+def test_batch_limit_is_per_import(queue):
+    """Лимит считается по каждому пакету отдельно"""
+    first = queue.enqueue_batch('recognize', [{'batch': 1}] * 3)
+    second = queue.enqueue_batch('recognize', [{'batch': 2}] * 3)
+
+    payloads = [queue.claim(f'w{n}')['payload'] for n in range(4)]
+    assert payloads == [{'batch': 1}, {'batch': 1}, {'batch': 2}, {'batch': 2}]
+    assert queue.claim('w5') is None
+    assert {job['status'] for job in queue.get_batch(first)['jobs'][2:]} == {'queued'}
+    assert {job['status'] for job in queue.get_batch(second)['jobs'][2:]} == {'queued'}
+
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+def make_zip(members, compression=zipfile.ZIP_STORED):
+    """ZIP в памяти: {имя: содержимое}"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return bytearray(buffer.getvalue())
+
+
+def patch_central_entry(data, name, offset, value):
+    """Меняет 2 байта записи центрального каталога файла name (флаги +8, метод +10)"""
+    encoded = name.encode()
+    position = 0
+    while True:
+        position = data.index(b'PK\x01\x02', position)
+        name_length = struct.unpack_from('<H', data, position + 28)[0]
+        if data[position + 46:position + 46 + name_length] == encoded:
+            struct.pack_into('<H', data, position + offset, value)
+            return data
+        position += 4
+
+
+def upload(name, data):
+    return SimpleNamespace(filename=name, stream=io.BytesIO(bytes(data)))
+
+
+@pytest.fixture
+def importer(tmp_path):
+    (tmp_path / 'uploads').mkdir()
+    return BulkImporter(tmp_path / 'uploads', BlobStore(tmp_path / 'objects'))
+
+
+def rejected_errors(rejected):
+    return {entry['file']: entry['error'] for entry in rejected}
+
+
+def test_bad_zip_members_are_rejected_one_by_one(importer, tmp_path):
+    """Битый, зашифрованный и сжатый неизвестным методом файлы отклоняются, остальные принимаются"""
+    data = make_zip({
+        'good.png': PNG + b'good',
+        'crc.png': PNG + b'crc-mismatch',
+        'encrypted.png': PNG + b'secret',
+        'method.png': PNG + b'method',
+        'notes.txt': b'not an image',
+    })
+    # Порча данных после сжатия: CRC не сходится при дочитывании
+    position = data.index(PNG + b'crc-mismatch')
+    data[position + len(PNG)] ^= 0xFF
+    patch_central_entry(data, 'encrypted.png', 8, 0x1)
+    patch_central_entry(data, 'method.png', 10, 97)
+
+    saved, rejected = importer.save_uploads([upload('photos.zip', data), upload('b.png', PNG + b'b')])
+
+    assert [entry['file'] for entry in saved] == ['good.png', 'b.png']
+    errors = rejected_errors(rejected)
+    assert set(errors) == {'crc.png', 'encrypted.png', 'method.png', 'notes.txt'}
+    assert errors['notes.txt'] == 'Unsupported file format'
+    assert all(errors[name].startswith('Bad ZIP member') for name in
+               ('crc.png', 'encrypted.png', 'method.png'))
+    assert all(entry['status'] == 'failed' for entry in rejected)
+    # Спулы отклоненных файлов удалены, в хранилище - только принятые
+    assert list((tmp_path / 'uploads').iterdir()) == []
+    assert importer.store.size()[0] == 2
+
+
+def test_corrupt_deflate_stream_is_rejected(importer):
+    """Поврежденный поток deflate (zlib.error) - ошибка одного файла, а не всего запроса"""
+    payload = PNG + bytes(range(256)) * 64
+    data = make_zip({'a.png': payload, 'b.png': PNG + b'fine'}, zipfile.ZIP_DEFLATED)
+    header = data.index(b'PK\x03\x04')
+    name_length, extra_length = struct.unpack_from('<HH', data, header + 26)
+    start = header + 30 + name_length + extra_length
+    for offset in range(2, 40):
+        data[start + offset] ^= 0x55
+
+    saved, rejected = importer.save_uploads([upload('photos.zip', data)])
+
+    assert [entry['file'] for entry in saved] == ['b.png']
+    assert list(rejected_errors(rejected)) == ['a.png']
+
+
+def test_unreadable_archive_is_rejected(importer):
+    """Не-ZIP с расширением .zip - одна запись отчета"""
+    saved, rejected = importer.save_uploads([upload('photos.zip', b'not a zip')])
+    assert saved == []
+    assert rejected_errors(rejected) == {'photos.zip': 'Bad ZIP archive'}
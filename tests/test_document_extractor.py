@@ -0,0 +1,82 @@
+"""
+document_extractor.py: фото больше лимита декодирования в одиночном и пакетном режимах
+"""
+
+import os
+import struct
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+import document_extractor as document_extractor_module
+from document_batch import BatchManifest, BatchRunner
+from document_extractor import DocumentExtractor
+
+
+class FakeVision:
+    """Вместо клиента vision API: запоминает запросы, отвечает JSON"""
+
+    def __init__(self):
+        self.calls = 0
+        self.stats = {'retries': 0}
+
+    def complete(self, content, max_tokens=500, model='gpt-4o'):
+        self.calls += 1
+        return '{"document_type": "label"}'
+
+
+def write_huge_png(path, width=20000, height=20000):
+    """Только заголовок PNG с огромными размерами - до декодирования дело не доходит"""
+    path.write_bytes(b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR'
+                     + struct.pack('>II', width, height) + b'\x08\x02\x00\x00\x00')
+    return path
+
+
+@pytest.fixture
+def extractor(tmp_path, monkeypatch):
+    monkeypatch.setenv('DOCUMENT_OUTPUT_DIR', str(tmp_path / 'output'))
+    monkeypatch.setenv('VISION_MAX_DECODE_PIXELS', '1000000')
+    document_extractor = DocumentExtractor()
+    document_extractor.vision = FakeVision()
+    return document_extractor
+
+
+def test_oversized_photo_is_reported_not_raised(extractor, tmp_path, capsys):
+    """extract_data печатает причину и возвращает None, запроса к API нет"""
+    path = write_huge_png(tmp_path / 'huge.png')
+
+    assert extractor.extract_data(str(path)) is None
+    assert 'Изображение слишком большое' in capsys.readouterr().out
+    assert extractor.vision.calls == 0
+
+
+def test_batch_records_oversized_photo_as_failed(extractor, tmp_path):
+    """В пакете такой файл - failed в манифесте, остальные файлы обрабатываются"""
+    folder = tmp_path / 'scans'
+    folder.mkdir()
+    write_huge_png(folder / 'huge.png')
+    cv2.imwrite(str(folder / 'page.png'), np.full((40, 60, 3), 255, dtype=np.uint8))
+    manifest = BatchManifest(tmp_path / 'manifest.db')
+    runner = BatchRunner(extractor, manifest, workers=2, retry_delay=0)
+
+    stats = runner.run(str(folder))
+
+    assert (stats['done'], stats['failed'], stats['retries']) == (1, 1, 0)
+    status, attempts, _, error = manifest.get(runner.hashes[str(folder / 'huge.png')],
+                                              runner.prompt_key)
+    assert (status, attempts) == ('failed', 1)
+    assert 'too large' in error
+    assert extractor.vision.calls == 1
+    manifest.close()
+
+
+def test_output_dir_defaults_next_to_script(monkeypatch):
+    """Без DOCUMENT_OUTPUT_DIR результаты - в output/ рядом с document_extractor.py"""
+    monkeypatch.delenv('DOCUMENT_OUTPUT_DIR', raising=False)
+    # Папку в дереве репозитория не создаем
+    monkeypatch.setattr(Path, 'mkdir', lambda self, **kwargs: None)
+
+    script_dir = os.path.dirname(os.path.abspath(document_extractor_module.__file__))
+    assert DocumentExtractor().output_dir == Path(script_dir) / 'output'
@@ -0,0 +1,18 @@
+"""
+hora_scanner.py: та же папка данных, что и у app.py
+"""
+
+from pathlib import Path
+
+from hora_scanner import MachineNumberExtractor
+
+
+def test_scanner_uses_app_data_dir(app_module):
+    """Под LOADLOCK_DATA_DIR (задан в conftest.py) output/ и хранилище фото - те же, что у app.py"""
+    extractor = MachineNumberExtractor()
+    try:
+        assert extractor.output_dir == Path(app_module.OUTPUT_DIR)
+        assert extractor.db_path.exists()
+        assert extractor.store.root == app_module.upload_store.root
+    finally:
+        extractor.cache.db.close()
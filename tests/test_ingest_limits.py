@@ -0,0 +1,107 @@
+"""
+Лимиты приема фото: потоковый предел размера, формат по сигнатуре, потолок пикселей декодирования
+"""
+
+import io
+import struct
+
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from image_preprocess import ImagePreprocessor, ImageTooLargeError
+from upload_ingest import HashingSpool
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+def png_header(width, height):
+    """Только сигнатура и IHDR: размеры читаются, декодировать нечего"""
+    return PNG + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', width, height) + b'\x08\x02\x00\x00\x00'
+
+
+def jpeg_header(width, height):
+    """SOI и SOF0 с размерами"""
+    return b'\xff\xd8\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 3) + b'\x00' * 6
+
+
+def spool_files(directory):
+    return [path.name for path in directory.iterdir() if path.name.startswith('.ingest_')]
+
+
+def test_spool_stops_at_byte_cap(tmp_path):
+    """Часть сверх max_bytes - RequestEntityTooLarge, недописанный файл удален"""
+    spool = HashingSpool(tmp_path, max_bytes=10)
+    spool.write(b'123456')
+    spool.write(b'7890')
+
+    with pytest.raises(RequestEntityTooLarge):
+        spool.write(b'x')
+    assert spool_files(tmp_path) == []
+
+
+def test_spool_sniffs_format_across_chunks(tmp_path):
+    """Сигнатура собирается из мелких частей; размер и хэш - по всему телу"""
+    spool = HashingSpool(tmp_path)
+    for byte in PNG + b'body':
+        spool.write(bytes([byte]))
+    spool.close()
+
+    assert spool.extension == '.png'
+    assert spool.size == len(PNG) + 4
+    spool.discard()
+
+
+@pytest.mark.parametrize('data', [b'<html>not a photo</html>', b'%PDF-1.7', b''])
+def test_spool_rejects_unknown_signature(tmp_path, data):
+    spool = HashingSpool(tmp_path)
+    spool.write(data)
+    assert spool.extension is None
+    spool.discard()
+
+
+def test_upload_with_image_name_but_text_content_is_rejected(app_module, client):
+    """Формат определяется по байтам, а не по имени; отклоненный файл не остается на диске"""
+    response = client.post('/api/upload', data={'file': (io.BytesIO(b'just text'), 'photo.jpg')})
+
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Unsupported file format'
+    assert spool_files(app_module.Path(app_module.app.config['UPLOAD_FOLDER'])) == []
+
+
+def test_upload_over_size_limit_is_413(app_module, client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'MAX_CONTENT_LENGTH', 1024)
+    response = client.post('/api/upload', data={'file': (io.BytesIO(PNG + b'x' * 4096), 'a.png')})
+
+    assert response.status_code == 413
+    assert spool_files(app_module.Path(app_module.app.config['UPLOAD_FOLDER'])) == []
+
+
+@pytest.fixture
+def preprocessor(monkeypatch):
+    monkeypatch.setenv('VISION_MAX_DECODE_PIXELS', '5000000')
+    return ImagePreprocessor.from_env(max_side=1024)
+
+
+def test_decode_ceiling_from_env(preprocessor, tmp_path):
+    """VISION_MAX_DECODE_PIXELS: больше - ImageTooLargeError до декодирования"""
+    path = tmp_path / 'huge.png'
+    path.write_bytes(png_header(3000, 2000))
+
+    assert preprocessor.max_decode_pixels == 5_000_000
+    with pytest.raises(ImageTooLargeError, match='3000x2000'):
+        preprocessor.prepare_source(str(path))
+
+
+def test_decode_ceiling_counts_reduced_jpeg_read(preprocessor, tmp_path):
+    """JPEG читается уменьшенным, поэтому лимит - на пиксели после уменьшения; PNG - целиком"""
+    jpeg = tmp_path / 'big.jpg'
+    jpeg.write_bytes(jpeg_header(4000, 4000))
+    png = tmp_path / 'big.png'
+    png.write_bytes(png_header(4000, 4000))
+
+    # 4000x4000 / 2^2 = 4 млн пикселей - в пределах; заголовок без данных не декодируется
+    source, stats = preprocessor.prepare_source(str(jpeg))
+    assert stats['original_size'] == (4000, 4000)
+    assert source.path == str(jpeg)
+    with pytest.raises(ImageTooLargeError):
+        preprocessor.prepare_source(str(png))
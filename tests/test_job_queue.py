@@ -0,0 +1,120 @@
+"""
+Очередь задач: возврат брошенных задач, heartbeat и лимит попыток
+"""
+
+import time
+
+import pytest
+
+from job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    job_queue = JobQueue(tmp_path / 'jobs.db', stale_after=60, max_attempts=2)
+    yield job_queue
+    job_queue.db.close()
+
+
+def age_heartbeat(queue, job_id, seconds):
+    """Сдвигает heartbeat задачи в прошлое - как будто обработчик молчит seconds секунд"""
+    with queue.db.transaction() as cursor:
+        cursor.execute(
+            "UPDATE jobs SET heartbeat_at = datetime('now', ?) WHERE id = ?",
+            (f'-{int(seconds)} seconds', job_id)
+        )
+
+
+def test_running_job_with_fresh_heartbeat_is_not_reclaimed(queue):
+    """Задачу с живым heartbeat другой обработчик не забирает"""
+    job_id = queue.enqueue('recognize', {'image_path': 'a.jpg'})
+    assert queue.claim('w1')['id'] == job_id
+    assert queue.claim('w2') is None
+    assert queue.get(job_id)['status'] == 'running'
+
+
+def test_stale_job_is_requeued_and_claimed_again(queue):
+    """Задача упавшего обработчика возвращается в очередь и выполняется снова"""
+    job_id = queue.enqueue('recognize', {'image_path': 'a.jpg'})
+    queue.claim('w1')
+    age_heartbeat(queue, job_id, 120)
+
+    job = queue.claim('w2')
+    assert job == {'id': job_id, 'kind': 'recognize', 'payload': {'image_path': 'a.jpg'}}
+    state = queue.get(job_id)
+    assert state['status'] == 'running'
+    assert state['attempts'] == 2
+
+
+def test_stale_job_fails_after_max_attempts(queue):
+    """После max_attempts брошенная задача завершается ошибкой, а не крутится вечно"""
+    job_id = queue.enqueue('recognize', {})
+    for worker in ('w1', 'w2'):
+        assert queue.claim(worker)['id'] == job_id
+        age_heartbeat(queue, job_id, 120)
+
+    assert queue.claim('w3') is None
+    state = queue.get(job_id)
+    assert state['status'] == 'failed'
+    assert state['error'] == 'Worker lost'
+    assert state['finished_at'] is not None
+
+
+def test_heartbeat_keeps_job_running(queue):
+    """heartbeat обновляет задачу, и ее не считают брошенной"""
+    job_id = queue.enqueue('recognize', {})
+    queue.claim('w1')
+    age_heartbeat(queue, job_id, 120)
+    queue.heartbeat([job_id])
+
+    assert queue.claim('w2') is None
+    assert queue.get(job_id)['attempts'] == 1
+
+
+def test_running_block_sends_heartbeats(tmp_path):
+    """Пока выполняется блок running(), фоновый поток обновляет heartbeat сам"""
+    queue = JobQueue(tmp_path / 'jobs.db', stale_after=1)
+    job_id = queue.enqueue('recognize', {})
+    queue.claim('w1')
+
+    def heartbeat_fresh():
+        return queue.db.execute(
+            "SELECT heartbeat_at >= datetime('now', '-1 seconds') FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()[0]
+
+    with queue.running(job_id):
+        age_heartbeat(queue, job_id, 120)
+        deadline = time.monotonic() + 5
+        while not heartbeat_fresh() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert queue.claim('w2') is None
+    assert queue.get(job_id)['attempts'] == 1
+
+
+def test_claim_job_takes_only_queued_job(queue):
+    """claim_job забирает конкретную задачу один раз"""
+    first = queue.enqueue('recognize', {'n': 1})
+    second = queue.enqueue('recognize', {'n': 2})
+
+    assert queue.claim_job(second, 'asgi')['payload'] == {'n': 2}
+    assert queue.claim_job(second, 'asgi') is None
+    assert queue.claim('w1')['id'] == first
+    assert queue.claim('w1') is None
+
+
+def test_complete_and_fail_are_final(queue):
+    """Завершенные задачи не возвращаются в очередь"""
+    done = queue.enqueue('recognize', {})
+    failed = queue.enqueue('recognize', {})
+    queue.claim('w1')
+    queue.claim('w1')
+    queue.complete(done, {'ok': True})
+    queue.fail(failed, 'boom')
+    age_heartbeat(queue, done, 120)
+    age_heartbeat(queue, failed, 120)
+
+    assert queue.claim('w2') is None
+    assert queue.get(done)['result'] == {'ok': True}
+    assert queue.get(failed)['error'] == 'boom'
+    assert queue.status_counts() == {'done': 1, 'failed': 1}
@@ -0,0 +1,84 @@
+"""
+Дельта-синхронизация /api/loadlocks?since=<seq> и ETag
+"""
+
+
+def test_etag_returns_304_until_data_changes(client, manager):
+    """Пока данные не менялись, If-None-Match отвечается 304; после изменения - новый ETag"""
+    manager.add_loadlock('1001', 'LL-1')
+    response = client.get('/api/loadlocks')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+    cached = client.get('/api/loadlocks', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.headers['ETag'] == etag
+
+    manager.add_loadlock('1002', 'LL-2')
+    fresh = client.get('/api/loadlocks', headers={'If-None-Match': etag})
+    assert fresh.status_code == 200
+    assert fresh.headers['ETag'] != etag
+    assert [ll['hora_number'] for ll in fresh.get_json()] == ['1001', '1002']
+
+
+def test_since_returns_only_changes(client, manager):
+    """since=<seq> отдает только измененные после seq LoadLock и удаленные id"""
+    _, first = manager.add_loadlock('2001', 'A')
+    _, second = manager.add_loadlock('2002', 'B')
+    _, third = manager.add_loadlock('2003', 'C')
+    seq = client.get('/api/loadlocks?since=0').get_json()['seq']
+
+    manager.update_status(second, 'working')
+    manager.delete_loadlock(third)
+    body = client.get(f'/api/loadlocks?since={seq}').get_json()
+
+    assert body['reset'] is False
+    assert [ll['id'] for ll in body['changed']] == [second]
+    assert body['changed'][0]['status'] == 'working'
+    assert body['deleted'] == [third]
+    assert body['seq'] > seq
+    assert first not in body['deleted']
+
+
+def test_since_without_changes_is_empty(client, manager):
+    """Повторный опрос с последним seq - пустая дельта того же seq"""
+    manager.add_loadlock('3001', 'A')
+    seq = client.get('/api/loadlocks?since=0').get_json()['seq']
+
+    body = client.get(f'/api/loadlocks?since={seq}').get_json()
+    assert body == {'seq': seq, 'reset': False, 'changed': [], 'deleted': []}
+
+
+def test_repeated_changes_collapse_to_one_entry(client, manager):
+    """Несколько изменений одного LoadLock дают одну строку дельты"""
+    _, loadlock_id = manager.add_loadlock('4001', 'A')
+    seq = client.get('/api/loadlocks?since=0').get_json()['seq']
+    for status in ('working', 'qc', 'ready'):
+        manager.update_status(loadlock_id, status)
+
+    body = client.get(f'/api/loadlocks?since={seq}').get_json()
+    assert [(ll['id'], ll['status']) for ll in body['changed']] == [(loadlock_id, 'ready')]
+
+
+def test_zero_or_future_seq_resets_to_full_list(client, manager):
+    """since=0 и seq больше текущего (база пересоздана) - полный список с reset"""
+    manager.add_loadlock('5001', 'B')
+    manager.add_loadlock('5002', 'A')
+
+    full = client.get('/api/loadlocks?since=0').get_json()
+    assert full['reset'] is True
+    assert [ll['name'] for ll in full['changed']] == ['A', 'B']
+
+    future = client.get(f"/api/loadlocks?since={full['seq'] + 100}").get_json()
+    assert future['reset'] is True
+    assert future['seq'] == full['seq']
+    assert len(future['changed']) == 2
+
+
+def test_delta_etag_matches_seq(client, manager):
+    """ETag дельты совпадает с ETag полного списка при том же seq"""
+    manager.add_loadlock('6001', 'A')
+    body = client.get('/api/loadlocks?since=1')
+    assert body.headers['ETag'] == f'"ll-{body.get_json()["seq"]}"'
+    assert client.get('/api/loadlocks').headers['ETag'] == body.headers['ETag']
@@ -0,0 +1,113 @@
+"""
+Постраничный /api/loadlocks: курсоры по ключу (выражение сортировки, id), фильтры и ошибки
+"""
+
+import pytest
+
+NAMES = ['B', 'A', 'C', 'A', 'B', 'A', 'C']
+
+
+@pytest.fixture
+def loadlocks(manager):
+    """LoadLock с повторяющимися именами - курсор должен различать их по id"""
+    return [manager.add_loadlock(f'{7000 + i}', name)[1] for i, name in enumerate(NAMES)]
+
+
+def fetch_all(client, query):
+    """Проходит все страницы по next_after; список страниц (списков id)"""
+    pages = []
+    url = f'/api/loadlocks?{query}'
+    while True:
+        body = client.get(url).get_json()
+        pages.append([ll['id'] for ll in body['items']])
+        if body['next_after'] is None:
+            return pages, body
+        url = f"/api/loadlocks?{query}&after={body['next_after']}"
+
+
+def test_pages_cover_all_rows_once_in_order(client, loadlocks):
+    """Страницы по 2 без пропусков и повторов, порядок (name, id)"""
+    pages, body = fetch_all(client, 'sort=name&limit=2')
+    expected = [i for _, i in sorted(zip(NAMES, loadlocks))]
+
+    assert [i for page in pages for i in page] == expected
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+    assert body['total'] == len(NAMES)
+
+
+def test_descending_pages(client, loadlocks):
+    """-name: обратный порядок (name, id), тоже без повторов"""
+    pages, _ = fetch_all(client, 'sort=-name&limit=3')
+    expected = [i for _, i in sorted(zip(NAMES, loadlocks), reverse=True)]
+    assert [i for page in pages for i in page] == expected
+
+
+def test_insert_before_cursor_does_not_shift_next_page(client, manager, loadlocks):
+    """Новая строка перед курсором не дает повторов на следующей странице (в отличие от OFFSET)"""
+    first = client.get('/api/loadlocks?sort=name&limit=3').get_json()
+    manager.add_loadlock('7999', '0-first')
+    rest, _ = fetch_all(client, 'sort=name&limit=3')
+    second = client.get(f"/api/loadlocks?sort=name&limit=3&after={first['next_after']}").get_json()
+
+    seen = [ll['id'] for ll in first['items']] + [ll['id'] for ll in second['items']]
+    assert len(seen) == len(set(seen))
+    assert seen == [i for _, i in sorted(zip(NAMES, loadlocks))][:6]
+    assert sum(len(page) for page in rest) == len(NAMES) + 1
+
+
+def test_status_filter_and_counts(client, manager, loadlocks):
+    """Фильтр статуса сужает страницы и total; counts - по всем статусам для вкладок"""
+    for loadlock_id in loadlocks[:3]:
+        manager.update_status(loadlock_id, 'working')
+    pages, body = fetch_all(client, 'status=working&sort=hora_number&limit=2')
+
+    assert [i for page in pages for i in page] == loadlocks[:3]
+    assert body['total'] == 3
+    assert body['counts'] == {'working': 3, 'inserted': 4}
+
+
+def test_prefix_search(client, loadlocks):
+    """q - префикс номера или имени; счетчики учитывают поиск"""
+    body = client.get('/api/loadlocks?q=700&sort=hora_number&limit=3').get_json()
+    assert [ll['hora_number'] for ll in body['items']] == ['7000', '7001', '7002']
+    assert body['total'] == len(NAMES)
+
+    body = client.get('/api/loadlocks?q=C').get_json()
+    assert sorted(ll['id'] for ll in body['items']) == [loadlocks[2], loadlocks[6]]
+    assert body['counts'] == {'inserted': 2}
+
+
+def test_limit_is_clamped(client, loadlocks):
+    """limit приводится к диапазону 1..LOADLOCK_PAGE_MAX"""
+    assert client.get('/api/loadlocks?limit=0').get_json()['limit'] == 1
+    assert client.get('/api/loadlocks?limit=100000').get_json()['limit'] == 500
+    assert client.get('/api/loadlocks?limit=abc').get_json()['limit'] == 100
+
+
+@pytest.mark.parametrize('query, error', [
+    ('after=not-a-cursor', 'Invalid cursor'),
+    ('status=unknown', 'Unknown status: unknown'),
+    ('sort=color', 'Unknown sort'),
+])
+def test_bad_parameters_are_rejected(client, loadlocks, query, error):
+    """Битый курсор, неизвестные статус и сортировка - 400 с описанием"""
+    response = client.get(f'/api/loadlocks?{query}')
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith(error)
+
+
+def test_cursor_from_other_sort_is_rejected(client, loadlocks):
+    """Курсор одной сортировки не подходит к другой, даже к обратной"""
+    cursor = client.get('/api/loadlocks?sort=name&limit=2').get_json()['next_after']
+    for sort in ('hora_number', '-name'):
+        response = client.get(f'/api/loadlocks?sort={sort}&after={cursor}')
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Cursor does not match sort'
+
+
+def test_cursor_round_trip(app_module):
+    """Курсор кодирует сортировку и ключ без потерь, включая не-ASCII"""
+    cursor = app_module.encode_cursor('-name', ('ללא שם', 42))
+    assert app_module.decode_cursor(cursor, '-name') == ('ללא שם', 42)
+    with pytest.raises(ValueError):
+        app_module.decode_cursor(cursor, 'name')
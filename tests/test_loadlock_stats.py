@@ -0,0 +1,115 @@
+"""
+Сводка /api/stats: триггеры миграции 6 и пересчет rebuild_stats
+"""
+
+
+def stats_rows(manager):
+    """loadlock_stats и гистограмма как словари (без нулевых счетчиков)"""
+    stats = {row[0]: (row[1], row[2]) for row in manager.db.execute(
+        'SELECT status, count, transitions FROM loadlock_stats WHERE count != 0 OR transitions != 0'
+    )}
+    histogram = {(row[0], row[1]): row[2] for row in manager.db.execute(
+        'SELECT status, bucket, count FROM loadlock_stats_histogram WHERE count != 0'
+    )}
+    return stats, histogram
+
+
+def set_status_since(manager, loadlock_id, seconds_ago):
+    """Сдвигает момент входа в текущий статус в прошлое"""
+    with manager.db.transaction() as cursor:
+        cursor.execute(
+            "UPDATE loadlocks SET status_since = datetime('now', ?) WHERE id = ?",
+            (f'-{int(seconds_ago)} seconds', loadlock_id)
+        )
+
+
+def test_insert_and_delete_update_counts(manager):
+    """Добавление и удаление LoadLock меняют счетчик статуса в той же транзакции"""
+    results = [manager.add_loadlock(str(n)) for n in range(3)]
+    stats, _ = stats_rows(manager)
+    assert stats == {'inserted': (3, 0)}
+
+    manager.delete_loadlock(results[0][1])
+    stats, _ = stats_rows(manager)
+    assert stats == {'inserted': (2, 0)}
+
+    status_since = manager.db.execute('SELECT status_since FROM loadlocks').fetchall()
+    assert all(row[0] for row in status_since)
+
+
+def test_status_change_moves_count_and_records_interval(manager):
+    """Смена статуса: счетчики переходят, интервал в старом статусе - в сумму и гистограмму"""
+    _, loadlock_id = manager.add_loadlock('100')
+    set_status_since(manager, loadlock_id, 2 * 3600)
+    manager.update_status(loadlock_id, 'working')
+
+    stats = manager.get_stats()
+    assert stats['working']['count'] == 1
+    assert stats['inserted']['count'] == 0
+    assert stats['inserted']['transitions'] == 1
+    assert 7190 <= stats['inserted']['total_seconds'] <= 7210
+    # 2 часа - корзина [1 ч, 4 ч)
+    assert stats['inserted']['histogram'] == [0, 1, 0, 0, 0, 0, 0]
+    assert stats['working']['transitions'] == 0
+
+
+def test_same_status_is_not_a_transition(manager):
+    """Перевод в тот же статус не считается переходом"""
+    _, loadlock_id = manager.add_loadlock('200')
+    manager.update_status(loadlock_id, 'inserted')
+    stats, histogram = stats_rows(manager)
+    assert stats == {'inserted': (1, 0)}
+    assert histogram == {}
+
+
+def test_bulk_update_keeps_counts_consistent(manager):
+    """Массовая смена статуса проходит через те же триггеры"""
+    ids = [manager.add_loadlock(str(300 + n))[1] for n in range(4)]
+    manager.update_status(ids[0], 'working')
+    manager.bulk_update_status('qc', loadlock_ids=ids)
+
+    stats, histogram = stats_rows(manager)
+    assert stats == {'inserted': (0, 4), 'working': (0, 1), 'qc': (4, 0)}
+    assert histogram == {('inserted', 0): 4, ('working', 0): 1}
+
+
+def test_rebuild_matches_triggers(manager):
+    """rebuild_stats из status_history дает те же счетчики и гистограмму, что и триггеры"""
+    ids = [manager.add_loadlock(str(400 + n))[1] for n in range(3)]
+    manager.update_status(ids[0], 'working')
+    manager.update_status(ids[0], 'qc')
+    manager.update_status(ids[1], 'ready')
+    manager.delete_loadlock(ids[2])
+    by_triggers = stats_rows(manager)
+
+    manager.rebuild_stats()
+    assert stats_rows(manager) == by_triggers
+
+
+def test_rebuild_repairs_drift(manager):
+    """Пересчет исправляет сводку, разошедшуюся с данными"""
+    manager.add_loadlock('500')
+    with manager.db.transaction() as cursor:
+        cursor.execute("UPDATE loadlock_stats SET count = 42 WHERE status = 'inserted'")
+        cursor.execute("INSERT INTO loadlock_stats (status, count) VALUES ('ghost', 3)")
+
+    manager.rebuild_stats()
+    stats, _ = stats_rows(manager)
+    assert stats == {'inserted': (1, 0)}
+
+
+def test_stats_endpoint_lists_every_status(client, manager):
+    """/api/stats отдает все статусы, включая пустые, и общее число"""
+    _, loadlock_id = manager.add_loadlock('600')
+    manager.add_loadlock('601')
+    manager.update_status(loadlock_id, 'ready')
+
+    body = client.get('/api/stats').get_json()
+    assert body['total'] == 2
+    assert set(body['statuses']) == {'inserted', 'working', 'missing', 'qc', 'packaging', 'ready'}
+    assert body['statuses']['ready']['count'] == 1
+    assert body['statuses']['missing'] == {
+        'count': 0, 'transitions': 0, 'total_seconds': 0, 'avg_seconds': None,
+        'histogram': [0] * 7, 'status_info': body['statuses']['missing']['status_info']
+    }
+    assert len(body['histogram_buckets']) == 6
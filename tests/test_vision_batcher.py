@@ -0,0 +1,190 @@
+"""
+Микропакеты vision API: разбор ответа пакета, переспрос по одному фото, ошибки пакета
+"""
+
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from vision_batcher import AsyncVisionBatcher, VisionBatcher, parse_batch_response
+from vision_client import VisionAPIError
+
+
+class FakeVision:
+    """Вместо клиента vision API: отвечает на пакет функцией batch_answer, на одно фото - сразу"""
+
+    def __init__(self, batch_answer):
+        self.batch_answer = batch_answer
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def complete(self, content, max_tokens=500, model='gpt-4o'):
+        images = [part['image_url']['url'] for part in content if part['type'] == 'image_url']
+        with self._lock:
+            self.calls.append((images, max_tokens))
+        if len(images) > 1:
+            return self.batch_answer(images)
+        return json.dumps({'hora_number': images[0], 'single': True})
+
+
+def run_together(batcher, images, prompt='prompt'):
+    """Одновременные вызовы complete из потоков; ответы разобраны из JSON"""
+    with ThreadPoolExecutor(len(images)) as pool:
+        answers = list(pool.map(lambda image: batcher.complete(image, prompt), images))
+    return [json.loads(answer) for answer in answers]
+
+
+def batch_calls(vision):
+    return [images for images, _ in vision.calls if len(images) > 1]
+
+
+def test_parse_full_batch_by_index():
+    """Номера из index, порядок в массиве не важен; index убирается из результата"""
+    text = 'Result:\n[{"index": 2, "hora_number": "b"}, {"index": 1, "hora_number": "a"}]'
+    assert parse_batch_response(text, 2) == {1: {'hora_number': 'a'}, 2: {'hora_number': 'b'}}
+
+
+def test_parse_partial_and_unparseable_answers():
+    """Без index номер берется по позиции только при полном массиве; мусор - пустой результат"""
+    assert parse_batch_response('[{"hora_number": "a"}, {"hora_number": "b"}]', 2) == {
+        1: {'hora_number': 'a'}, 2: {'hora_number': 'b'}}
+    assert parse_batch_response('[{"hora_number": "a"}]', 2) == {}
+    assert parse_batch_response('[{"index": 2, "hora_number": "b"}, {"index": 9}, 5]', 3) == {
+        2: {'hora_number': 'b'}}
+    assert parse_batch_response('no json here', 2) == {}
+    assert parse_batch_response('[{"index": 1,', 2) == {}
+    assert parse_batch_response(None, 2) == {}
+
+
+def test_full_batch_is_one_request():
+    """max_batch одновременных фото - один запрос, лимит ответа умножен на число фото"""
+    vision = FakeVision(lambda images: json.dumps(
+        [{'index': n, 'hora_number': image} for n, image in enumerate(images, start=1)]))
+    batcher = VisionBatcher(vision, max_batch=3, window=5, max_tokens=100)
+
+    answers = run_together(batcher, ['a', 'b', 'c'])
+
+    assert answers == [{'hora_number': 'a'}, {'hora_number': 'b'}, {'hora_number': 'c'}]
+    assert len(vision.calls) == 1
+    assert sorted(vision.calls[0][0]) == ['a', 'b', 'c'] and vision.calls[0][1] == 300
+
+
+def test_partial_answer_falls_back_to_single_requests():
+    """Фото без результата в ответе пакета переспрашиваются по одному, остальные - нет"""
+    vision = FakeVision(lambda images: json.dumps([{'index': 1, 'hora_number': images[0]}]))
+    batcher = VisionBatcher(vision, max_batch=2, window=5)
+
+    answers = run_together(batcher, ['a', 'b'])
+
+    batch = batch_calls(vision)[0]
+    assert len(vision.calls) == 2
+    assert {answer['hora_number'] for answer in answers} == {'a', 'b'}
+    assert [answer.get('single', False) for answer in answers] == [image == batch[1] for image in 'ab']
+
+
+def test_unparseable_answer_falls_back_for_every_photo():
+    vision = FakeVision(lambda images: 'Sorry, I cannot help with that.')
+    batcher = VisionBatcher(vision, max_batch=2, window=5)
+
+    answers = run_together(batcher, ['a', 'b'])
+
+    assert answers == [{'hora_number': 'a', 'single': True}, {'hora_number': 'b', 'single': True}]
+    assert len(vision.calls) == 3
+
+
+@pytest.mark.parametrize('status_code', [400, 413])
+def test_too_large_batch_is_split(status_code):
+    """400/413 на пакет - каждое фото отправляется отдельно, ошибки нет"""
+    def reject(images):
+        raise VisionAPIError(f'{status_code} Error', status_code=status_code)
+    vision = FakeVision(reject)
+    batcher = VisionBatcher(vision, max_batch=2, window=5)
+
+    answers = run_together(batcher, ['a', 'b'])
+
+    assert answers == [{'hora_number': 'a', 'single': True}, {'hora_number': 'b', 'single': True}]
+    assert len(vision.calls) == 3
+
+
+def test_other_batch_error_reaches_every_caller():
+    """Прочие ошибки пакета (5xx после повторов) получает каждый ждущий поток"""
+    def fail(images):
+        raise VisionAPIError('503 Error', status_code=503)
+    batcher = VisionBatcher(FakeVision(fail), max_batch=2, window=5)
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(batcher.complete, image, 'prompt') for image in 'ab']
+    for future in futures:
+        with pytest.raises(VisionAPIError):
+            future.result()
+    assert len(batcher.vision.calls) == 1
+
+
+def test_lone_photo_after_window_is_sent_alone():
+    """Одно фото за окно уходит обычным одиночным запросом"""
+    vision = FakeVision(lambda images: pytest.fail('no batch expected'))
+    batcher = VisionBatcher(vision, max_batch=4, window=0.01)
+
+    assert json.loads(batcher.complete('a', 'prompt')) == {'hora_number': 'a', 'single': True}
+    assert vision.calls == [(['a'], 500)]
+
+
+class FakeAsyncVision(FakeVision):
+    """То же для AsyncVisionBatcher: complete - корутина"""
+
+    async def complete(self, content, max_tokens=500, model='gpt-4o'):
+        await asyncio.sleep(0)
+        return FakeVision.complete(self, content, max_tokens, model)
+
+
+def run_async_together(batcher, images, prompt='prompt'):
+    async def main():
+        return await asyncio.gather(*(batcher.complete(image, prompt) for image in images))
+    return [json.loads(answer) for answer in asyncio.run(main())]
+
+
+def test_async_full_batch_is_one_request():
+    """Задачи asyncio собираются в пакет так же, как потоки"""
+    vision = FakeAsyncVision(lambda images: json.dumps(
+        [{'index': n, 'hora_number': image} for n, image in enumerate(images, start=1)]))
+    batcher = AsyncVisionBatcher(vision, max_batch=3, window=5, max_tokens=100)
+
+    answers = run_async_together(batcher, ['a', 'b', 'c'])
+
+    assert answers == [{'hora_number': 'a'}, {'hora_number': 'b'}, {'hora_number': 'c'}]
+    assert vision.calls == [(['a', 'b', 'c'], 300)]
+
+
+def test_async_partial_answer_and_split():
+    """Неполный ответ и 400 на пакет - переспрос по одному фото"""
+    vision = FakeAsyncVision(lambda images: json.dumps([{'index': 2, 'hora_number': images[1]}]))
+    answers = run_async_together(AsyncVisionBatcher(vision, max_batch=2, window=5), ['a', 'b'])
+    assert answers == [{'hora_number': 'a', 'single': True}, {'hora_number': 'b'}]
+    assert len(vision.calls) == 2
+
+    def reject(images):
+        raise VisionAPIError('400 Error', status_code=400)
+    vision = FakeAsyncVision(reject)
+    answers = run_async_together(AsyncVisionBatcher(vision, max_batch=2, window=5), ['a', 'b'])
+    assert answers == [{'hora_number': 'a', 'single': True}, {'hora_number': 'b', 'single': True}]
+    assert len(vision.calls) == 3
+
+
+def test_async_cancelled_leader_does_not_strand_others():
+    """Отмена лидера до отправки: остальные фото уходят одиночными запросами"""
+    vision = FakeAsyncVision(lambda images: pytest.fail('no batch expected'))
+    batcher = AsyncVisionBatcher(vision, max_batch=4, window=5)
+
+    async def main():
+        leader = asyncio.create_task(batcher.complete('a', 'prompt'))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(batcher.complete('b', 'prompt'))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await asyncio.wait_for(follower, 1)
+
+    assert json.loads(asyncio.run(main())) == {'hora_number': 'b', 'single': True}
+    assert vision.calls == [(['b'], 500)]
@@ -0,0 +1,132 @@
+"""
+Клиент vision API: повторы после 429 и 5xx, ответ не-JSON, лимит частоты на процесс
+"""
+
+import asyncio
+import json
+import time
+from collections import defaultdict
+
+import pytest
+
+import profiling
+import vision_client
+from vision_client import AsyncVisionClient, VisionAPIError, VisionClient, client_options
+
+ANSWER = json.dumps({'choices': [{'message': {'content': '{"hora_number": "1"}'}}]})
+
+
+class FakeResponse:
+    def __init__(self, status_code, text=ANSWER, headers=None, reason='OK'):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.reason = reason
+
+
+class FakeSession:
+    """Вместо requests.Session: отдает заготовленные ответы по очереди"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Паузы клиента: записываются и выполняются (все короткие)"""
+    recorded = []
+    real_sleep = time.sleep
+
+    def sleep(seconds):
+        recorded.append(seconds)
+        real_sleep(seconds)
+    monkeypatch.setattr(vision_client.time, 'sleep', sleep)
+    return recorded
+
+
+def make_client(*responses):
+    client = VisionClient('test', max_retries=2, backoff_base=0.01, backoff_max=0.02,
+                          requests_per_minute=6000, burst=10)
+    client.session = FakeSession(responses)
+    return client
+
+
+def test_429_waits_retry_after_for_whole_process(sleeps):
+    """429: пауза из Retry-After, на нее же останавливается общий лимит частоты"""
+    client = make_client(FakeResponse(429, headers={'Retry-After': '0.1'}, reason='Too Many Requests'),
+                         FakeResponse(200))
+    started = time.monotonic()
+
+    assert client.complete('text') == '{"hora_number": "1"}'
+    assert sleeps[0] == 0.1
+    assert client.bucket.paused_until >= started + 0.1
+    assert client.session.calls == 2
+    assert client.stats == {'requests': 2, 'retries': 1, 'errors': 0, 'rate_limited': 1}
+
+
+def test_5xx_is_retried_with_backoff(sleeps):
+    """503, затем успех: один повтор с задержкой не больше backoff_base"""
+    client = make_client(FakeResponse(503, reason='Service Unavailable'), FakeResponse(200))
+
+    assert client.complete('text') == '{"hora_number": "1"}'
+    assert len(sleeps) == 1 and 0 <= sleeps[0] <= 0.01
+    assert client.stats == {'requests': 2, 'retries': 1, 'errors': 0, 'rate_limited': 0}
+
+
+def test_non_json_2xx_raises_after_retries(sleeps):
+    """200 с HTML (прокси) повторяется, после max_retries - VisionAPIError"""
+    client = make_client(FakeResponse(200, text='<html>gateway</html>'))
+
+    with pytest.raises(VisionAPIError, match='Invalid JSON') as error:
+        client.complete('text')
+    assert error.value.status_code == 200
+    assert client.session.calls == 3
+    assert client.stats == {'requests': 3, 'retries': 2, 'errors': 1, 'rate_limited': 0}
+
+
+def test_client_error_is_not_retried(sleeps):
+    """400 - сразу VisionAPIError с кодом ответа"""
+    client = make_client(FakeResponse(400, reason='Bad Request'))
+
+    with pytest.raises(VisionAPIError) as error:
+        client.complete('text')
+    assert error.value.status_code == 400
+    assert client.session.calls == 1
+    assert sleeps == []
+
+
+@pytest.mark.parametrize('processes, per_process', [('4', 30.0), ('1', 120.0), ('0', 120.0)])
+def test_rpm_is_split_between_processes(monkeypatch, processes, per_process):
+    """VISION_API_RPM - бюджет ключа, делится на VISION_API_PROCESSES (не меньше 1)"""
+    monkeypatch.setenv('VISION_API_RPM', '120')
+    monkeypatch.setenv('VISION_API_PROCESSES', processes)
+    assert client_options()['requests_per_minute'] == per_process
+
+
+def test_async_complete_counts_vision_phase():
+    """Асинхронный клиент тоже учитывает время запроса в фазе vision (Server-Timing)"""
+    client = AsyncVisionClient('test')
+
+    async def chat(content, max_tokens=500, model='gpt-4o'):
+        await asyncio.sleep(0.02)
+        return json.loads(ANSWER)
+    client.chat = chat
+
+    async def main():
+        try:
+            return await client.complete('text')
+        finally:
+            await client.aclose()
+
+    timings = defaultdict(float)
+    token = profiling._timings.set(timings)
+    try:
+        assert asyncio.run(main()) == '{"hora_number": "1"}'
+    finally:
+        profiling._timings.reset(token)
+    assert timings['vision'] >= 0.02
@@ -0,0 +1,82 @@
+"""
+Миниатюры фото LoadLock для карточек (WebP/JPEG через OpenCV)
+"""
+
+import os
+from pathlib import Path
+
+import cv2
+
+from image_preprocess import REDUCED_READ_FLAGS, image_dimensions
+
+THUMBNAIL_MEDIA_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+class ThumbnailMaker:
+    """Строит уменьшенные копии фото в отдельной папке"""
+
+    def __init__(self, thumb_dir, max_side=320, output_format='webp', quality=75):
+        self.thumb_dir = Path(thumb_dir)
+        self.thumb_dir.mkdir(parents=True, exist_ok=True)
+        self.max_side = max_side
+        self.output_format = output_format if output_format in THUMBNAIL_MEDIA_TYPES else 'jpeg'
+        self.quality = quality
+
+    @classmethod
+    def from_env(cls, default_dir):
+        """Создает генератор миниатюр с настройками из переменных окружения"""
+        return cls(
+            os.getenv('THUMBNAIL_DIR') or default_dir,
+            max_side=int(os.getenv('THUMBNAIL_MAX_SIDE', 320)),
+            output_format=os.getenv('THUMBNAIL_FORMAT', 'webp').lower(),
+            quality=int(os.getenv('THUMBNAIL_QUALITY', 75))
+        )
+
+    @property
+    def media_type(self):
+        return THUMBNAIL_MEDIA_TYPES[self.output_format]
+
+    def thumbnail_path(self, name):
+        """Путь миниатюры для имени (например, id LoadLock и имя исходного файла)"""
+        extension = '.webp' if self.output_format == 'webp' else '.jpg'
+        return self.thumb_dir / f"{name}{extension}"
+
+    def _read(self, image_path):
+        """Декодирует фото сразу уменьшенным, если это JPEG сильно больше миниатюры"""
+        flags = cv2.IMREAD_COLOR
+        size = image_dimensions(image_path)
+        if size and Path(image_path).suffix.lower() in ('.jpg', '.jpeg'):
+            longest = max(size)
+            for factor in (8, 4, 2):
+                if longest // factor >= self.max_side:
+                    flags = REDUCED_READ_FLAGS[factor]
+                    break
+        return cv2.imread(str(image_path), flags)
+
+    def make(self, image_path, name):
+        """Создает миниатюру и возвращает ее путь или None, если фото не читается"""
+        image = self._read(image_path)
+        if image is None:
+            return None
+
+        height, width = image.shape[:2]
+        longest = max(height, width)
+        if longest > self.max_side:
+            scale = self.max_side / longest
+            image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+
+        if self.output_format == 'webp':
+            ok, buffer = cv2.imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+        else:
+            ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality,
+                                                      cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+        if not ok:
+            return None
+
+        path = self.thumbnail_path(name)
+        # Запись через временный файл: читатель никогда не увидит половину миниатюры
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_bytes(buffer.tobytes())
+        os.replace(tmp_path, path)
+        return path
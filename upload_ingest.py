@@ -0,0 +1,91 @@
+"""
+Потоковый прием загрузок: тело запроса пишется на диск кусками с подсчетом SHA-256
+"""
+
+import hashlib
+import os
+import tempfile
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from image_preprocess import sniff_image_type
+
+# Сколько первых байтов нужно для определения формата по сигнатуре
+SNIFF_BYTES = 16
+
+
+class HashingSpool:
+    """Файл для werkzeug (stream_factory): пишет части загрузки сразу в папку назначения.
+
+    По пути считает SHA-256 и размер и определяет формат по первым байтам,
+    поэтому после разбора запроса файл не нужно ни копировать, ни перечитывать.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.header = b''
+        self.finalized = False
+        self._file = tempfile.NamedTemporaryFile(dir=self.directory, prefix='.ingest_',
+                                                 suffix='.part', delete=False)
+        self.path = self._file.name
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+    @property
+    def extension(self):
+        """Настоящий формат по сигнатуре ('.jpg', '.png', ...) или None"""
+        return sniff_image_type(self.header)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.discard()
+            raise RequestEntityTooLarge()
+        if len(self.header) < SNIFF_BYTES:
+            self.header += bytes(data[:SNIFF_BYTES - len(self.header)])
+        self.digest.update(data)
+        return self._file.write(data)
+
+    # Остальной интерфейс файла, который использует FileStorage
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def flush(self):
+        return self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def store_in(self, store, extension):
+        """Переносит принятый файл в BlobStore под его хэшем (rename без копирования)"""
+        self.close()
+        self.path = store.put_file(self.path, self.sha256, extension)
+        self.finalized = True
+        return self.path
+
+    def discard(self):
+        """Удаляет недопринятый или отклоненный файл"""
+        self.close()
+        if self.finalized:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
@@ -0,0 +1,264 @@
+"""
+Микропакеты запросов к vision API: несколько одновременно ждущих распознавания фото
+уходят одним запросом chat/completions, ответ - JSON-массив с номерами изображений
+
+Отдельного потока нет: первый вызвавший поток (лидер) ждет остальных до window секунд
+или до max_batch фото, отправляет пакет и раздает результаты. Фото, для которых ответ
+пакета не разобрался, каждый поток переспрашивает одиночным запросом.
+AsyncVisionBatcher - то же для задач asyncio (ASGI-режим).
+"""
+
+import asyncio
+import json
+import os
+import re
+import threading
+
+from metrics import VISION_BATCH_FALLBACKS, VISION_BATCH_IMAGES
+from profiling import phase
+from vision_client import VisionAPIError
+
+# Ответы API, после которых пакет переспрашивается по одному фото (запрос слишком велик)
+SPLIT_STATUSES = {400, 413}
+
+BATCH_PROMPT = """You will receive {count} images, each preceded by its label "Image <number>".
+Apply the following instructions to EACH image independently.
+
+{prompt}
+
+Return ONLY a JSON array with exactly {count} objects, one per image in the same order.
+Each object must have the structure described above plus an "index" field with the image number (1 to {count})."""
+
+
+def parse_batch_response(response_text, count):
+    """Результаты пакета по номерам изображений: {номер: словарь}; неразобранные номера отсутствуют"""
+    match = re.search(r'\[.*\]', response_text or '', re.DOTALL)
+    if not match:
+        return {}
+    try:
+        items = json.loads(match.group())
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    results = {}
+    for position, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            continue
+        index = item.pop('index', None)
+        try:
+            index = int(index)
+        except (TypeError, ValueError):
+            # Без номера порядок надежен, только если объектов ровно столько, сколько фото
+            index = position if len(items) == count else None
+        if index is not None and 1 <= index <= count and index not in results:
+            results[index] = item
+    return results
+
+
+class _Pending:
+    """Фото, ждущее ответа пакета"""
+
+    def __init__(self, image_source, event=threading.Event):
+        self.image_source = image_source
+        self.answer = None
+        self.error = None
+        # Ответ пакета не разобрался - поток сам отправит одиночный запрос
+        self.fallback = False
+        self.done = event()
+
+
+class _Batch:
+    def __init__(self, event=threading.Event):
+        self.items = []
+        self.full = event()
+
+
+class VisionBatcher:
+    """Собирает одновременные запросы с одним промптом в пакеты до max_batch фото"""
+
+    def __init__(self, vision, model="gpt-4o", max_batch=4, window=0.1, max_tokens=500):
+        self.vision = vision
+        self.model = model
+        self.max_batch = max_batch
+        self.window = window
+        # Лимит ответа на одно фото; у пакета - на все фото сразу
+        self.max_tokens = max_tokens
+        self._open = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, vision, model="gpt-4o", max_tokens=500):
+        """Создает пакетировщик из VISION_BATCH_SIZE (1 - без пакетов) и VISION_BATCH_WINDOW_MS"""
+        return cls(
+            vision,
+            model=model,
+            max_batch=max(1, int(os.getenv('VISION_BATCH_SIZE', 4))),
+            window=float(os.getenv('VISION_BATCH_WINDOW_MS', 100)) / 1000,
+            max_tokens=max_tokens
+        )
+
+    def complete(self, image_source, prompt):
+        """Текст ответа для одного фото (как vision.complete) или None; VisionAPIError при ошибке API"""
+        if self.max_batch <= 1:
+            return self._single(image_source, prompt)
+
+        pending, batch, leader = self._join(image_source, prompt, threading.Event)
+        if leader:
+            with phase('vision'):
+                batch.full.wait(self.window)
+            self._close(batch, prompt)
+            self._send(batch.items, prompt)
+        else:
+            with phase('vision'):
+                pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        if pending.fallback:
+            VISION_BATCH_FALLBACKS.inc()
+            return self._single(image_source, prompt)
+        return pending.answer
+
+    def _join(self, image_source, prompt, event):
+        """Добавляет фото в открытый пакет промпта: (_Pending, _Batch, лидер ли вызывающий)"""
+        pending = _Pending(image_source, event)
+        with self._lock:
+            batch = self._open.get(prompt)
+            leader = batch is None
+            if leader:
+                batch = self._open[prompt] = _Batch(event)
+            batch.items.append(pending)
+            if len(batch.items) >= self.max_batch:
+                # Пакет полон - следующие запросы начинают новый
+                del self._open[prompt]
+                batch.full.set()
+        return pending, batch, leader
+
+    def _close(self, batch, prompt):
+        """Закрывает пакет для новых фото (если он еще открыт)"""
+        with self._lock:
+            if self._open.get(prompt) is batch:
+                del self._open[prompt]
+
+    def _single(self, image_source, prompt):
+        return self.vision.complete(self._single_content(image_source, prompt),
+                                    max_tokens=self.max_tokens, model=self.model)
+
+    @staticmethod
+    def _single_content(image_source, prompt):
+        return [
+            {"type": "image_url", "image_url": {"url": image_source}},
+            {"type": "text", "text": prompt}
+        ]
+
+    @staticmethod
+    def _batch_content(items, prompt):
+        """Сообщение пакета: подписи "Image N", изображения и общий промпт"""
+        content = []
+        for number, item in enumerate(items, start=1):
+            content.append({"type": "text", "text": f"Image {number}:"})
+            content.append({"type": "image_url", "image_url": {"url": item.image_source}})
+        content.append({"type": "text", "text": BATCH_PROMPT.format(count=len(items), prompt=prompt)})
+        return content
+
+    @staticmethod
+    def _distribute(items, answer):
+        """Раздает результаты пакета; фото без результата переспрашиваются по одному"""
+        results = parse_batch_response(answer, len(items))
+        for number, item in enumerate(items, start=1):
+            if number in results:
+                item.answer = json.dumps(results[number], ensure_ascii=False)
+            else:
+                item.fallback = True
+
+    @staticmethod
+    def _fail(items, error):
+        """Ошибка пакета: слишком большой пакет - по одному фото, остальное - всем"""
+        for item in items:
+            if (len(items) > 1 and isinstance(error, VisionAPIError)
+                    and error.status_code in SPLIT_STATUSES):
+                item.fallback = True
+            else:
+                item.error = error
+
+    def _send(self, items, prompt):
+        """Отправляет пакет и раздает результаты; вызывается лидером"""
+        VISION_BATCH_IMAGES.observe(len(items))
+        try:
+            if len(items) == 1:
+                items[0].answer = self._single(items[0].image_source, prompt)
+                return
+
+            answer = self.vision.complete(self._batch_content(items, prompt),
+                                          max_tokens=self.max_tokens * len(items), model=self.model)
+            self._distribute(items, answer)
+        except Exception as e:
+            self._fail(items, e)
+        finally:
+            for item in items:
+                item.done.set()
+
+
+class AsyncVisionBatcher(VisionBatcher):
+    """То же для asyncio (AsyncVisionClient): задачи ждут пакет, не блокируя цикл событий"""
+
+    async def complete(self, image_source, prompt):
+        """Текст ответа для одного фото или None; VisionAPIError при ошибке API"""
+        if self.max_batch <= 1:
+            return await self._single(image_source, prompt)
+
+        pending, batch, leader = self._join(image_source, prompt, asyncio.Event)
+        if leader:
+            try:
+                with phase('vision'):
+                    await asyncio.wait_for(batch.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                # Лидер отменен до отправки - остальные фото уходят одиночными запросами
+                self._close(batch, prompt)
+                for item in batch.items:
+                    item.fallback = True
+                    item.done.set()
+                raise
+            self._close(batch, prompt)
+            await self._send(batch.items, prompt)
+        else:
+            with phase('vision'):
+                await pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        if pending.fallback:
+            VISION_BATCH_FALLBACKS.inc()
+            return await self._single(image_source, prompt)
+        return pending.answer
+
+    async def _single(self, image_source, prompt):
+        return await self.vision.complete(self._single_content(image_source, prompt),
+                                          max_tokens=self.max_tokens, model=self.model)
+
+    async def _send(self, items, prompt):
+        """Отправляет пакет и раздает результаты; вызывается лидером"""
+        VISION_BATCH_IMAGES.observe(len(items))
+        try:
+            if len(items) == 1:
+                items[0].answer = await self._single(items[0].image_source, prompt)
+                return
+
+            answer = await self.vision.complete(self._batch_content(items, prompt),
+                                                max_tokens=self.max_tokens * len(items),
+                                                model=self.model)
+            self._distribute(items, answer)
+        except asyncio.CancelledError:
+            # Лидер отменен во время запроса - остальные фото уходят одиночными запросами
+            for item in items:
+                item.fallback = True
+            raise
+        except Exception as e:
+            self._fail(items, e)
+        finally:
+            for item in items:
+                item.done.set()
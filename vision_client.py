@@ -0,0 +1,505 @@
+"""
+Общий клиент vision API (chat/completions): пул соединений, повторы, лимиты запросов
+"""
+
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import observe_vision_response
+from profiling import phase
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+# Временные ошибки, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+# Кратно 3: base64 соседних кусков склеивается без промежуточного '='
+BASE64_CHUNK = 3 * 16 * 1024
+
+
+class VisionAPIError(Exception):
+    """Запрос к vision API не удался (после всех повторов)"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def parse_reset_duration(value):
+    """Разбирает длительность из x-ratelimit-reset-*: '1s', '6m0s', '20ms', '1h2m3.5s'"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def parse_retry_after(value):
+    """Разбирает Retry-After: секунды или HTTP-дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ImageSource:
+    """Изображение для image_url, которое кодируется в base64 по частям при отправке"""
+
+    def __init__(self, media_type, path=None, data=None):
+        self.media_type = media_type
+        self.path = path
+        self.data = data
+
+    @property
+    def size(self):
+        """Размер изображения в байтах"""
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def uri_length(self):
+        """Длина data URI без его построения"""
+        return len(self.uri_prefix()) + 4 * ((self.size + 2) // 3)
+
+    def uri_prefix(self):
+        return f"data:{self.media_type};base64,".encode('ascii')
+
+    def iter_uri(self):
+        """Отдает data URI частями: в памяти не больше одного куска файла"""
+        yield self.uri_prefix()
+        if self.data is not None:
+            for start in range(0, len(self.data), BASE64_CHUNK):
+                yield base64.standard_b64encode(self.data[start:start + BASE64_CHUNK])
+            return
+        with open(self.path, 'rb') as image_file:
+            for chunk in iter(lambda: image_file.read(BASE64_CHUNK), b''):
+                yield base64.standard_b64encode(chunk)
+
+    def to_uri(self):
+        """Полный data URI строкой (для небольших изображений и отладки)"""
+        return b''.join(self.iter_uri()).decode('ascii')
+
+
+class StreamingJSONBody:
+    """Тело запроса: JSON, в котором ImageSource подставляются потоково.
+
+    requests видит объект с read() и __len__ и отправляет его с Content-Length,
+    читая кусками, - полная base64-строка изображения в памяти не собирается.
+    """
+
+    def __init__(self, payload):
+        self.parts = []
+        sources = []
+        marker = f"__image_{uuid.uuid4().hex}_"
+
+        def replace(value):
+            if isinstance(value, ImageSource):
+                sources.append(value)
+                return f"{marker}{len(sources) - 1}__"
+            if isinstance(value, dict):
+                return {key: replace(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [replace(item) for item in value]
+            return value
+
+        text = json.dumps(replace(payload), ensure_ascii=False)
+        for i, piece in enumerate(re.split(rf'{marker}(\d+)__', text)):
+            # Нечетные элементы split - номера изображений
+            self.parts.append(sources[int(piece)] if i % 2 else piece.encode('utf-8'))
+        self.length = sum(part.uri_length() if isinstance(part, ImageSource) else len(part)
+                          for part in self.parts)
+        self.rewind()
+
+    def __len__(self):
+        return self.length
+
+    def rewind(self):
+        """Готовит тело к повторной отправке"""
+        self._chunks = self._iter_chunks()
+        self._buffer = b''
+
+    def _iter_chunks(self):
+        for part in self.parts:
+            if isinstance(part, ImageSource):
+                yield from part.iter_uri()
+            else:
+                yield part
+
+    async def aiter_chunks(self):
+        """Куски тела для асинхронного клиента (httpx)"""
+        for chunk in self._iter_chunks():
+            yield chunk
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def contains_image_source(value):
+    """Есть ли в payload изображения, которые нужно отправлять потоково"""
+    if isinstance(value, ImageSource):
+        return True
+    if isinstance(value, dict):
+        return any(contains_image_source(item) for item in value.values())
+    if isinstance(value, list):
+        return any(contains_image_source(item) for item in value)
+    return False
+
+
+class TokenBucket:
+    """Клиентский ограничитель частоты: rate запросов в секунду, запас capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # Пауза, которую попросил сервер (Retry-After, исчерпанный лимит)
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Берет токен и возвращает 0 или возвращает, сколько секунд ждать"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Блокирует поток, пока не появится свободный токен"""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """То же для asyncio: ждет, не блокируя цикл событий"""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов всем потокам на seconds секунд"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class BaseVisionClient:
+    """Общее для синхронного и асинхронного клиентов: лимит частоты, задержки, статистика"""
+
+    def __init__(self, api_key, base_url=None, timeout=60, max_retries=4,
+                 backoff_base=1.0, backoff_max=30.0, requests_per_minute=60,
+                 burst=10, bucket=None):
+        self.api_key = api_key
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # bucket - общий лимит с другим клиентом того же процесса
+        self.bucket = bucket or TokenBucket(requests_per_minute / 60.0, burst)
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+
+        self.stats = {'requests': 0, 'retries': 0, 'errors': 0, 'rate_limited': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        """Увеличивает счетчик статистики"""
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _backoff(self, attempt):
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _respect_rate_limits(self, response):
+        """Приостанавливает запросы, если сервер сообщает об исчерпанном лимите"""
+        headers = response.headers
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if remaining is not None and remaining.isdigit() and int(remaining) == 0:
+                reset = parse_reset_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                if reset:
+                    self.bucket.pause(reset)
+
+    def _retry_delay(self, response, attempt):
+        """Пауза перед повтором после ответа с кодом из RETRY_STATUSES"""
+        delay = self._backoff(attempt)
+        if response.status_code == 429:
+            self._count('rate_limited')
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                delay = retry_after
+            # Лимит общий для всех потоков процесса - ждут все
+            self.bucket.pause(delay)
+        self._count('retries')
+        return delay
+
+    @staticmethod
+    def _decode(response_text, status_code):
+        """JSON успешного ответа; VisionAPIError, если тело не JSON-объект"""
+        try:
+            result = json.loads(response_text)
+        except ValueError as e:
+            raise VisionAPIError(f"{status_code} Invalid JSON in response: {e}",
+                                 status_code=status_code) from e
+        if not isinstance(result, dict):
+            raise VisionAPIError(f"{status_code} Unexpected response: {type(result).__name__}",
+                                 status_code=status_code)
+        return result
+
+    @staticmethod
+    def _answer_text(result):
+        """Текст первого варианта ответа или None"""
+        if 'choices' in result and len(result['choices']) > 0:
+            return result['choices'][0]['message']['content']
+        return None
+
+
+class VisionClient(BaseVisionClient):
+    """Клиент chat/completions с keep-alive пулом, повторами и ограничением частоты"""
+
+    def __init__(self, api_key, base_url=None, pool_size=16, **options):
+        super().__init__(api_key, base_url, **options)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(self.headers)
+
+    def chat(self, content, max_tokens=500, model="gpt-4o"):
+        """Отправляет сообщение пользователя и возвращает JSON ответа.
+
+        В content вместо строки data URI можно передать ImageSource - изображение
+        будет закодировано в base64 потоково во время отправки.
+        """
+        payload = {
+            "model": model,
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": max_tokens
+        }
+        url = f"{self.base_url}/chat/completions"
+        body = StreamingJSONBody(payload) if contains_image_source(content) else None
+
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self._count('requests')
+            started = time.perf_counter()
+            try:
+                if body is not None:
+                    body.rewind()
+                    response = self.session.post(url, data=body, timeout=self.timeout)
+                else:
+                    response = self.session.post(url, json=payload, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                observe_vision_response('error', time.perf_counter() - started)
+                if attempt >= self.max_retries:
+                    self._count('errors')
+                    raise VisionAPIError(str(e)) from e
+                self._count('retries')
+                time.sleep(self._backoff(attempt))
+                continue
+
+            self._respect_rate_limits(response)
+
+            if response.status_code < 400:
+                try:
+                    result = self._decode(response.text, response.status_code)
+                except VisionAPIError:
+                    # Обрезанный или чужой (прокси) ответ - повторяем, как сетевую ошибку
+                    observe_vision_response('error', time.perf_counter() - started)
+                    if attempt >= self.max_retries:
+                        self._count('errors')
+                        raise
+                    self._count('retries')
+                    time.sleep(self._backoff(attempt))
+                    continue
+                observe_vision_response(response.status_code, time.perf_counter() - started,
+                                        result.get('usage'))
+                return result
+            observe_vision_response(response.status_code, time.perf_counter() - started)
+
+            if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                self._count('errors')
+                raise VisionAPIError(
+                    f"{response.status_code} Error: {response.reason} for url: {url}",
+                    status_code=response.status_code
+                )
+
+            time.sleep(self._retry_delay(response, attempt))
+
+    def complete(self, content, max_tokens=500, model="gpt-4o"):
+        """Возвращает текст первого варианта ответа или None, если вариантов нет"""
+        # Фаза vision в Server-Timing включает ожидание лимита и повторы
+        with phase('vision'):
+            result = self.chat(content, max_tokens=max_tokens, model=model)
+        return self._answer_text(result)
+
+
+class AsyncVisionClient(BaseVisionClient):
+    """Неблокирующий клиент chat/completions для asyncio (httpx): те же повторы и лимиты.
+
+    Сотни запросов одновременно ждут ответа в одном потоке; пул соединений - pool_size.
+    """
+
+    def __init__(self, api_key, base_url=None, pool_size=100, **options):
+        # httpx нужен только ASGI-режиму (asgi_app.py)
+        import httpx
+        super().__init__(api_key, base_url, **options)
+        self._httpx = httpx
+        self.client = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+    async def chat(self, content, max_tokens=500, model="gpt-4o"):
+        """Отправляет сообщение пользователя и возвращает JSON ответа (ImageSource - потоково)"""
+        payload = {
+            "model": model,
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": max_tokens
+        }
+        url = f"{self.base_url}/chat/completions"
+        body = StreamingJSONBody(payload)
+
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire_async()
+            self._count('requests')
+            started = time.perf_counter()
+            try:
+                body.rewind()
+                # Длина известна заранее - тело уходит с Content-Length, без chunked
+                response = await self.client.post(
+                    url, content=body.aiter_chunks(), headers={'Content-Length': str(len(body))}
+                )
+            except self._httpx.TransportError as e:
+                observe_vision_response('error', time.perf_counter() - started)
+                if attempt >= self.max_retries:
+                    self._count('errors')
+                    raise VisionAPIError(str(e)) from e
+                self._count('retries')
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            self._respect_rate_limits(response)
+
+            if response.status_code < 400:
+                try:
+                    result = self._decode(response.text, response.status_code)
+                except VisionAPIError:
+                    # Обрезанный или чужой (прокси) ответ - повторяем, как сетевую ошибку
+                    observe_vision_response('error', time.perf_counter() - started)
+                    if attempt >= self.max_retries:
+                        self._count('errors')
+                        raise
+                    self._count('retries')
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+                observe_vision_response(response.status_code, time.perf_counter() - started,
+                                        result.get('usage'))
+                return result
+            observe_vision_response(response.status_code, time.perf_counter() - started)
+
+            if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                self._count('errors')
+                raise VisionAPIError(
+                    f"{response.status_code} Error: {response.reason_phrase} for url: {url}",
+                    status_code=response.status_code
+                )
+            await asyncio.sleep(self._retry_delay(response, attempt))
+
+    async def complete(self, content, max_tokens=500, model="gpt-4o"):
+        """Возвращает текст первого варианта ответа или None, если вариантов нет"""
+        # Как у VisionClient: фаза vision включает ожидание лимита и повторы
+        with phase('vision'):
+            result = await self.chat(content, max_tokens=max_tokens, model=model)
+        return self._answer_text(result)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client_options():
+    """Настройки клиента из окружения (VISION_API_*)"""
+    return {
+        'timeout': float(os.getenv('VISION_API_TIMEOUT', 60)),
+        'max_retries': int(os.getenv('VISION_API_MAX_RETRIES', 4)),
+        # Лимит частоты действует внутри процесса: VISION_API_RPM - общий бюджет ключа,
+        # делится на число процессов с клиентом (воркеры gunicorn + worker.py)
+        'requests_per_minute': float(os.getenv('VISION_API_RPM', 60))
+        / max(1, int(os.getenv('VISION_API_PROCESSES', 1))),
+        'burst': int(os.getenv('VISION_API_BURST', 10)),
+    }
+
+
+def get_vision_client(api_key, base_url=None):
+    """Возвращает общий на процесс клиент: один пул соединений и один лимит на всех"""
+    base_url = base_url or os.getenv('VISION_API_BASE_URL') or DEFAULT_BASE_URL
+    key = (api_key, base_url)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = VisionClient(
+                api_key,
+                base_url=base_url,
+                pool_size=int(os.getenv('VISION_API_POOL_SIZE', 16)),
+                **client_options()
+            )
+        return _clients[key]
+
+
+def create_async_vision_client(api_key, base_url=None):
+    """Асинхронный клиент для текущего цикла событий; лимит частоты общий с get_vision_client"""
+    base_url = base_url or os.getenv('VISION_API_BASE_URL') or DEFAULT_BASE_URL
+    return AsyncVisionClient(
+        api_key,
+        base_url=base_url,
+        pool_size=int(os.getenv('VISION_API_ASYNC_POOL_SIZE', 100)),
+        bucket=get_vision_client(api_key, base_url).bucket,
+        **client_options()
+    )
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Отдельный процесс для фоновых задач распознавания (Procfile: worker)
+"""
+
+import atexit
+import os
+
+# Веб-процесс не должен запускать собственные обработчики внутри этого процесса
+os.environ['UPLOAD_WORKERS'] = '0'
+
+# Метрики пишутся в ту же папку, что у gunicorn (PROMETHEUS_MULTIPROC_DIR), до импорта app
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from app import job_queue, JOB_HANDLERS
+from job_queue import JobWorkerPool
+from metrics import mark_process_dead
+
+
+def main():
+    """Запускает пул обработчиков очереди"""
+    # Live-метрики (обработчики очереди) этого процесса после выхода не учитываются
+    atexit.register(mark_process_dead, os.getpid())
+    size = int(os.environ.get('WORKER_THREADS', 4))
+    print(f"✓ Обработчик очереди запущен: {size} потоков")
+    JobWorkerPool(job_queue, JOB_HANDLERS, size=size).run_forever()
+
+
+if __name__ == "__main__":
+    main()